@@ -4,18 +4,49 @@
 """
 raspberry piのGPIOのダミープログラム。
 raspberry pi以外でも動作するように、必要な関数をダミーで用意。
+
+ピン毎の入力レベルを持ち、set_inputでレベルを変えるとadd_event_detectで指定したエッジとbouncetimeに従って
+callbackを呼ぶ。Timelineは(時刻, ピン番号, レベル)のリストを別スレッドで再生し、実際のライブラリと同じく
+callbackを別スレッドから呼ぶ。bouncetimeの判定には実時間ではなく予定の時刻を使うので、結果は再現できる。
+コンソールへの出力はしない。
 """
 
+import threading
+import time
 
 BOARD = 1
 OUT = 0
 IN = 1
 BCM = 2
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
 RISING = 31
 FALLING = 32
 BOTH = 33
 
+mode = None
+levels = {}  # ピン番号毎の入力レベル 設定していないピンはHIGH(接点off)
+directions = {}
+edges = {}  # ピン番号毎の検出するエッジ
+bouncetimes = {}  # ピン番号毎のbouncetime (s)
+last_events = {}  # ピン番号毎の最後に検出したエッジの時刻 (s)
+detected = set()  # event_detectedで取得されていないエッジを検出したピン番号
 callbacks = {}
+errors = []  # callbackで発生した例外
+lock = threading.RLock()
+
+
+def channels(a):
+    """
+    ピン番号、またはピン番号のリストから、ピン番号のリストを返す。
+
+    :param a: int
+    :return: list of int
+    """
+    return list(a) if isinstance(a, (list, tuple)) else [a]
 
 
 def setmode(a):
@@ -25,18 +56,38 @@ def setmode(a):
     :param a: str
     :return:
     """
-    print(a)
+    global mode
+    mode = a
+
+
+def getmode():
+    """
+    Get numbering mode used for channel numbers.
+
+    :return: int
+    """
+    return mode
 
 
-def setup(a, b):
+def setup(a, b, pull_up_down=PUD_OFF, initial=-1):
     """
     Set up a GPIO channel or list of channels with a direction and (optional) pull/up down control.
 
     :param a: str
     :param b: str
+    :param pull_up_down: int
+    :param initial: int
     :return:
     """
-    print(a, b)
+    with lock:
+        for channel in channels(a):
+            directions[channel] = b
+            if b == OUT and initial != -1:
+                levels[channel] = int(bool(initial))
+            elif pull_up_down == PUD_DOWN:
+                levels[channel] = LOW
+            elif pull_up_down == PUD_UP:
+                levels[channel] = HIGH
 
 
 def output(a, b):
@@ -47,7 +98,9 @@ def output(a, b):
     :param b: str
     :return:
     """
-    print(a, b)
+    with lock:
+        for channel in channels(a):
+            levels[channel] = int(bool(b))
 
 
 def input(a):
@@ -57,18 +110,74 @@ def input(a):
     :param a: str
     :return:
     """
-    print(a)
+    return bool(levels.get(a, HIGH))
+
+
+def set_input(a, value, at=None):
+    """
+    test dummy method. ピンの入力レベルを変え、検出するエッジであればcallbackを呼ぶ。
+    atはbouncetimeの判定に使う時刻(s)で、省略時は現在時刻。callbackはこの関数を呼んだスレッドで呼ぶ。
+    callbackを呼んだ場合はTrueを返す。
+
+    :param a: int
+    :param value: int
+    :param at: float
+    :return: bool
+    """
+    value = int(bool(value))
+    with lock:
+        previous = levels.get(a, HIGH)
+        levels[a] = value
+        edge = edges.get(a)
+        if previous == value or edge is None:
+            return False
+        if edge != BOTH and edge != (RISING if value else FALLING):
+            return False
+        if at is None:
+            at = time.monotonic()
+        last = last_events.get(a)
+        if last is not None and at - last < bouncetimes.get(a, 0):
+            return False  # チャタリングとして捨てる
+        last_events[a] = at
+        detected.add(a)
+        listeners = list(callbacks.get(a, ()))
+    fire(a, listeners)
     return True
 
 
-def cleanup():
+def fire(a, listeners):
+    """
+    callbackを順に呼ぶ。callbackで発生した例外はerrorsに記録し、次のcallbackを呼ぶ。
+
+    :param a: int
+    :param listeners: list of function
+    :return:
+    """
+    for callback in listeners:
+        try:
+            callback(a)
+        except Exception as e:
+            errors.append(e)
+
+
+def cleanup(a=None):
     """
     Clean up by resetting all GPIO channels that have been used by this program to INPUT
     with no pullup/pulldown and no event detection.
 
+    :param a: int
     :return:
     """
-    print('a')
+    global mode
+    with lock:
+        targets = list(set(levels) | set(directions) | set(edges)) if a is None else channels(a)
+        for channel in targets:
+            for table in (levels, directions, edges, bouncetimes, last_events, callbacks):
+                table.pop(channel, None)
+            detected.discard(channel)
+        if a is None:
+            mode = None  # 実際のライブラリと同じく、番号の指定も消える
+            del errors[:]
 
 
 def setwarnings(flag):
@@ -78,12 +187,13 @@ def setwarnings(flag):
     :param flag: bool
     :return:
     """
-    print(flag)
 
 
 def add_event_detect(a, b, callback=None, bouncetime=300):
     """
     Enable edge detection events for a particular GPIO channel.
+    実際のライブラリと同じく、setmodeとsetupで入力に設定していない場合はRuntimeError。
+    ダミーでは、既に設定されている場合も置き換える。
 
     :param a:
     :param b:
@@ -91,24 +201,156 @@ def add_event_detect(a, b, callback=None, bouncetime=300):
     :param bouncetime:
     :return:
     """
-
-    callbacks[a] = callback
-    print(a, b, callback, bouncetime)
+    with lock:
+        if mode is None:
+            raise RuntimeError('Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)')
+        if directions.get(a) != IN:
+            raise RuntimeError('You must setup() the GPIO channel as an input first')
+        edges[a] = b
+        bouncetimes[a] = max(bouncetime, 0) / 1000
+        last_events.pop(a, None)
+        callbacks[a] = [callback] if callback is not None else []
     return True
 
 
+def add_event_callback(a, callback):
+    """
+    Add a callback for an event already defined using add_event_detect().
+
+    :param a: int
+    :param callback: function
+    :return:
+    """
+    with lock:
+        if a not in edges:
+            raise RuntimeError('Add event detection using add_event_detect first before adding a callback')
+        callbacks[a].append(callback)
+
+
+def remove_event_detect(a):
+    """
+    Remove edge detection for a particular GPIO channel.
+
+    :param a: int
+    :return:
+    """
+    with lock:
+        for table in (edges, bouncetimes, last_events, callbacks):
+            table.pop(a, None)
+        detected.discard(a)
+
+
+def event_detected(a):
+    """
+    Returns True if an edge has occurred on a given GPIO.
+
+    :param a: int
+    :return: bool
+    """
+    with lock:
+        if a in detected:
+            detected.discard(a)
+            return True
+        return False
+
+
 def event_detect(a):
     """
     test dummy event detect method.
+    入力レベルとbouncetimeに関わらず、ピンのcallbackを呼ぶ。
+
     :param a:
     :return:
     """
-    try:
-        callback = callbacks[a]
-        callback(a)
-        print(callback)
-    except:
-        pass
+    with lock:
+        listeners = list(callbacks.get(a, ()))
+    fire(a, listeners)
+
+
+class Timeline:
+    """
+    (時刻(s), ピン番号, レベル)のリストを、別スレッドで時刻に合わせてset_inputする。
+    callbackは実際のライブラリと同じく、この1つのスレッドから順に呼ばれる。
+    speedは再生速度の倍率で、Noneの場合は待たずに全て入れる。
+    """
+
+    def __init__(self, events, speed=1.0):
+        """
+        コンストラクタ。再生はstart()で開始する。
+
+        :param events: list of (float, int, int)
+        :param speed: float
+        """
+        self.events = sorted(events, key=lambda event: event[0])
+        self.speed = speed
+        self.origin = None  # 再生開始時のtime.perf_counter()
+        self.lag = 0.0  # 予定の時刻からの最大の遅れ (s)
+        self.fired = []  # callbackを呼んだエッジの(時刻, ピン番号)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        再生を開始する。
+
+        :return: Timeline
+        """
+        self.stop_event.clear()
+        self.origin = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def scheduled(self, at):
+        """
+        イベントの時刻に対応するtime.perf_counter()の値を返す。
+
+        :param at: float
+        :return: float
+        """
+        return self.origin + (at / self.speed if self.speed else 0)
+
+    def run(self):
+        """
+        再生スレッドの本体。
+
+        :return:
+        """
+        for at, channel, value in self.events:
+            scheduled = self.scheduled(at)
+            delay = scheduled - time.perf_counter()
+            if delay > 0 and self.stop_event.wait(delay):
+                return
+            if self.stop_event.is_set():
+                return
+            if self.speed:
+                self.lag = max(self.lag, time.perf_counter() - scheduled)
+            if set_input(channel, value, at):
+                self.fired.append((at, channel))
+
+    def join(self, timeout=None):
+        """
+        再生が終わるまで待つ。終わった場合はTrueを返す。
+
+        :param timeout: float
+        :return: bool
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+    def stop(self):
+        """
+        再生を止める。
 
+        :return:
+        """
+        self.stop_event.set()
+        self.join()
 
+    def __enter__(self):
+        return self.start()
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+asyncio上で素材分配ルータを制御するプログラム。
+電文の組み立て・解析はChangeRouterと共通で、シリアルの受信はイベントループで待つ。
+"""
+
+import asyncio
+import serial
+import change_router
+from change_router import ChangeRouter, router_r_dict
+
+
+class AsyncChangeRouter:
+    """
+    asyncioで素材分配ルータを制御するクラス。
+    1つのシリアルポートを複数のコルーチンから使えるよう、電文のやり取りは到着順に1つずつ行う。
+    シリアルの受信はファイルディスクリプタの監視で行う為、raspberry pi(posix)上で動作する。
+    """
+
+    def __init__(self, port=None, timeout=None):
+        """
+        コンストラクタ。シリアルポートはopen()で開く。
+
+        :param port: str
+        :param timeout: float
+        """
+        self.port = port or change_router.comport
+        self.timeout = change_router.timeout if timeout is None else timeout
+        self.com = None
+        self.loop = None
+        self.reader = None
+        self.lock = None
+
+    async def open(self):
+        """
+        シリアルポートを開き、受信データをイベントループで受け取るようにする。
+
+        :return:
+        """
+        self.loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+        self.com = serial.Serial(
+            port=self.port,
+            baudrate=9600,
+            bytesize=8,
+            parity='N',
+            stopbits=1,
+            timeout=0,  # 受信は監視で待つ為、read()はすぐ読み出し
+            writeTimeout=5)
+        self.reader = asyncio.StreamReader()
+        self.loop.add_reader(self.com.fileno(), self.on_readable)
+
+    def close(self):
+        """
+        受信の監視をやめ、シリアルポートを閉じる。
+
+        :return:
+        """
+        if self.com is not None:
+            self.loop.remove_reader(self.com.fileno())
+            self.com.close()
+            self.com = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def on_readable(self):
+        """
+        シリアルポートが受信可能になった時のコールバック。受信データをreaderに渡す。
+
+        :return:
+        """
+        data = self.com.read(self.com.in_waiting or 1)
+        if data:
+            self.reader.feed_data(data)
+
+    async def transaction(self, frame, coro_func):
+        """
+        ロックを取得して電文を送信し、応答をcoro_funcで受信する。
+        タイムアウトやキャンセル時は前の応答の残りを次の送信で捨てる為、送信毎にreaderを作り直す。
+
+        :param frame: bytes
+        :param coro_func: function
+        :return: bool
+        """
+        async with self.lock:
+            self.reader = asyncio.StreamReader()
+            self.com.write(frame)
+            try:
+                return await asyncio.wait_for(coro_func(), self.timeout)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return False
+
+    async def set_crosspoint(self, dist, source):
+        """
+        ディスティネーションch,ソースchから制御する電文を送信し、成功失敗の結果を返す。
+
+        :param dist: str
+        :param source: str
+        :return: bool
+        """
+        async def receive():
+            reply = await self.reader.readexactly(1)
+            return reply[0] == router_r_dict['ACK']
+
+        return await self.transaction(
+            ChangeRouter.get_crosspoint_set_frame(dist, source), receive)
+
+    async def get_crosspoint(self, dist):
+        """
+        ディスティネーションchから情報を取得する電文を送信し、
+        (ディスティネーションch, ソースch)のタプルを返す。失敗した場合はNoneを返す。
+
+        :param dist: str
+        :return: (str, str)
+        """
+        async def receive():
+            reply = await self.reader.readexactly(1)
+            if reply[0] != router_r_dict['ACK']:
+                return None
+            await self.reader.readuntil(bytes((router_r_dict['STX'],)))
+            receipt_data = await self.reader.readuntil(bytes((router_r_dict['ETX'],)))
+            receipt_data += await self.reader.readexactly(1)  # BBC
+            return ChangeRouter.parse_status(receipt_data.decode('latin-1'))
+
+        channels = await self.transaction(ChangeRouter.get_information_frame(dist), receive)
+        return channels or None
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+ChangeRouterとSerial2Tcpをループバックのシリアルポート対とローカルのTCPの送信先でつなぎ、
+送受信の遅延を計測してJSONで出力するプログラム。リリース毎の性能の比較に使う。
+
+python benchmark.py --iterations 200 --output bench.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import RPi.GPIO as GPIO
+import change_router
+import loopback
+import router_log
+import serial2tcp
+
+
+def percentiles(samples):
+    """
+    計測した時間(s)のリストから、件数と最小・平均・パーセンタイル・最大(ms)の辞書を返す。
+
+    :param samples: list of float
+    :return: dict
+    """
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))] * 1000
+
+    return {
+        'count': len(ordered),
+        'min': ordered[0] * 1000,
+        'mean': sum(ordered) / len(ordered) * 1000,
+        'p50': rank(50),
+        'p90': rank(90),
+        'p99': rank(99),
+        'max': ordered[-1] * 1000,
+    }
+
+
+def start_bridge(port, sink):
+    """
+    ダミーのSerial2Tcpを開始する。全てのソースを変換できるようにし、送信先はsinkとする。
+
+    :param port: str
+    :param sink: loopback.TcpSink
+    :return: serial2tcp.Serial2Tcp
+    """
+    table_path = os.path.join(tempfile.gettempdir(), 'benchmark_location.csv')
+    with open(table_path, 'w', encoding='utf-8') as f:
+        f.write('地名,旧番号,新番号\n')
+        f.writelines('%d,%d,%d\n' % (i, i, (i - 1) % 256 + 1) for i in range(1000))
+    ser = serial2tcp.Serial2Tcp(port, table_path=table_path,
+                                targets=[sink.address + (serial2tcp.Serial2Tcp.target_id,)])
+    ser.start()
+    return ser
+
+
+def bench_set(cr, iterations):
+    """
+    set_crosspointの遅延を計測する。
+
+    :param cr: change_router.ChangeRouter
+    :param iterations: int
+    :return: dict
+    """
+    samples = []
+    failures = 0
+    for i in range(iterations):
+        start = time.perf_counter()
+        status = cr.set_crosspoint('127', ('070', '090')[i % 2])
+        samples.append(time.perf_counter() - start)
+        failures += not status
+    result = percentiles(samples)
+    result['failures'] = failures
+    return result
+
+
+def bench_get(cr, iterations):
+    """
+    get_crosspointの遅延を計測する。
+
+    :param cr: change_router.ChangeRouter
+    :param iterations: int
+    :return: dict
+    """
+    samples = []
+    failures = 0
+    for i in range(iterations):
+        start = time.perf_counter()
+        status = cr.get_crosspoint('127')
+        samples.append(time.perf_counter() - start)
+        failures += not status
+    result = percentiles(samples)
+    result['failures'] = failures
+    return result
+
+
+def bench_salvo(cr, iterations, size):
+    """
+    size個のディスティネーションのset_crosspointsの遅延とスループットを計測する。
+
+    :param cr: change_router.ChangeRouter
+    :param iterations: int
+    :param size: int
+    :return: dict
+    """
+    samples = []
+    failures = 0
+    for i in range(iterations):
+        salvo = [('%03d' % (dist + 1), '%03d' % ((dist + i) % 999 + 1)) for dist in range(size)]
+        start = time.perf_counter()
+        results = cr.set_crosspoints(salvo)
+        samples.append(time.perf_counter() - start)
+        failures += sum(not status for dist, status in results)
+    result = percentiles(samples)
+    result['size'] = size
+    result['failures'] = failures
+    result['crosspoints_per_second'] = size * len(samples) / sum(samples) if samples else 0
+    return result
+
+
+def bench_gpio(cr, iterations):
+    """
+    GPIOのイベントから、制御命令のACKを受け取るまでの時間を計測する。
+    イベント毎に状態が変わるように、nSubとtSubの接点を交互に入れる。イベントはまとめずに全て制御する。
+
+    :param cr: change_router.ChangeRouter
+    :param iterations: int
+    :return: dict
+    """
+    cr.set_event_detect('128', window=0)
+    samples = []
+    for i in range(iterations):
+        pin = (change_router.gpio_nsub, change_router.gpio_tsub)[i % 2]
+        start = time.perf_counter()
+        GPIO.event_detect(pin)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def bench_flap(cr, iterations):
+    """
+    接点がばたついた場合に、GPIOのイベントがいくつの制御にまとめられるかを計測する。
+
+    :param cr: change_router.ChangeRouter
+    :param iterations: int
+    :return: dict
+    """
+    cr.set_event_detect('128')
+    start = time.perf_counter()
+    for i in range(iterations):
+        GPIO.event_detect((change_router.gpio_nsub, change_router.gpio_tsub)[i % 2])
+    cr.coalescer.flush()
+    return {
+        'events': cr.coalescer.events,
+        'dispatched': cr.coalescer.dispatched,
+        'absorbed': cr.coalescer.absorbed,
+        'elapsed': (time.perf_counter() - start) * 1000,
+    }
+
+
+def measure_import(module='change_router'):
+    """
+    新しいPythonのプロセスでmoduleのimportにかかる時間(ms)を計測する。
+
+    :param module: str
+    :return: float
+    """
+    code = 'import time; start = time.perf_counter(); import %s; print(time.perf_counter() - start)' % module
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output.decode().split()[-1]) * 1000
+
+
+def scratch_status_path(prefix='benchmark_'):
+    """
+    計測で使う前回の状態のファイルを、本番のファイルとは別に空の状態で用意して返す。
+
+    :param prefix: str
+    :return: str
+    """
+    path_name = os.path.join(tempfile.gettempdir(), prefix + change_router.temp_GPIO_filename)
+    if os.path.exists(path_name):
+        os.remove(path_name)
+    return path_name
+
+
+def measure_startup(port):
+    """
+    ChangeRouterを作り、GPIOの設定とシリアルポートを開くまでの時間(ms)を計測する。
+
+    :param port: str
+    :return: float
+    """
+    start = time.perf_counter()
+    cr = change_router.ChangeRouter(log_level=router_log.ERROR, port=port,
+                                    status_path=scratch_status_path()).open()
+    elapsed = (time.perf_counter() - start) * 1000
+    cr.close()
+    return elapsed
+
+
+def check_budget(results, import_budget, startup_budget):
+    """
+    importと起動の時間が予算(ms)に収まっているかを確認し、結果の辞書を返す。
+
+    :param results: dict
+    :param import_budget: float
+    :param startup_budget: float
+    :return: dict
+    """
+    return {
+        'import_budget': import_budget,
+        'startup_budget': startup_budget,
+        'ok': results['import'] <= import_budget and results['startup'] <= startup_budget,
+    }
+
+
+def run(iterations=100, salvo_size=20):
+    """
+    全ての計測を行い、結果の辞書を返す。
+
+    :param iterations: int
+    :param salvo_size: int
+    :return: dict
+    """
+    results = {'import': measure_import()}
+    with loopback.SerialPair() as pair, loopback.TcpSink() as sink:
+        results['startup'] = measure_startup(pair.port_a)
+        ser = start_bridge(pair.port_b, sink)
+        cr = change_router.ChangeRouter(log_level=router_log.ERROR, port=pair.port_a,
+                                        status_path=scratch_status_path()).open()
+        try:
+            results['set_crosspoint'] = bench_set(cr, iterations)
+            results['get_crosspoint'] = bench_get(cr, iterations)
+            results['set_crosspoints'] = bench_salvo(cr, max(1, iterations // 10), salvo_size)
+            results['gpio_edge_to_ack'] = bench_gpio(cr, iterations)
+            results['tally_flap'] = bench_flap(cr, iterations)
+        finally:
+            cr.close()
+            ser.stop()
+            ser.com.close()
+        results['tcp_bytes_received'] = sink.received
+    return results
+
+
+def main(argv=None):
+    """
+    コマンドラインの引数に従って計測し、結果をJSONで出力する。
+    importか起動の時間が予算を超えた場合は1を返す。
+
+    :param argv: list of str
+    :return: int
+    """
+    parser = argparse.ArgumentParser(description='素材分配ルータ制御の遅延を計測する')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--salvo-size', type=int, default=20)
+    parser.add_argument('--output', help='出力ファイル 省略時は標準出力')
+    parser.add_argument('--import-budget', type=float, default=200, help='change_routerのimport時間の予算 (ms)')
+    parser.add_argument('--startup-budget', type=float, default=100, help='ChangeRouterを開く時間の予算 (ms)')
+    args = parser.parse_args(argv)
+
+    # 計測中のダミーの表示は捨てる
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = run(args.iterations, args.salvo_size)
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': args.iterations,
+        'results': results,
+        'budget': check_budget(results, args.import_budget, args.startup_budget),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+    return 0 if report['budget']['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
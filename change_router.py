@@ -8,10 +8,18 @@ raspberry pi上にて、池上の素材分配ルータをOATally接点によっ
 import serial
 import time
 import RPi.GPIO as GPIO
-import platform
+import sys
 import os
 import tempfile
 import datetime
+import functools
+import heapq
+import itertools
+import threading
+from concurrent.futures import CancelledError, Future
+from array import array
+import router_log
+import router_metrics
 
 timeout = 5  # タイムアウト値（s）
 interval = 0.1  # 待ち時間 (s)
@@ -24,44 +32,492 @@ gpio_nsub = 3
 
 select_sw = {gpio_nsub: nSub_ch, gpio_tsub: tSub_ch}
 
-GPIO.setmode(GPIO.BCM)  # BCMの番号で指定する
-GPIO.setup(gpio_tsub, GPIO.IN)
-GPIO.setup(gpio_nsub, GPIO.IN)
+gpio_ready = False  # GPIOを設定済みかどうか
 
 comport = '/dev/ttyUSB0'
 # Windows上はCOM12、raspberry piでは/dev/ttyUSB0、Jenkins上では/dev/tnt0
-if platform.uname()[0] == 'Windows':
+if sys.platform == 'win32':
     comport = 'COM12'  # COM12
-    print(comport)
 
 router_dict = {0x02: 'STX',  0x03: 'ETX', 0x17: 'ETB',
                0x06: 'ACK', 0x15: 'NAK', 0x04: 'EOT'}
 router_r_dict = {v: k for k, v in list(router_dict.items())}
 
+# 命令の優先度 小さいほど先に実行する
+PRIORITY_TALLY = 0  # OA Tallyによる切り替え
+PRIORITY_OPERATOR = 1  # 操作による切り替え・問い合わせ
+PRIORITY_BULK = 2  # 一括の問い合わせ・定期的な状態の確認
+priority_names = {PRIORITY_TALLY: 'tally', PRIORITY_OPERATOR: 'operator', PRIORITY_BULK: 'bulk'}
+
 temp_GPIO_filename = 'GPIO_status.txt'
 
 debug_filename = "change_router.log"
 
 
+def setup_gpio():
+    """
+    Tallyの接点のGPIOを入力に設定する。import時ではなく、最初にChangeRouterを開いた時に1度だけ行う。
+    GPIO.cleanup()で番号の指定とピンの設定が消えた後は、もう1度設定する。
+
+    :return:
+    """
+    global gpio_ready
+    if gpio_ready and GPIO.getmode() is not None:
+        return
+    GPIO.setmode(GPIO.BCM)  # BCMの番号で指定する
+    GPIO.setup(gpio_tsub, GPIO.IN)
+    GPIO.setup(gpio_nsub, GPIO.IN)
+    gpio_ready = True
+
+
+class StatusStore:
+    """
+    最後に制御したソースchをメモリ上に持つクラス。
+    テンポラリファイルへの保存は別スレッドで一時ファイルに書いてから置き換え、ファイルは再起動時の復元にのみ使う。
+    """
+
+    def __init__(self, path_name, log=None):
+        """
+        コンストラクタ。保存されている状態があれば読み込む。
+        保存に失敗した場合は、errorsに数えてlog(メッセージ, レベル)に渡す。
+
+        :param path_name: str
+        :param log: function
+        """
+        self.path_name = path_name
+        self.log = log
+        self.errors = 0
+        self.lock = threading.Lock()  # 状態の比較と更新を一度に行う為のロック
+        self.condition = threading.Condition()
+        self.pending = None  # 保存待ちの状態
+        self.writer = None
+        self.value = self.load()
+
+    def load(self):
+        """
+        保存されている状態を読み込んで返す。無ければ空文字を返す。
+
+        :return: str
+        """
+        if os.path.isfile(self.path_name):
+            with open(self.path_name, 'r') as f:
+                return f.read()
+        return ''
+
+    def restore(self):
+        """
+        保存されている状態をメモリ上の状態に戻す。
+
+        :return: str
+        """
+        self.flush()
+        with self.lock:
+            self.value = self.load()
+        return self.value
+
+    def update(self, value):
+        """
+        状態がvalueから変化していれば更新して保存を依頼し、Trueを返す。
+
+        :param value: str
+        :return: bool
+        """
+        with self.lock:
+            if value == self.value:
+                return False
+            self.value = value
+
+            # 同時に更新された場合に古い状態が保存されないよう、比較と同じロックの中で保存を依頼する
+            with self.condition:
+                self.pending = value
+                if self.writer is None:
+                    self.writer = threading.Thread(target=self.write_run)
+                    self.writer.start()
+        return True
+
+    def write_run(self):
+        """
+        保存待ちの状態をファイルに書き込むスレッドの本体。保存待ちが無くなれば終了する。
+        書き込みに失敗しても終了せず、次の保存待ちを書き込む。
+
+        :return:
+        """
+        try:
+            while True:
+                with self.condition:
+                    value = self.pending
+                    if value is None:
+                        return
+                    self.pending = None
+                try:
+                    self.write(value)
+                except OSError as e:
+                    self.errors += 1
+                    if self.log is not None:
+                        self.log('status write error!! %s : %s\n' % (self.path_name, e), router_log.ERROR)
+        finally:
+            # 例外で終わった場合も、flush()を待たせず、次の更新で新しいスレッドを開始できるようにする
+            with self.condition:
+                if self.writer is threading.current_thread():
+                    self.writer = None
+                self.condition.notify_all()
+
+    def write(self, value):
+        """
+        一時ファイルに書き込んでから置き換え、書き込み途中のファイルが残らないようにする。
+
+        :param value: str
+        :return:
+        """
+        temp_name = self.path_name + '.tmp'
+        with open(temp_name, 'w') as f:
+            f.write(value)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, self.path_name)
+
+    def flush(self, timeout=None):
+        """
+        保存待ちの状態が書き込まれるまで待つ。
+
+        :param timeout: float
+        :return: bool
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.writer is None, timeout)
+
+
+class TallyCoalescer:
+    """
+    GPIOのイベントから制御までの間で、ディスティネーションch毎にwindow秒の間の要求をまとめるクラス。
+    窓の最初の要求はすぐに制御するので遅れは増えない。窓の間に来た要求は最新のソースchだけを残し、
+    窓の終わりに、それが最後に制御したソースchと違う場合だけ制御する。
+    制御せずにまとめた要求の数をabsorbedに数える。
+    """
+
+    def __init__(self, dispatch, window=0.02, log=None, counter=None):
+        """
+        コンストラクタ。dispatchは(ディスティネーションch, ソースch)で制御する関数。
+        窓の終わりの制御で例外が起きた場合は、errorsに数えてlog(メッセージ, レベル)に渡す。
+        counter(router_metrics.Counter)を指定した場合は、まとめた要求をそれにも数える。
+
+        :param dispatch: function
+        :param window: float
+        :param log: function
+        :param counter: router_metrics.Counter
+        """
+        self.dispatch = dispatch
+        self.window = window
+        self.log = log
+        self.counter = counter
+        self.errors = 0
+        self.condition = threading.Condition()
+        self.windows = {}  # ディスティネーションch毎の[窓の終わりの時刻, 待っているソースch]
+        self.last = {}  # ディスティネーションch毎の最後に制御したソースch
+        self.worker = None
+        self.events = 0
+        self.absorbed = 0
+        self.dispatched = 0
+
+    def submit(self, dist, source):
+        """
+        制御の要求を受け付ける。窓が開いていなければすぐに制御してTrueを、
+        窓の終わりまで待たせた場合はFalseを返す。
+
+        :param dist: str
+        :param source: str
+        :return: bool
+        """
+        with self.condition:
+            self.events += 1
+            now = time.monotonic()
+            entry = self.windows.get(dist)
+            if entry is not None and now < entry[0]:
+                if entry[1] is not None:
+                    self.absorb()  # 待っていた要求は新しい要求に置き換える
+                entry[1] = source
+                if self.worker is None:
+                    self.worker = threading.Thread(target=self.run, daemon=True)
+                    self.worker.start()
+                self.condition.notify_all()
+                return False
+            if entry is not None and entry[1] is not None:
+                self.absorb()  # 窓の終わりの処理を待っていた要求は新しい要求に置き換える
+            self.windows[dist] = [now + self.window, None]
+            self.last[dist] = source
+            self.dispatched += 1
+        self.dispatch(dist, source)
+        return True
+
+    def absorb(self):
+        """
+        制御せずにまとめた要求を数える。
+
+        :return:
+        """
+        self.absorbed += 1
+        if self.counter is not None:
+            self.counter.inc()
+
+    def take_due(self, now):
+        """
+        窓の終わった要求を取り出し、制御が必要な(ディスティネーションch, ソースch)のリストを返す。
+        制御する場合は新しい窓を開く。
+
+        :param now: float
+        :return: list of (str, str)
+        """
+        due = []
+        for dist, entry in list(self.windows.items()):
+            if now < entry[0]:
+                continue
+            if entry[1] is None:
+                del self.windows[dist]
+            elif entry[1] == self.last.get(dist):
+                self.absorb()
+                del self.windows[dist]
+            else:
+                due.append((dist, entry[1]))
+                self.windows[dist] = [now + self.window, None]
+                self.last[dist] = entry[1]
+                self.dispatched += 1
+        return due
+
+    def run(self):
+        """
+        窓の終わりに待っている要求を制御するスレッドの本体。待っている要求が無くなれば終了する。
+        制御に失敗しても終了せず、次の要求を処理する。
+
+        :return:
+        """
+        try:
+            while True:
+                with self.condition:
+                    due = self.take_due(time.monotonic())
+                    if not due:
+                        deadlines = [entry[0] for entry in self.windows.values() if entry[1] is not None]
+                        if not deadlines:
+                            return
+                        self.condition.wait(max(0, min(deadlines) - time.monotonic()))
+                        continue
+                for dist, source in due:
+                    try:
+                        self.dispatch(dist, source)
+                    except Exception as e:
+                        self.errors += 1
+                        if self.log is not None:
+                            self.log('tally dispatch error!! %s %s : %s\n' % (dist, source, e), router_log.ERROR)
+        finally:
+            # 例外で終わった場合も、次の要求で新しいスレッドを開始できるようにする
+            with self.condition:
+                if self.worker is threading.current_thread():
+                    self.worker = None
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        待っている要求が全て処理されるまで待つ。
+
+        :param timeout: float
+        :return: bool
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.worker is None, timeout)
+
+
+class CommandScheduler:
+    """
+    1つのシリアルポートへの命令を優先度順に1つずつ実行するクラス。
+    待っている命令はTally、操作、一括の順に実行するので、問い合わせが溜まっていても切り替えを待たせない。
+    low_priority以下の優先度の命令は、1秒にlow_rate回までに抑える。
+    優先度毎に、受け付けてから実行し終わるまでの時間をヒストグラムに記録する。
+    """
+
+    def __init__(self, low_rate=10, low_priority=PRIORITY_BULK, registry=None):
+        """
+        コンストラクタ。命令を実行するスレッドを開始する。
+
+        :param low_rate: float
+        :param low_priority: int
+        :param registry: router_metrics.Registry
+        """
+        self.low_interval = 1.0 / low_rate if low_rate else 0
+        self.low_priority = low_priority
+        self.next_low = 0  # 次に優先度の低い命令を実行してよい時刻(time.monotonic())
+        self.queue = []  # (優先度, 受付順, 受付時刻, Future, 関数, 引数)のヒープ
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+
+        registry = registry or router_metrics.default_registry
+        self.latency = {priority: registry.histogram(
+            'router_%s_command_seconds' % name, 'Time from queueing a %s command to its completion.' % name)
+            for priority, name in priority_names.items()}
+        self.max_latency = dict.fromkeys(priority_names, 0.0)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def submit(self, priority, func, *args, **kwargs):
+        """
+        命令(funcの呼び出し)を優先度priorityで受け付け、結果のFutureを返す。
+
+        :param priority: int
+        :param func: function
+        :return: Future
+        """
+        future = Future()
+        with self.condition:
+            if not self.running:
+                raise RuntimeError('scheduler is closed')
+            heapq.heappush(self.queue, (priority, next(self.sequence), time.monotonic(),
+                                        future, func, args, kwargs))
+            self.condition.notify()
+        return future
+
+    def take(self):
+        """
+        次に実行する命令を取り出す。優先度の低い命令しか無く、実行してよい時刻になっていなければ、
+        その時刻か新しい命令が来るまで待つ。終了した場合はNoneを返す。
+
+        :return: tuple
+        """
+        with self.condition:
+            while self.running:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                if self.queue[0][0] >= self.low_priority:
+                    remaining = self.next_low - time.monotonic()
+                    if remaining > 0:
+                        self.condition.wait(remaining)
+                        continue
+                    self.next_low = time.monotonic() + self.low_interval
+                return heapq.heappop(self.queue)
+            return None
+
+    def run(self):
+        """
+        命令を実行するスレッドの本体。
+
+        :return:
+        """
+        while True:
+            command = self.take()
+            if command is None:
+                return
+            priority, sequence, queued, future, func, args, kwargs = command
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            elapsed = time.monotonic() - queued
+            if priority in self.latency:
+                self.latency[priority].observe(elapsed)
+                self.max_latency[priority] = max(self.max_latency[priority], elapsed)
+
+    def stats(self):
+        """
+        優先度毎の実行した命令の数と、受け付けてから実行し終わるまでの平均・最大の時間(s)を返す。
+
+        :return: dict
+        """
+        return {name: {'count': self.latency[priority].count,
+                       'mean': self.latency[priority].sum / self.latency[priority].count
+                       if self.latency[priority].count else 0.0,
+                       'max': self.max_latency[priority]}
+                for priority, name in priority_names.items()}
+
+    def close(self):
+        """
+        待っている命令を取り消し、実行中の命令が終わるのを待ってスレッドを終了する。
+
+        :return:
+        """
+        with self.condition:
+            self.running = False
+            for command in self.queue:
+                command[3].cancel()
+            self.queue = []
+            self.condition.notify_all()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+
 class ChangeRouter:
     """GPIOの接点信号により素材分配ルータを制御するクラス"""
     # TODO 問題が起こった時にメール通知する機能の追加。
 
-    def __init__(self, log="off"):
+    def __init__(self, log="off", log_level=router_log.INFO, log_background=True, port=None,
+                 registry=None, status_path=None):
         """
         引数無しコンストラクタ。
-        シリアルの初期化。
+        シリアルポートは開かないので、open()を呼ぶかwith文で使う。
+        ログはlog_level以上のものを書き込み、log_backgroundがFalseの場合は書き込みを待つ。
+        処理時間や応答の回数はregistry(省略時はrouter_metrics.default_registry)に記録する。
+        前回の状態はstatus_path(省略時はテンポラリフォルダのtemp_GPIO_filename)に保存する。
+        試験の道具からは、本番の状態を上書きしないよう別のファイルを指定する。
 
         """
 
+        self.log_level = log_level
+        self.log_background = log_background
+        self.log_writer = None
         if log != "off":
             self.set_log(log)
         else:
             self.log = log
 
+        # ディスティネーションch毎の(ソースch, 記録した時刻)
+        self.crosspoints = {}
+        self.crosspoint_max_age = None  # 記録を信用する秒数 Noneは無制限
+        self.lock = threading.RLock()  # シリアルの送受信を1つずつ行う為のロック
+        self.reconcile_event = threading.Event()
+        self.reconcile_thread = None
+        self.tally_window = 0.02  # GPIOのイベントをまとめる秒数
+        self.bouncetime = 300  # GPIOのエッジのチャタリングとして捨てる時間 (ms)
+        self.coalescer = None
+        self.scheduler = None
+
+        # 前回の状態はメモリ上に持ち、テンポラリファイルは再起動時の復元に使う
+        self.status = StatusStore(status_path or os.path.join(tempfile.gettempdir(), temp_GPIO_filename),
+                                  self.write_log)
+
+        registry = registry or router_metrics.default_registry
+        self.set_seconds = registry.histogram(
+            'router_set_crosspoint_seconds', 'Time from sending a crosspoint set frame to its reply.')
+        self.get_seconds = registry.histogram(
+            'router_get_crosspoint_seconds', 'Time from sending a status query to the status frame.')
+        self.replies = registry.counter(
+            'router_replies_total', 'Replies from the router by control code.', 'reply')
+        self.status_errors = registry.counter(
+            'router_status_errors_total', 'Status frames with a bad BBC or layout.')
+        self.gpio_events = registry.counter(
+            'router_gpio_events_total', 'GPIO tally events by pin.', 'pin')
+        self.tally_absorbed = registry.counter(
+            'router_tally_absorbed_total', 'Tally changes merged without switching.')
+
+        self.port = port
+        self.com = None  # シリアルポートはopen()で開く
+
+    def open(self):
+        """
+        GPIOを設定し、シリアルポートを開く。portを省略した場合はcomport、開けなければ/dev/tnt0を使う。
+        既に開いている場合は何もしない。
+
+        :return: ChangeRouter
+        """
+        if self.com is not None:
+            return self
+        setup_gpio()
         try:
             self.com = serial.Serial(
-              port=comport,
+              port=self.port or comport,
               baudrate=9600,
               bytesize=8,
               parity='N',
@@ -71,6 +527,8 @@ class ChangeRouter:
               )
 
         except serial.SerialException:
+            if self.port is not None:
+                raise
             self.com = serial.Serial(
                 port='/dev/tnt0',
                 baudrate=9600,
@@ -79,6 +537,31 @@ class ChangeRouter:
                 stopbits=1,
                 timeout=5,
                 writeTimeout=5)
+        return self
+
+    def close(self):
+        """
+        スケジューラと状態を合わせるスレッドを止め、シリアルポートを閉じる。
+        保存待ちの状態は書き込み、ログは書き込んでから書き込みスレッドを終了する。
+        以降のログは直接ファイルに書き込む。
+
+        :return:
+        """
+        self.stop_reconcile()
+        self.stop_scheduler()
+        if self.com is not None:
+            self.com.close()
+            self.com = None
+        self.status.flush()
+        if self.log_writer is not None:
+            self.log_writer.close()
+            self.log_writer = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def set_log(self, log_name):
         """
@@ -88,20 +571,48 @@ class ChangeRouter:
         :return:
         """
         self.log = os.path.join(tempfile.gettempdir(), log_name)
+        if self.log_writer is not None:
+            self.log_writer.close()
+            self.log_writer = None
+        if self.log_background:
+            self.log_writer = router_log.LogWriter(self.log)
 
-    def write_log(self, message):
+    def log_enabled(self, level):
+        """
+        levelのログを書き込むかどうかを返す。
+
+        :param level: int
+        :return: bool
+        """
+        return level >= self.log_level
+
+    def write_log(self, message, level=router_log.INFO):
         """
         logにメッセージを書き込む
 
         :param message:
+        :param level: int
         :return:
         """
+        if level < self.log_level:
+            return
 
-        if self.log != "off":
+        if self.log == "off":
+            print(message)
+        elif self.log_writer is not None:
+            self.log_writer.write(str(message))
+        else:
             with open(self.log, 'a') as f:
                 f.write(str(message))
-        else:
-            print(message)
+
+    def flush_log(self):
+        """
+        バックグラウンドで書き込み待ちのログを書き込む。
+
+        :return:
+        """
+        if self.log_writer is not None:
+            self.log_writer.flush()
 
     @staticmethod
     def get_sub_state():
@@ -176,6 +687,54 @@ class ChangeRouter:
         except KeyError:
             return "'%s'" % character
 
+    @staticmethod
+    def build_frame(text_message):
+        """
+        BBC演算対象の文字列から、STX～ETX+BBCまでの完全な電文をbytesで返す。
+
+        :param text_message: str
+        :return: bytes
+        """
+        data = text_message.encode('ascii')
+        result = 0
+        for d in data:
+            result ^= d
+        return bytes((router_r_dict['STX'],)) + data + bytes((result,))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def get_information_frame(dist):
+        """
+        ディスティネーションchの情報を取得する送信電文をbytesで返す。同じchの電文は再利用する。
+
+        :param dist: str
+        :return: bytes
+        """
+        return ChangeRouter.build_frame(ChangeRouter.get_information(dist))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def get_crosspoint_set_frame(dist, source):
+        """
+        ディスティネーションch,ソースchの制御電文をbytesで返す。同じ組み合わせの電文は再利用する。
+
+        :param dist: str
+        :param source: str
+        :return: bytes
+        """
+        return ChangeRouter.build_frame(ChangeRouter.get_crosspoint_set(dist, source))
+
+    def send_frame(self, frame):
+        """
+        電文を1回の書き込みで送信し、ログにも1エントリとして記録する。
+
+        :param frame: bytes
+        :return:
+        """
+        if self.log_enabled(router_log.DEBUG):
+            self.write_log(''.join('>' + self.router_chr(chr(x)) for x in frame), router_log.DEBUG)
+        self.com.write(frame)
+
     def serial_wait(self):
         """ シリアルデバイスの応答待ち
         """
@@ -207,6 +766,128 @@ class ChangeRouter:
             + text_message \
             + self.bbc(text_message)
 
+    def read_bytes(self, size, deadline):
+        """
+        deadline(time.monotonic()の値)までを上限に、最大size文字をブロッキングで受信する。
+        揃った時点ですぐに返り、タイムアウトした場合はそれまでに受信した分を返す。
+
+        :param size: int
+        :param deadline: float
+        :return: bytes
+        """
+        data = b''
+        while len(data) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.com.timeout = remaining  # 受信待ちはカーネル側でブロックさせる
+            data += self.com.read(size - len(data))
+        return data
+
+    def read_reply(self, deadline):
+        """
+        ACK/NAKなどの1文字の応答をdeadlineまで待って受信し、制御コード名を返す。
+        タイムアウトした場合はNoneを返す。
+
+        :param deadline: float
+        :return: str
+        """
+        receipt_data = self.read_bytes(1, deadline)
+        if not receipt_data:
+            self.replies.inc('timeout')
+            self.write_log("<timeout\n", router_log.WARNING)
+            return None
+        reply = self.router_chr(chr(receipt_data[0]))
+        self.replies.inc(reply)
+        self.write_log("<" + reply + "\n", router_log.DEBUG)
+        return reply
+
+    def read_frame(self, deadline):
+        """
+        STXから始まりETX+BBCで終わる応答電文をdeadlineまで待って受信し、STXを除いた文字列を返す。
+        STXより前に受信したデータは読み捨てる。タイムアウトした場合はNoneを返す。
+
+        :param deadline: float
+        :return: str
+        """
+        while True:
+            receipt_data = self.read_bytes(1, deadline)
+            if not receipt_data:
+                return None
+            if receipt_data[0] == router_r_dict['STX']:
+                self.write_log("<STX\n", router_log.DEBUG)
+                break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        self.com.timeout = remaining
+        frame = self.com.read_until(bytes((router_r_dict['ETX'],)))
+        if not frame.endswith(bytes((router_r_dict['ETX'],))):
+            return None
+
+        receipt_data = self.read_bytes(1, deadline)  # BBC
+        if not receipt_data:
+            return None
+        # bytes型のままではbbc演算や文字列比較ができないため文字列に変換
+        return (frame + receipt_data).decode('latin-1')
+
+    @staticmethod
+    def parse_status(receipt_data):
+        """
+        STXを除いた状態応答電文のBBCと内容を確認し、(ディスティネーションch, ソースch)のタプルを返す。
+        異常な電文の場合はNoneを返す。
+
+        :param receipt_data: str
+        :return: (str, str)
+        """
+        if len(receipt_data) != 15 \
+                or ChangeRouter.bbc(receipt_data[:-1]) != receipt_data[-1]:
+            return None
+
+        expect = ("1010000%s%s" % (receipt_data[7:10], receipt_data[10:13])) \
+            + chr(router_r_dict['ETX'])
+        if expect != receipt_data[:14]:
+            return None
+        return receipt_data[7:10], receipt_data[10:13]
+
+    def query_crosspoint(self, dist):
+        """
+        シリアルデバイスにディスティネーションchから情報を取得する電文を送信し、
+        応答の(ディスティネーションch, ソースch)のタプルを返す。失敗した場合はNoneを返す。
+        応答の内容はクロスポイントの状態として記録する。
+
+        :param dist: str
+        :return: (str, str)
+        """
+        with self.lock:
+            start = time.monotonic()
+            deadline = start + timeout
+
+            self.send_frame(self.get_information_frame(dist))
+
+            # 応答受信処理
+            if self.read_reply(deadline) != 'ACK':
+                return None
+
+            receipt_data = self.read_frame(deadline)
+            if receipt_data is None:
+                return None
+            self.get_seconds.observe(time.monotonic() - start)
+
+        channels = self.parse_status(receipt_data)
+        if channels is None:
+            self.status_errors.inc()
+            self.write_log('status data is ng!\n', router_log.ERROR)
+            return None
+
+        self.record_crosspoint(*channels)
+        self.write_log("output channel is %s, input channel is %s" % channels)
+        self.write_log("<" + receipt_data[:13], router_log.DEBUG)
+        self.write_log("<" + self.router_chr(receipt_data[13:14]), router_log.DEBUG)
+        self.write_log("<" + self.router_chr(receipt_data[14:15]), router_log.DEBUG)
+        return channels
+
     def get_crosspoint(self, dist):
         """
         シリアルデバイスにディスティネーションchから情報を取得する電文を送信し、得た情報を標準出力に表示、
@@ -215,92 +896,271 @@ class ChangeRouter:
         :param dist: str
         :return: bool
         """
+        return self.query_crosspoint(dist) is not None
 
-        status = False  # 成功したかのフラグ 初期値は失敗 　
-        next_time = time.time()+timeout
-
-        for x in self.get_full_information(dist):
-            self.write_log(">" + self.router_chr(x))
-            self.com.write(x)
+    def record_crosspoint(self, dist, source):
+        """
+        ディスティネーションchが今ソースchを出力していることを記録する。sourceがNoneの場合は記録を消す。
 
-        self.serial_wait()
+        :param dist: str
+        :param source: str
+        :return:
+        """
+        if source is None:
+            self.crosspoints.pop(dist, None)
+        else:
+            self.crosspoints[dist] = (source, time.monotonic())
 
-        # 応答受信処理
-        while time.time() < next_time:
-            if self.com.in_waiting > 0:
-                # 受信データはbytes 型
-                receipt_data = self.com.read(1)
-                if self.router_chr(receipt_data) == 'ACK':
-                    self.write_log("<" + self.router_chr(receipt_data) + "\n")
-                    break
-                else:
-                    return status
-
-        self.serial_wait()
-
-        while time.time() < next_time:
-            if self.com.in_waiting > 0:
-                # 受信データはbytes 型
-                receipt_data = self.com.read(1)
-                if self.router_chr(receipt_data) == 'STX':
-                    self.write_log("<" + self.router_chr(receipt_data) + "\n")
-                else:
-                    break
+    def cached_source(self, dist, max_age=None):
+        """
+        記録しているディスティネーションchのソースchを返す。
+        記録が無いか、max_age秒(Noneの場合はcrosspoint_max_age)より古い場合はNoneを返す。
 
-            d_len = self.com.inWaiting()  # 受信バッファにたまってる数を確認
-            if d_len > 0:
-                receipt_data = self.com.read(d_len)
-                if self.bbc(receipt_data[:-1]) == receipt_data[-1]:
-                    self.write_log('bbc checksum is ok!\n')
-                    expect = ("1010000%s%s" % (receipt_data[7:10],
-                                               receipt_data[10:13])) \
-                        + chr(router_r_dict['ETX'])
-                    if expect == receipt_data[:14]:
-                        self.write_log('data is correct\n')
-                    else:
-                        break
+        :param dist: str
+        :param max_age: float
+        :return: str
+        """
+        if max_age is None:
+            max_age = self.crosspoint_max_age
+        try:
+            source, updated = self.crosspoints[dist]
+        except KeyError:
+            return None
+        if max_age is not None and time.monotonic() - updated > max_age:
+            return None
+        return source
 
-                    self.write_log("output channel is %s, input channel is %s"
-                                   % (receipt_data[7:10], receipt_data[10:13]))
-                self.write_log("<" + receipt_data[:13])
-                self.write_log("<" + self.router_chr(receipt_data[13:14]))
-                self.write_log("<" + self.router_chr(receipt_data[14:15]))
-                status = True
-                break
-        return status
+    def get_source(self, dist, max_age=None):
+        """
+        ディスティネーションchのソースchを返す。記録が新しければ問い合わせず、古ければ問い合わせる。
+        分からなかった場合はNoneを返す。
 
-    def set_crosspoint(self, dist, source):
+        :param dist: str
+        :param max_age: float
+        :return: str
+        """
+        source = self.cached_source(dist, max_age)
+        if source is None:
+            channels = self.query_crosspoint(dist)
+            if channels is not None:
+                source = channels[1]  # 問い合わせの往復がmax_ageより長くても、今の応答を返す
+        return source
+
+    def set_crosspoint(self, dist, source, skip_unchanged=False):
         """
         シリアルデバイスにディスティネーションch,ソースchから制御する電文を送信し、
         成功失敗の結果を返す。
+        skip_unchangedがTrueで、既にそのソースchを出力していると記録されている場合は送信せずに成功とする。
 
         :param dist: str
         :param source: str
+        :param skip_unchanged: bool
         :return: bool
         """
+        if skip_unchanged and self.cached_source(dist) == source:
+            self.write_log("crosspoint is not changed %s\n" % dist)
+            return True
+
         status = False  # 成功したかのフラグ 初期値は失敗 　
 
-        for x in self.get_full_crosspoint_set(dist, source):
-            self.write_log(">" + self.router_chr(x))
-            self.com.write(x.encode())
-        self.serial_wait()
-
-        next_time = time.time()+timeout
-        # 応答受信処理
-        while time.time() < next_time:
-            if self.com.in_waiting > 0:
-                # 受信データはbytes 型
-                receipt_data = self.com.read(1)
-                if self.router_chr(receipt_data) == 'ACK':
-                    self.write_log("<" + self.router_chr(receipt_data) + "\n")
-                    status = True
-                    break
-                else:
-                    self.write_log("crosspoint set error!!\n")
-                    break
+        with self.lock:
+            start = time.monotonic()
+            deadline = start + timeout
+
+            self.send_frame(self.get_crosspoint_set_frame(dist, source))
+
+            # 応答受信処理
+            reply = self.read_reply(deadline)
+            if reply is not None:
+                self.set_seconds.observe(time.monotonic() - start)
+
+        if reply == 'ACK':
+            self.record_crosspoint(dist, source)
+            status = True
+        else:
+            if reply is None:
+                self.record_crosspoint(dist, None)  # 切り替わったか分からない
+            self.write_log("crosspoint set error!!\n", router_log.ERROR)
 
         return status
 
+    def set_crosspoints(self, crosspoints, skip_unchanged=False):
+        """
+        複数のディスティネーションch,ソースchの制御電文を続けて送信し(サルボ)、
+        送信順に返ってくるACK/NAKを対応付けて、crosspointsと同じ順番で成功失敗のリストを返す。
+        応答が1つでもタイムアウトした場合は、どの応答がどの電文のものか分からないので、送信した全てを失敗とする。
+        skip_unchangedがTrueの場合、既にそのソースchを出力しているディスティネーションは送信せずに成功とする。
+
+        :param crosspoints: list of (str, str)
+        :param skip_unchanged: bool
+        :return: list of (str, bool)
+        """
+        # 同じディスティネーションが複数あっても電文と対応するよう、結果は順番で持つ
+        results = [None] * len(crosspoints)
+        sends = []  # (順番, ディスティネーションch, ソースch)
+        for i, (dist, source) in enumerate(crosspoints):
+            if skip_unchanged and self.cached_source(dist) == source:
+                results[i] = True
+            else:
+                sends.append((i, dist, source))
+
+        if sends:
+            with self.lock:
+                self.send_frame(b''.join(self.get_crosspoint_set_frame(dist, source)
+                                         for i, dist, source in sends))
+
+                # 応答受信処理 応答毎にタイムアウトを計る
+                replies = []
+                for send in sends:
+                    reply = self.read_reply(time.monotonic() + timeout)
+                    if reply is None:
+                        break
+                    replies.append(reply)
+
+            if len(replies) < len(sends):
+                # 途中の応答が失われると、以降の応答がどの電文のものか分からないので、サルボ全体を不明とする
+                for i, dist, source in sends:
+                    self.record_crosspoint(dist, None)  # 切り替わったか分からない
+                    results[i] = False
+                self.write_log("crosspoint set timeout!! %d/%d replies\n" % (len(replies), len(sends)),
+                               router_log.ERROR)
+            else:
+                for (i, dist, source), reply in zip(sends, replies):
+                    if reply == 'ACK':
+                        self.record_crosspoint(dist, source)
+                    else:
+                        self.write_log("crosspoint set error!! %s\n" % dist, router_log.ERROR)
+                    results[i] = reply == 'ACK'
+
+        return [(dist, status) for (dist, source), status in zip(crosspoints, results)]
+
+    def dump_crosspoints(self, dest_range, window=16):
+        """
+        dest_rangeの全てのディスティネーションchの状態を、応答を待たずに続けて問い合わせ(最大window個)、
+        ディスティネーション番号を添字、ソース番号を値とする配列で返す。分からなかったものは-1とする。
+
+        :param dest_range: iterable of int
+        :param window: int
+        :return: array
+        """
+        dests = list(dest_range)
+        sources = array('h', [-1]) * (max(dests, default=-1) + 1)
+
+        with self.lock:
+            sent = 0
+            for received in range(len(dests)):
+                # 応答待ちがwindow個になるまで問い合わせを送る
+                if sent < len(dests) and sent - received < window:
+                    count = min(len(dests) - sent, window - (sent - received))
+                    self.send_frame(b''.join(self.get_information_frame('%03d' % dest)
+                                             for dest in dests[sent:sent + count]))
+                    sent += count
+
+                deadline = time.monotonic() + timeout
+                reply = self.read_reply(deadline)
+                if reply is None:
+                    break  # 以降の応答の対応が分からなくなるので打ち切る
+                if reply != 'ACK':
+                    continue
+                receipt_data = self.read_frame(deadline)
+                if receipt_data is None:
+                    break
+
+                channels = self.parse_status(receipt_data)
+                if channels is None:
+                    self.status_errors.inc()
+                    self.write_log('status data is ng!\n', router_log.ERROR)
+                    continue
+                self.record_crosspoint(*channels)
+                dest = int(channels[0])
+                if dest < len(sources):
+                    sources[dest] = int(channels[1])
+
+        return sources
+
+    def start_scheduler(self, low_rate=10):
+        """
+        シリアルポートへの命令を優先度順に実行するスケジューラを開始する。
+        開始後はGPIOのイベントによる切り替えと定期的な状態の確認がスケジューラを通り、
+        他の処理はschedule()で優先度を指定して依頼する。
+
+        :param low_rate: float
+        :return: CommandScheduler
+        """
+        self.stop_scheduler()
+        self.scheduler = CommandScheduler(low_rate)
+        return self.scheduler
+
+    def stop_scheduler(self):
+        """
+        スケジューラを終了する。
+
+        :return:
+        """
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
+
+    def schedule(self, priority, method, *args, **kwargs):
+        """
+        スケジューラにmethod(ChangeRouterのメソッド名)を優先度priorityで依頼し、結果のFutureを返す。
+        スケジューラを開始していない場合や、stop_scheduler()で終了した直後はすぐに実行し、終わったFutureを返す。
+
+        :param priority: int
+        :param method: str
+        :return: Future
+        """
+        func = getattr(self, method)
+        scheduler = self.scheduler
+        if scheduler is not None:
+            try:
+                return scheduler.submit(priority, func, *args, **kwargs)
+            except RuntimeError:
+                pass  # 終了したスケジューラには依頼できないので、この場で実行する
+        future = Future()
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def start_reconcile(self, dists, period=60):
+        """
+        別スレッドでperiod秒毎にディスティネーションchの状態を問い合わせ、記録を実際の状態に合わせる。
+
+        :param dists: list of str
+        :param period: float
+        :return:
+        """
+        self.stop_reconcile()
+        self.reconcile_event.clear()
+
+        def reconcile():
+            while not self.reconcile_event.is_set():
+                for dist in dists:
+                    if self.reconcile_event.is_set():
+                        break
+                    try:
+                        self.schedule(PRIORITY_BULK, 'query_crosspoint', dist).result()
+                    except CancelledError:
+                        pass  # スケジューラの終了で取り消された問い合わせは次の周期に回す
+                self.reconcile_event.wait(period)
+
+        self.reconcile_thread = threading.Thread(target=reconcile, daemon=True)
+        self.reconcile_thread.start()
+
+    def stop_reconcile(self):
+        """
+        状態を合わせるスレッドを停止させる。
+
+        :return:
+        """
+        if self.reconcile_thread is not None:
+            self.reconcile_event.set()
+            self.reconcile_thread.join()
+            self.reconcile_thread = None
+
     def set_crosspoint_by_oa_tally(self, dist):
         """
         OA Tally信号の接点信号の状態(GPIOの状態)に基づいて、ソースchを決定し、
@@ -322,82 +1182,89 @@ class ChangeRouter:
 
         return state, ck_change
 
-    def gpio_status_check(self):
+    def status_check(self, now_status):
         """
-        GPIOの前回の状態が記録してあるテンポラリファイルの内容と現在の状態を比較して
-        NsubかTsubへの変化があればTrueを、なければFalseを返す。
+        前回制御したソースchと比較して、NsubかTsubへの変化があればTrueを、なければFalseを返す。
+        変化があった場合は前回の状態を更新する。
 
+        :param now_status: str
         :return: bool
         """
-        now_status = self.get_sub_state()
-        old_status = ''
+        if now_status == OA_ch:
+            return False
+        return self.status.update(now_status)
 
-        path_name = os.path.join(tempfile.gettempdir(), temp_GPIO_filename)
-        if os.path.isfile(path_name):
-            with open(path_name, 'r') as f:
-                old_status = f.read()
+    def restore_status(self):
+        """
+        テンポラリファイルに保存されている前回の状態を読み込み直す。
 
-        if now_status == old_status:
-            result = False
-        else:
-            if now_status == OA_ch:
-                result = False
-            else:
-                result = True
+        :return: str
+        """
+        return self.status.restore()
+
+    def gpio_status_check(self):
+        """
+        GPIOの前回の状態と現在の状態を比較して
+        NsubかTsubへの変化があればTrueを、なければFalseを返す。
 
-                # 変化があったので書き込み処理
-                with open(path_name, 'w') as f:
-                    f.write(now_status)
+        :return: bool
+        """
+        result = self.status_check(self.get_sub_state())
 
         self.write_log("gpio_status_check is %s\n" % result)
         return result
 
     def gpio_history_check(self, input_ch):
         """
-        GPIOの前回の状態が記録してあるテンポラリファイルの内容とイベントのピン番号のｃｈと比較して
+        GPIOの前回の状態とイベントのピン番号のｃｈと比較して
         NsubかTsubへの変化があればTrueを、なければFalseを返す。
 
         :return:
         """
-
-        now_status = input_ch
-
-        old_status = ''
-
-        path_name = os.path.join(tempfile.gettempdir(), temp_GPIO_filename)
-        if os.path.isfile(path_name):
-            with open(path_name, 'r') as f:
-                old_status = f.read()
-
-        if now_status == old_status:
-            result = False
-        else:
-            if now_status == OA_ch:
-                result = False
-            else:
-                result = True
-
-                # 変化があったので書き込み処理
-                with open(path_name, 'w') as f:
-                    f.write(now_status)
+        result = self.status_check(input_ch)
 
         self.write_log("gpio_history_check is %s\n" % result)
         return result
 
-    def set_event_detect(self, dist_ch):
+    def dispatch_tally(self, dist, source):
+        """
+        GPIOのイベントによる切り替えを行う。スケジューラがあれば最優先で依頼し、終わるのを待たない。
+        stop_scheduler()で終了した直後など、依頼できない場合はこの場で切り替える。
+
+        :param dist: str
+        :param source: str
+        :return:
+        """
+        scheduler = self.scheduler
+        if scheduler is not None:
+            try:
+                scheduler.submit(PRIORITY_TALLY, self.set_crosspoint, dist, source)
+                return
+            except RuntimeError:
+                pass
+        self.set_crosspoint(dist, source)
+
+    def set_event_detect(self, dist_ch, window=None):
         """
         GPIOイベントメッセージを受けるとset_crosspointを実行するようにセットする。
+        接点がばたついた場合に続けて切り替えないよう、window秒(省略時はtally_window)の間の変化はまとめる。
 
         :param dist_ch:
+        :param window: float
         :return: bool
         """
+        setup_gpio()
+        self.coalescer = TallyCoalescer(self.dispatch_tally,
+                                        self.tally_window if window is None else window, self.write_log,
+                                        self.tally_absorbed)
 
         # callbackメソッド
         def input_select(gpio_input):
+            self.gpio_events.inc(gpio_input)
             try:
                 select_ch = select_sw[gpio_input]
                 if self.gpio_history_check(select_ch):
-                    self.set_crosspoint(dist_ch, select_ch)
+                    self.coalescer.submit(dist_ch, select_ch)
             except KeyError:
                 return
             # 送信時の時刻を出力
@@ -405,9 +1272,9 @@ class ChangeRouter:
             self.write_log(str(gpio_input)+"\n")
 
         GPIO.add_event_detect(gpio_tsub, GPIO.FALLING,
-                              callback=input_select, bouncetime=300)
+                              callback=input_select, bouncetime=self.bouncetime)
         GPIO.add_event_detect(gpio_nsub, GPIO.FALLING,
-                              callback=input_select, bouncetime=300)
+                              callback=input_select, bouncetime=self.bouncetime)
 
         return True
 
@@ -415,18 +1282,21 @@ class ChangeRouter:
     def cleanup():
         """"
         GPIOのクルーンアップ
+        番号の指定とピンの設定も消えるので、次に開く時はsetup_gpio()で設定し直す。
 
         :return: bool
         """
+        global gpio_ready
 
         GPIO.cleanup()
+        gpio_ready = False
 
         return True
 
 
 if __name__ == '__main__':
     # ポーリングの場合の処理
-    cr = ChangeRouter()
+    cr = ChangeRouter().open()
     # cr.write_log("状態確認")
     # cr.get_crosspoint('128')
     cr.write_log("制御指令")
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+実機を使わずに試験する為の、ループバックのシリアルポート対とSW-P-88の送信先の代役。
+シリアルポート対はtty0tty(/dev/tnt0と/dev/tnt1)と同じように、2つの疑似端末の間でデータを中継する。
+"""
+
+import os
+import pty
+import select
+import socket
+import threading
+import tty
+
+
+class SerialPair:
+    """
+    2つの疑似端末をつなぎ、一方に書いたデータがもう一方から読めるようにするクラス。
+    ChangeRouterにport_a、Serial2Tcpにport_bを渡して使う。
+    """
+
+    def __init__(self):
+        """
+        コンストラクタ。疑似端末を2つ作り、中継スレッドを開始する。
+        """
+        self.fds = []
+        self.ports = []
+        for i in range(2):
+            master, slave = pty.openpty()
+            tty.setraw(slave)
+            self.fds.append((master, slave))
+            self.ports.append(os.ttyname(slave))
+        self.wakeup = os.pipe()  # 中継スレッドを止める為のパイプ
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def port_a(self):
+        return self.ports[0]
+
+    @property
+    def port_b(self):
+        return self.ports[1]
+
+    def run(self):
+        """
+        中継スレッドの本体。一方のmasterから読んだデータをもう一方のmasterに書く。
+
+        :return:
+        """
+        a, b = self.fds[0][0], self.fds[1][0]
+        peer = {a: b, b: a}
+        while True:
+            readable = select.select([a, b, self.wakeup[0]], [], [])[0]
+            if self.wakeup[0] in readable:
+                return
+            for fd in readable:
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    continue
+                os.write(peer[fd], data)
+
+    def close(self):
+        """
+        中継スレッドを止め、疑似端末を閉じる。
+
+        :return:
+        """
+        os.write(self.wakeup[1], b'x')
+        self.thread.join()
+        for fd in [fd for pair in self.fds for fd in pair] + list(self.wakeup):
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TcpSink:
+    """
+    SW-P-88の送信先の代役となるローカルのTCPサーバ。受信したデータの量を数える。
+    """
+
+    def __init__(self):
+        """
+        コンストラクタ。空いているポートで待ち受けを開始する。
+        """
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.address = self.server.getsockname()
+        self.received = 0
+        self.connections = 0
+        self.disconnections = 0  # 送信側から切断された数
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        接続を受け付け、接続毎のスレッドで受信する。
+
+        :return:
+        """
+        while True:
+            try:
+                conn, address = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.receive, args=(conn,), daemon=True).start()
+
+    def receive(self, conn):
+        """
+        切断されるまで受信したバイト数を数える。
+
+        :param conn: socket
+        :return:
+        """
+        with conn:
+            while True:
+                try:
+                    data = conn.recv(4096)
+                except OSError:
+                    return
+                if not data:
+                    self.disconnections += 1
+                    return
+                self.received += len(data)
+
+    def close(self):
+        """
+        待ち受けを終了する。
+
+        :return:
+        """
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)  # acceptで待っているスレッドを起こす
+        except OSError:
+            pass
+        self.server.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+複数の素材分配ルータ(シリアルポート)をまとめて制御するプログラム。
+ルータ毎に専用のスレッドで送受信し、あるルータの応答待ちが他のルータを待たせないようにする。
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import change_router
+
+
+class RouterController:
+    """
+    複数の素材分配ルータを(ルータ名, ディスティネーションch)で指定して制御するクラス。
+    """
+
+    def __init__(self, ports, **kwargs):
+        """
+        コンストラクタ。ルータ名とシリアルポートの辞書から、ルータ毎のChangeRouterとスレッドを用意する。
+        kwargsはChangeRouterにそのまま渡す。
+
+        :param ports: dict
+        """
+        self.routers = {}
+        self.workers = {}
+        try:
+            for name, port in ports.items():
+                self.routers[name] = change_router.ChangeRouter(port=port, **kwargs).open()
+                self.workers[name] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=str(name))
+        except Exception:
+            self.close()
+            raise
+
+    def submit(self, router, method, *args, **kwargs):
+        """
+        ルータのスレッドでChangeRouterのmethodを実行し、Futureを返す。
+        同じルータへの命令は順番に、別のルータへの命令は並行して実行される。
+
+        :param router: str
+        :param method: str
+        :return: Future
+        """
+        return self.workers[router].submit(getattr(self.routers[router], method), *args, **kwargs)
+
+    def set_crosspoint(self, key, source):
+        """
+        (ルータ名, ディスティネーションch)にソースchを切り替える命令を出し、結果(bool)のFutureを返す。
+
+        :param key: (str, str)
+        :param source: str
+        :return: Future
+        """
+        router, dist = key
+        return self.submit(router, 'set_crosspoint', dist, source)
+
+    def get_crosspoint(self, key):
+        """
+        (ルータ名, ディスティネーションch)の状態を問い合わせ、
+        (ディスティネーションch, ソースch)かNoneのFutureを返す。
+
+        :param key: (str, str)
+        :return: Future
+        """
+        router, dist = key
+        return self.submit(router, 'query_crosspoint', dist)
+
+    def set_crosspoints(self, crosspoints, timeout=None):
+        """
+        {(ルータ名, ディスティネーションch): ソースch}をルータ毎のサルボにまとめて並行して送信し、
+        {(ルータ名, ディスティネーションch): 成功失敗}を返す。
+        timeout秒までに終わらなかったルータや、例外になったルータのディスティネーションは失敗とする。
+
+        :param crosspoints: dict
+        :param timeout: float
+        :return: dict
+        """
+        salvos = {}
+        for (router, dist), source in crosspoints.items():
+            salvos.setdefault(router, []).append((dist, source))
+
+        futures = {router: self.submit(router, 'set_crosspoints', salvo)
+                   for router, salvo in salvos.items()}
+        wait(futures.values(), timeout)
+
+        results = {key: False for key in crosspoints}
+        for router, future in futures.items():
+            if future.done() and future.exception() is None:
+                for dist, status in future.result():
+                    results[(router, dist)] = status
+        return results
+
+    def close(self):
+        """
+        スレッドを終了し、全てのシリアルポートを閉じる。
+
+        :return:
+        """
+        for worker in self.workers.values():
+            worker.shutdown()
+        for router in self.routers.values():
+            router.close()
+        self.workers = {}
+        self.routers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
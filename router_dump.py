@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+素材分配ルータの全ディスティネーションchの状態を取得し、CSVかJSONで出力するプログラム。
+
+python router_dump.py --range 1-128 --format csv --output dump.csv
+"""
+
+import argparse
+import csv
+import json
+import sys
+import change_router
+
+
+def parse_range(text):
+    """
+    "1-128"や"1,5,10-20"の形式の文字列から、ディスティネーション番号のリストを返す。
+
+    :param text: str
+    :return: list of int
+    """
+    dests = []
+    for item in text.split(','):
+        start, _, end = item.partition('-')
+        dests.extend(range(int(start), int(end or start) + 1))
+    return dests
+
+
+def write_dump(sources, dests, output, output_format):
+    """
+    ディスティネーション番号とソース番号の組をoutputに書き出す。分からなかったソースは空とする。
+
+    :param sources: array
+    :param dests: list of int
+    :param output: file
+    :param output_format: str
+    :return:
+    """
+    rows = [(dest, sources[dest] if sources[dest] >= 0 else None) for dest in dests]
+    if output_format == 'json':
+        json.dump([{'destination': dest, 'source': source} for dest, source in rows], output, indent=1)
+        output.write('\n')
+    else:
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(['destination', 'source'])
+        for dest, source in rows:
+            writer.writerow([dest, '' if source is None else source])
+
+
+def main(argv=None):
+    """
+    コマンドラインの引数に従って状態を取得し、出力する。
+
+    :param argv: list of str
+    :return: int
+    """
+    parser = argparse.ArgumentParser(description='素材分配ルータのクロスポイントの状態を出力する')
+    parser.add_argument('--range', default='1-128', help='ディスティネーションch 例: 1-128,200')
+    parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+    parser.add_argument('--output', help='出力ファイル 省略時は標準出力')
+    parser.add_argument('--window', type=int, default=16, help='応答を待たずに送る問い合わせの数')
+    parser.add_argument('--port', help='シリアルポート 省略時はChangeRouterの既定のポート')
+    args = parser.parse_args(argv)
+
+    dests = parse_range(args.range)
+    with change_router.ChangeRouter(port=args.port) as cr:
+        sources = cr.dump_crosspoints(dests, args.window)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            write_dump(sources, dests, f, args.format)
+    else:
+        write_dump(sources, dests, sys.stdout, args.format)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+池上の素材分配ルータ(DCC-057)のシリアル制御を模擬するエミュレータ。
+クロスポイントの状態を持ち、状態問い合わせには実際に切り替えたソースを返す。
+応答の遅延とばらつき、NAK・無応答・BBC異常の混入を設定でき、複数のシリアルポートで同時に受け付けられる。
+
+python router_emulator.py --ports 2 --latency 5 --jitter 2 --nak-rate 0.01
+"""
+
+import argparse
+import random
+import sys
+import threading
+import time
+from array import array
+import serial
+import loopback
+import serial2tcp
+
+router_r_dict = serial2tcp.router_r_dict
+
+
+class RouterEmulator:
+    """
+    素材分配ルータのエミュレータ。ポート毎のスレッドで電文を受け付け、クロスポイントの状態は全ポートで共有する。
+    """
+    size = 1000  # ディスティネーション・ソース番号の数(000～999)
+    interval = 0.5  # 受信待ちのタイムアウト 停止の確認をする間隔 (s)
+
+    def __init__(self, ports, latency=0.0, jitter=0.0, nak_rate=0.0, drop_rate=0.0, corrupt_rate=0.0,
+                 seed=None):
+        """
+        コンストラクタ。portsのシリアルポートを開く。受け付けはstart()で開始する。
+        latency(s)の後、±jitter(s)の範囲でばらつかせて応答する。
+        各命令はnak_rateの確率でNAKを返し、drop_rateの確率で応答せず、
+        状態応答はcorrupt_rateの確率でBBCを壊して返す。
+
+        :param ports: list of str
+        :param latency: float
+        :param jitter: float
+        :param nak_rate: float
+        :param drop_rate: float
+        :param corrupt_rate: float
+        :param seed: int
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.nak_rate = nak_rate
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+        self.crosspoints = array('h', [0]) * self.size  # ディスティネーション番号毎のソース番号
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.pairs = []  # virtual()で作った疑似端末の対
+        self.client_ports = []
+        self.commands = 0
+        self.acks = 0
+        self.naks = 0
+        self.drops = 0
+        self.corrupted = 0
+        self.coms = [serial.serial_for_url(port, timeout=self.interval, writeTimeout=5) for port in ports]
+
+    @classmethod
+    def virtual(cls, count=1, **kwargs):
+        """
+        疑似端末の対をcount組作り、一方でエミュレータを受け付ける。
+        ChangeRouterはもう一方(client_ports)に接続する。
+
+        :param count: int
+        :return: RouterEmulator
+        """
+        pairs = [loopback.SerialPair() for i in range(count)]
+        emulator = cls([pair.port_b for pair in pairs], **kwargs)
+        emulator.pairs = pairs
+        emulator.client_ports = [pair.port_a for pair in pairs]
+        return emulator
+
+    def start(self):
+        """
+        ポート毎の受付スレッドを開始する。
+
+        :return: RouterEmulator
+        """
+        self.stop_event.clear()
+        self.threads = [threading.Thread(target=self.run, args=(com,), daemon=True) for com in self.coms]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        受付スレッドを停止させる。
+
+        :return:
+        """
+        self.stop_event.set()
+        for com in self.coms:
+            if hasattr(com, 'cancel_read'):
+                com.cancel_read()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def close(self):
+        """
+        受付を停止し、シリアルポートと疑似端末を閉じる。
+
+        :return:
+        """
+        self.stop()
+        for com in self.coms:
+            com.close()
+        for pair in self.pairs:
+            pair.close()
+        self.pairs = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_crosspoint(self, dist):
+        """
+        ディスティネーション番号のソース番号を返す。
+
+        :param dist: int
+        :return: int
+        """
+        return self.crosspoints[dist]
+
+    def set_crosspoint(self, dist, source):
+        """
+        ディスティネーション番号にソース番号を切り替える。
+
+        :param dist: int
+        :param source: int
+        :return:
+        """
+        with self.lock:
+            self.crosspoints[dist] = source
+
+    @staticmethod
+    def number(frame, start):
+        """
+        電文のstartからの3桁の数字を番号にする。数字でない場合はNoneを返す。
+
+        :param frame: memoryview
+        :param start: int
+        :return: int
+        """
+        digits = frame[start:start + 3]
+        if len(digits) != 3 or not all(0x30 <= d <= 0x39 for d in digits):
+            return None
+        return (digits[0] - 0x30) * 100 + (digits[1] - 0x30) * 10 + digits[2] - 0x30
+
+    @staticmethod
+    def status_frame(dist, source, corrupt=False):
+        """
+        ディスティネーション番号の状態応答電文を返す。corruptがTrueの場合はBBCを壊す。
+
+        :param dist: int
+        :param source: int
+        :param corrupt: bool
+        :return: bytes
+        """
+        text = b'1010000%03d%03d' % (dist, source) + bytes((router_r_dict['ETX'],))
+        result = 0
+        for d in text:
+            result ^= d
+        if corrupt:
+            result ^= 0xff
+        return bytes((router_r_dict['STX'],)) + text + bytes((result,))
+
+    def run(self, com):
+        """
+        1つのポートの受付スレッドの本体。
+
+        :param com: serial.Serial
+        :return:
+        """
+        decoder = serial2tcp.FrameDecoder()
+        while not self.stop_event.is_set():
+            space = decoder.space()
+            size = com.readinto(space[:1])
+            if not size:
+                continue
+            waiting = min(com.in_waiting, len(space) - 1)
+            if waiting:
+                size += com.readinto(space[1:1 + waiting])
+            decoder.commit(size)
+            for frame in decoder.frames():
+                reply = self.handle(frame)
+                if reply is not None:
+                    self.wait_latency()
+                    com.write(reply)
+
+    def wait_latency(self):
+        """
+        設定した遅延とばらつきの分だけ待つ。
+
+        :return:
+        """
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, frame):
+        """
+        受信した電文を処理し、返す応答(bytes)を返す。応答しない場合はNoneを返す。
+
+        :param frame: memoryview
+        :return: bytes
+        """
+        with self.lock:
+            self.commands += 1
+            fault = self.random.random()
+            if fault < self.drop_rate:
+                self.drops += 1
+                return None
+            nak = fault < self.drop_rate + self.nak_rate
+            corrupt = self.random.random() < self.corrupt_rate
+
+            command = frame[1:3]
+            dist = self.number(frame, 8)
+            source = self.number(frame, 11)
+            if nak or dist is None or source is None or command not in (b'03', b'10'):
+                self.naks += 1
+                return bytes((router_r_dict['NAK'],))
+
+            self.acks += 1
+            if command == b'03':
+                self.crosspoints[dist] = source
+                return bytes((router_r_dict['ACK'],))
+
+            if corrupt:
+                self.corrupted += 1
+            return bytes((router_r_dict['ACK'],)) + self.status_frame(dist, self.crosspoints[dist], corrupt)
+
+    def stats(self):
+        """
+        受け付けた命令と、応答・混入した異常の数を返す。
+
+        :return: dict
+        """
+        return {'commands': self.commands, 'acks': self.acks, 'naks': self.naks,
+                'drops': self.drops, 'corrupted': self.corrupted}
+
+
+def main(argv=None):
+    """
+    コマンドラインの引数に従って疑似端末でエミュレータを開始し、Ctrl-Cで終了する。
+
+    :param argv: list of str
+    :return: int
+    """
+    parser = argparse.ArgumentParser(description='素材分配ルータ(DCC-057)のエミュレータ')
+    parser.add_argument('--ports', type=int, default=1, help='疑似端末の数')
+    parser.add_argument('--latency', type=float, default=0, help='応答の遅延 (ms)')
+    parser.add_argument('--jitter', type=float, default=0, help='遅延のばらつき (ms)')
+    parser.add_argument('--nak-rate', type=float, default=0, help='NAKを返す確率')
+    parser.add_argument('--drop-rate', type=float, default=0, help='応答しない確率')
+    parser.add_argument('--corrupt-rate', type=float, default=0, help='状態応答のBBCを壊す確率')
+    parser.add_argument('--seed', type=int, help='乱数の種')
+    args = parser.parse_args(argv)
+
+    emulator = RouterEmulator.virtual(
+        args.ports, latency=args.latency / 1000, jitter=args.jitter / 1000, nak_rate=args.nak_rate,
+        drop_rate=args.drop_rate, corrupt_rate=args.corrupt_rate, seed=args.seed)
+    with emulator:
+        for port in emulator.client_ports:
+            print(port)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    print(emulator.stats())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+ログをバックグラウンドのスレッドでまとめてファイルに書き込むモジュール。
+書き込む側はキューに積むだけで、ファイルの操作は待たない。
+"""
+
+import atexit
+import collections
+import os
+import threading
+
+# ログレベル 値はloggingモジュールと同じ
+DEBUG = 10  # 送受信した電文などの詳細
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+
+class LogWriter:
+    """
+    ログをまとめて書き込むクラス。
+    一定数たまるか一定時間たつと書き込み、ファイルが大きくなればローテーションする。
+    """
+
+    def __init__(self, path_name, batch_size=64, flush_interval=0.5,
+                 max_bytes=1024 * 1024, backup_count=3):
+        """
+        コンストラクタ。書き込みスレッドを開始する。
+
+        :param path_name: str
+        :param batch_size: int
+        :param flush_interval: float
+        :param max_bytes: int
+        :param backup_count: int
+        """
+        self.path_name = path_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue = collections.deque()  # append/popleftはロック無しでスレッド間の受け渡しに使える
+        self.event = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, message):
+        """
+        メッセージを書き込み待ちに積む。
+
+        :param message: str
+        :return:
+        """
+        self.queue.append(message)
+        if len(self.queue) >= self.batch_size:
+            self.event.set()
+
+    def flush(self, timeout=None):
+        """
+        それまでに積んだメッセージが書き込まれるまで待つ。
+
+        :param timeout: float
+        :return: bool
+        """
+        if not self.thread.is_alive():
+            return False
+        done = threading.Event()
+        self.queue.append(done)
+        self.event.set()
+        return done.wait(timeout)
+
+    def close(self):
+        """
+        残りのメッセージを書き込み、書き込みスレッドを終了する。
+
+        :return:
+        """
+        if self.running:
+            self.running = False
+            self.event.set()
+            self.thread.join()
+            atexit.unregister(self.close)
+
+    def run(self):
+        """
+        書き込みスレッドの本体。
+
+        :return:
+        """
+        while self.running:
+            self.event.wait(self.flush_interval)
+            self.event.clear()
+            self.write_batch()
+        self.write_batch()
+
+    def write_batch(self):
+        """
+        書き込み待ちのメッセージをまとめてファイルに書き込む。
+
+        :return:
+        """
+        messages = []
+        waiters = []
+        while self.queue:
+            item = self.queue.popleft()
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+            else:
+                messages.append(item)
+
+        if messages:
+            text = ''.join(messages)
+            self.rotate(len(text.encode('utf-8')))
+            with open(self.path_name, 'a') as f:
+                f.write(text)
+
+        for waiter in waiters:
+            waiter.set()
+
+    def rotate(self, size):
+        """
+        sizeを書き込むとmax_bytesを超える場合、ファイルを.1、.2…にずらす。
+
+        :param size: int
+        :return:
+        """
+        if self.max_bytes <= 0 or not os.path.isfile(self.path_name):
+            return
+        if os.path.getsize(self.path_name) + size <= self.max_bytes:
+            return
+
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.path_name, i)
+            if os.path.isfile(source):
+                os.replace(source, '%s.%d' % (self.path_name, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path_name, self.path_name + '.1')
+        else:
+            os.remove(self.path_name)
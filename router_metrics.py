@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+処理時間のヒストグラムや応答の回数などを数え、Prometheusのテキスト形式でHTTPから取得できるようにするモジュール。
+記録は数値の加算だけなので、本番のraspberry piでも常に有効にしておける。
+
+curl http://127.0.0.1:9057/metrics
+"""
+
+import bisect
+import os
+import threading
+import weakref
+
+# HTTPサーバの既定のポート node_exporter(9100)などのPrometheusのexporterと重ならないようにする
+# 環境変数ROUTER_METRICS_PORTで変えられる
+default_port = int(os.environ.get('ROUTER_METRICS_PORT', 9057))
+
+# 処理時間のヒストグラムの区切り (s) シリアル9600bpsの1電文は十数ms
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def format_value(value):
+    """
+    数値をPrometheusのテキスト形式の値にする。
+
+    :param value: float
+    :return: str
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    """
+    ラベルの(名前, 値)のタプルから、{name="value"}の文字列を返す。
+
+    :param labels: tuple
+    :return: str
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+class Counter:
+    """
+    増えるだけの回数。label_nameを指定すると、ラベルの値毎に数える。
+    """
+    metric_type = 'counter'
+
+    def __init__(self, name, help_text, label_name=None):
+        """
+        コンストラクタ。
+
+        :param name: str
+        :param help_text: str
+        :param label_name: str
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label=None, amount=1):
+        """
+        labelの回数をamountだけ増やす。
+
+        :param label: str
+        :param amount: int
+        :return:
+        """
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def get(self, label=None):
+        """
+        labelの回数を返す。
+
+        :param label: str
+        :return: int
+        """
+        return self.values.get(label, 0)
+
+    def samples(self):
+        """
+        (名前, ラベル, 値)のリストを返す。
+
+        :return: list
+        """
+        with self.lock:
+            items = sorted(self.values.items(), key=lambda item: str(item[0]))
+        if self.label_name is None:
+            return [(self.name, (), value) for label, value in items]
+        return [(self.name, ((self.label_name, label),), value) for label, value in items]
+
+
+class Gauge:
+    """
+    増減する値。funcを指定すると、取得される度にfuncを呼んで値とする。
+    funcで数えている累計の回数をcounterとして出す場合はmetric_typeに'counter'を指定する。
+    trackで登録したインスタンス毎のfuncの値は合算し、インスタンスが無くなると外れる。
+    """
+
+    def __init__(self, name, help_text, func=None, metric_type='gauge'):
+        """
+        コンストラクタ。
+
+        :param name: str
+        :param help_text: str
+        :param func: function
+        :param metric_type: str
+        """
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.metric_type = metric_type
+        self.value = 0
+        self.tracked = weakref.WeakKeyDictionary()  # インスタンス毎のfunc(インスタンス)
+
+    def track(self, owner, func):
+        """
+        ownerの値をfunc(owner)で取得して合算するように登録する。
+        funcがownerを参照し続けないように、ownerは引数で渡す。
+
+        :param owner: object
+        :param func: function
+        :return:
+        """
+        self.tracked[owner] = func
+
+    def set(self, value):
+        """
+        値を設定する。
+
+        :param value: float
+        :return:
+        """
+        self.value = value
+
+    def get(self):
+        """
+        値を返す。
+
+        :return: float
+        """
+        value = self.func() if self.func is not None else self.value
+        return value + sum(func(owner) for owner, func in list(self.tracked.items()))
+
+    def samples(self):
+        """
+        (名前, ラベル, 値)のリストを返す。
+
+        :return: list
+        """
+        return [(self.name, (), self.get())]
+
+
+class Histogram:
+    """
+    処理時間などの分布。区切り毎の件数と合計を数える。
+    """
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        """
+        コンストラクタ。
+
+        :param name: str
+        :param help_text: str
+        :param buckets: tuple of float
+        """
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # 最後は+Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        値を1件記録する。
+
+        :param value: float
+        :return:
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        """
+        (名前, ラベル, 値)のリストを返す。区切り毎の件数は累積にする。
+
+        :return: list
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        result = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            result.append((self.name + '_bucket', (('le', format_value(float(bound))),), cumulative))
+        result.append((self.name + '_sum', (), total))
+        result.append((self.name + '_count', (), count))
+        return result
+
+
+class Registry:
+    """
+    メトリクスを名前で登録しておき、まとめてテキスト形式にするクラス。
+    同じ名前で取得すると同じメトリクスを返すので、複数のインスタンスの値は合算される。
+    """
+
+    def __init__(self):
+        """
+        コンストラクタ。
+        """
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, name, factory):
+        """
+        nameのメトリクスを返す。無ければfactoryで作って登録する。
+
+        :param name: str
+        :param factory: function
+        :return:
+        """
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = factory()
+            return metric
+
+    def counter(self, name, help_text, label_name=None):
+        return self.get_or_create(name, lambda: Counter(name, help_text, label_name))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self.get_or_create(name, lambda: Histogram(name, help_text, buckets))
+
+    def gauge(self, name, help_text, func=None, metric_type='gauge', owner=None):
+        """
+        nameのGaugeを返す。funcを指定した場合は、既にあっても新しいfuncに置き換える。
+        ownerを指定した場合は置き換えずに、func(owner)の値を他のインスタンスの値と合算する。
+
+        :param name: str
+        :param help_text: str
+        :param func: function
+        :param metric_type: str
+        :param owner: object
+        :return: Gauge
+        """
+        gauge = self.get_or_create(name, lambda: Gauge(name, help_text, None, metric_type))
+        if owner is not None:
+            gauge.track(owner, func)
+        elif func is not None:
+            gauge.func = func
+        return gauge
+
+    def render(self):
+        """
+        全てのメトリクスをPrometheusのテキスト形式にする。
+
+        :return: str
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+            lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# 特に指定しない場合に使うレジストリ
+default_registry = Registry()
+
+
+def start_server(port=None, host='127.0.0.1', registry=None):
+    """
+    メトリクスを返すHTTPサーバを別スレッドで開始する。止める場合は戻り値のshutdown()とserver_close()を呼ぶ。
+    /metricsへのGETにregistry(省略時はdefault_registry)の内容を返す。portの省略時はdefault_port。
+
+    :param port: int
+    :param host: str
+    :param registry: Registry
+    :return: http.server.ThreadingHTTPServer
+    """
+    import http.server  # import時間を増やさないよう、使う時にだけ読み込む
+
+    registry = registry or default_registry
+    if port is None:
+        port = default_port
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # アクセス毎の表示はしない
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def try_start_server(port=None, host='127.0.0.1', registry=None):
+    """
+    start_serverと同じだが、ポートが使用中などで開始できない場合は警告を記録してNoneを返す。
+    メトリクスが取れなくても、本来の処理は止めないようにする為に使う。
+
+    :param port: int
+    :param host: str
+    :param registry: Registry
+    :return: http.server.ThreadingHTTPServer
+    """
+    try:
+        return start_server(port, host, registry)
+    except OSError as e:
+        import logging  # import時間を増やさないよう、使う時にだけ読み込む
+        logging.getLogger(__name__).warning('metrics server could not start on %s:%s : %s',
+                                            host, default_port if port is None else port, e)
+        return None
@@ -10,10 +10,16 @@ import serial
 import time
 from array import array
 import threading
-import platform
+import sys
 import csv
 import socket
+import select
 import os
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import sw_p_88
+import router_metrics
 
 # シリアルコードの正引き辞書、逆引き辞書
 router_dict = {0x02: 'STX',  0x03: 'ETX', 0x17: 'ETB', 0x06: 'ACK', 0x15: 'NAK', 0x04: 'EOT'}
@@ -21,16 +27,564 @@ router_r_dict = {v: k for k, v in list(router_dict.items())}
 
 comport = '/dev/ttyUSB0'
 # Windows上はCOM11、raspberry piでは/dev/ttyUSB0、Jenkins上では/dev/tnt0
-if platform.uname()[0] == 'Windows':
+if sys.platform == 'win32':
     comport = 'COM11'
 
 
+@functools.lru_cache(maxsize=1024)
+def connect_packet(target_id, source_id):
+    """
+    target_idへsource_idを接続するSW-P-88パケットを返す。同じ組み合わせは作り直さない。
+    通常はIdTableで作っておいたパケットを使い、テーブルに無いソース番号の場合に使う。
+
+    :param target_id: int
+    :param source_id: int
+    :return: bytes
+    """
+    return sw_p_88.crosspoint_connect(target_id, source_id)
+
+
+class IdTable:
+    """
+    旧番号(0～999)を添字、新番号を値とする配列に変換した変換テーブル。0は変換無しを表す。
+    送信先毎に、テーブルにある新番号へ接続するSW-P-88パケットも作っておく。
+    ファイルが更新されると読み込み直し、全ての行が正しい場合だけ配列とパケットを丸ごと差し替える。
+    参照する側は差し替え前後のどちらかを見るので、作りかけの配列やパケットを見ることは無い。
+    """
+    size = 1000  # 旧番号の数
+    new_id_max = 256  # SW-P-88のソース番号の上限
+    check_interval = 1  # ファイルの更新を確認する間隔 (s)
+
+    def __init__(self, path_name, target_ids=()):
+        """
+        コンストラクタ。ファイルを読み込む。読み込めない場合は例外を送出する。
+        target_idsは、パケットを作っておく送信先のディスティネーション番号。
+
+        :param path_name: str
+        :param target_ids: list of int
+        """
+        self.path_name = path_name
+        self.target_ids = tuple(target_ids)
+        self.compiled = (array('h', [0]) * self.size, ({},) * len(self.target_ids))  # (配列, 送信先毎のパケット)
+        self.mtime = None
+        self.next_check = 0
+        self.reloads = 0
+        self.errors = 0
+        self.load()
+
+    @classmethod
+    def compile(cls, rows):
+        """
+        旧番号・新番号の列を持つ行から配列を作る。範囲外の番号や、同じ旧番号に異なる新番号がある場合は
+        ValueErrorを送出する。
+
+        :param rows: iterable of dict
+        :return: array
+        """
+        table = array('h', [0]) * cls.size
+        for line, row in enumerate(rows, 2):
+            try:
+                old_id = int(row['旧番号'])
+                new_id = int(row['新番号'])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError('line %d: invalid row %s' % (line, row))
+            if not 0 <= old_id < cls.size or not 1 <= new_id <= cls.new_id_max:
+                raise ValueError('line %d: number out of range %d,%d' % (line, old_id, new_id))
+            if table[old_id] not in (0, new_id):
+                raise ValueError('line %d: duplicate old number %d' % (line, old_id))
+            table[old_id] = new_id
+        return table
+
+    @property
+    def table(self):
+        return self.compiled[0]
+
+    @property
+    def packets(self):
+        """
+        送信先毎の、新番号をキーにしたSW-P-88パケットの辞書のタプル。
+
+        :return: tuple of dict
+        """
+        return self.compiled[1]
+
+    def load(self):
+        """
+        ファイルを読み込んで配列とパケットを差し替え、変換できる旧番号の数を返す。
+        読み込めない場合は例外を送出し、それまでの配列とパケットを使い続ける。
+
+        :return: int
+        """
+        mtime = os.stat(self.path_name).st_mtime_ns
+        with open(self.path_name, 'r', encoding='utf-8-sig') as f:
+            table = self.compile(csv.DictReader(f))
+        source_ids = set(table)
+        source_ids.discard(0)
+        packets = tuple(sw_p_88.build_packets(source_ids, target_id) for target_id in self.target_ids)
+        self.compiled = (table, packets)  # 参照の代入だけで両方を一度に差し替える
+        self.mtime = mtime
+        return sum(1 for new_id in table if new_id)
+
+    def reload_if_changed(self):
+        """
+        check_interval毎にファイルの更新を確認し、更新されていれば読み込み直す。
+        読み込み直した場合はTrueを返す。不正な内容の場合は、次に更新されるまで元の配列を使う。
+
+        :return: bool
+        """
+        now = time.monotonic()
+        if now < self.next_check:
+            return False
+        self.next_check = now + self.check_interval
+        try:
+            mtime = os.stat(self.path_name).st_mtime_ns
+        except OSError as e:
+            print('[*]ID table error : {}'.format(e))
+            self.errors += 1
+            return False
+        if mtime == self.mtime:
+            return False
+        try:
+            self.load()
+        except (OSError, ValueError) as e:
+            print('[*]ID table error : {}'.format(e))
+            self.errors += 1
+            self.mtime = mtime  # 同じ内容を読み直さない
+            return False
+        self.reloads += 1
+        return True
+
+    def get(self, old_id):
+        """
+        旧番号の新番号を返す。変換できない場合はNoneを返す。
+
+        :param old_id: int
+        :return: int
+        """
+        if not 0 <= old_id < self.size:
+            return None
+        return self.table[old_id] or None
+
+
+class FrameDecoder:
+    """
+    受信したデータを溜めて、STX～ETX+BBCまでの電文を1つずつ取り出すクラス。
+    電文が複数回の受信に分かれていても、1回の受信に複数の電文があっても取り出せる。
+    BBCが合わない電文は捨てて、その数を数える。
+    受信バッファは最初に確保したものを使い続け、電文はバッファのmemoryviewで返すので、
+    受信を続けてもコピーやメモリの確保がほとんど起こらない。
+    """
+    size = 4096  # 受信バッファの大きさ
+    min_space = 256  # 受信データを書き込む後ろの空きの最小値
+
+    def __init__(self, size=None, counter=None):
+        """
+        コンストラクタ。受信バッファを確保する。
+        counter(router_metrics.Counter)を指定した場合は、BBCが合わない電文をそれにも数える。
+
+        :param size: int
+        :param counter: router_metrics.Counter
+        """
+        self.buffer = bytearray(max(size or self.size, self.min_space))
+        self.view = memoryview(self.buffer)
+        self.start = 0  # 未処理のデータの先頭
+        self.end = 0  # 未処理のデータの終わり
+        self.bbc_errors = 0
+        self.counter = counter
+
+    def space(self):
+        """
+        受信データを書き込める領域のmemoryviewを返す。
+        後ろの空きが少なくなった時だけ、未処理のデータを先頭に詰める。
+
+        :return: memoryview
+        """
+        if len(self.buffer) - self.end < self.min_space:
+            length = self.end - self.start
+            if length == len(self.buffer):
+                length = 0  # 電文にならないデータで一杯になったので捨てる
+            self.view[:length] = self.view[self.end - length:self.end]
+            self.start, self.end = 0, length
+        return self.view[self.end:]
+
+    def commit(self, size):
+        """
+        space()の領域にsizeバイト書き込んだことを記録する。
+
+        :param size: int
+        :return:
+        """
+        self.end += size
+
+    def feed(self, data):
+        """
+        受信データを追加し、揃った電文(STX～BBC)をmemoryviewで順に返す。
+        返した電文は次に受信データを追加するまで有効。
+
+        :param data: bytes
+        :return: generator
+        """
+        data = memoryview(data)
+        while data:
+            space = self.space()
+            size = min(len(space), len(data))
+            space[:size] = data[:size]
+            self.commit(size)
+            data = data[size:]
+            yield from self.frames()
+
+    def frames(self):
+        """
+        受信バッファにある揃った電文(STX～BBC)をmemoryviewで順に返す。
+
+        :return: generator
+        """
+        buffer = self.buffer
+        while True:
+            start = buffer.find(router_r_dict['STX'], self.start, self.end)
+            if start < 0:
+                # STXが無ければ電文の途中ではないので全て捨てる
+                self.start = self.end
+                return
+            self.start = start
+
+            end = buffer.find(router_r_dict['ETX'], start + 1, self.end)
+            next_start = buffer.find(router_r_dict['STX'], start + 1, self.end)
+            if 0 <= next_start and (end < 0 or next_start < end):
+                # ETXの前に次のSTXが来たので、途中で切れた電文を捨てる
+                self.start = next_start
+                continue
+            if end < 0 or end + 1 >= self.end:
+                return  # BBCまで揃っていないので次の受信を待つ
+            self.start = end + 2
+
+            result = 0
+            for d in self.view[start + 1:end + 1]:
+                result ^= d
+            if result == buffer[end + 1]:
+                yield self.view[start:end + 2]
+            else:
+                self.bbc_errors += 1
+                if self.counter is not None:
+                    self.counter.inc()
+
+
+class TargetConnection:
+    """
+    SW-P-88の送信先とのTCP接続を張ったままにして使い回すクラス。
+    切断や接続失敗の時は間隔を延ばしながら再接続し、送信の度には接続しない。
+    """
+    timeout = 2  # 接続・送信のタイムアウト (s)
+    backoff_min = 0.5  # 再接続の最初の待ち時間 (s)
+    backoff_max = 30  # 再接続の最大の待ち時間 (s)
+    keepalive = {'TCP_KEEPIDLE': 10, 'TCP_KEEPINTVL': 5, 'TCP_KEEPCNT': 3}  # キープアライブの設定
+
+    def __init__(self, ip, port, timeout=None):
+        """
+        コンストラクタ。接続は最初の送信時に行う。timeoutを省略した場合はTargetConnection.timeoutとする。
+
+        :param ip: str
+        :param port: int
+        :param timeout: float
+        """
+        self.address = (ip, port)
+        if timeout is not None:
+            self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+        self.backoff = 0
+        self.next_connect = 0  # 次に接続を試みてよい時刻(time.monotonic())
+        self.connects = 0
+        self.errors = 0
+        self.responses = 0  # 読み捨てた相手からのレスポンス(recv)の数
+
+    def connect(self):
+        """
+        送信先に接続する。再接続の待ち時間中や接続に失敗した場合はFalseを返す。
+
+        :return: bool
+        """
+        now = time.monotonic()
+        if now < self.next_connect:
+            return False
+        try:
+            sock = socket.create_connection(self.address, self.timeout)
+        except OSError as e:
+            print('[*]Connect error : {}'.format(e))
+            self.errors += 1
+            self.backoff = min(max(self.backoff * 2, self.backoff_min), self.backoff_max)
+            self.next_connect = now + self.backoff
+            return False
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # 応答の無くなった相手はOSのキープアライブで検出する
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in self.keepalive.items():
+            if hasattr(socket, name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+        self.sock = sock
+        self.backoff = 0
+        self.connects += 1
+        return True
+
+    def close(self):
+        """
+        接続を閉じる。
+
+        :return:
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def is_alive(self):
+        """
+        接続が生きているか確認する。相手からのレスポンスは数えて読み捨て、
+        相手が切断していた(半開きの)場合はFalseを返す。
+
+        :return: bool
+        """
+        try:
+            while select.select([self.sock], [], [], 0)[0]:
+                response = self.sock.recv(4096)
+                if not response:
+                    return False
+                self.responses += 1
+        except OSError:
+            return False
+        return True
+
+    def send(self, data):
+        """
+        データを送信する。切断されていた場合は再接続して1度だけ送り直す。
+
+        :param data: bytes
+        :return: bool
+        """
+        with self.lock:
+            for retry in range(2):
+                if self.sock is not None and not self.is_alive():
+                    self.close()
+                if self.sock is None and not self.connect():
+                    return False
+                try:
+                    self.sock.sendall(data)
+                    return True
+                except OSError as e:
+                    print('[*]Send error : {}'.format(e))
+                    self.errors += 1
+                    self.close()
+            return False
+
+
+class TargetGroup:
+    """
+    同じクロスポイントを複数のSW-P-88の送信先(本線・予備など)へ並行して送るクラス。
+    送信先毎に接続と送信スレッドを持つので、全体の時間は合計ではなく一番遅い送信先の時間になり、
+    応答の無い送信先があっても他の送信先は待たされない。
+    """
+
+    def __init__(self, targets):
+        """
+        コンストラクタ。targetsは(IPアドレス, ポート, ディスティネーション番号)か、
+        それにタイムアウト(s)を加えたタプルのリスト。
+
+        :param targets: list of tuple
+        """
+        self.connections = [TargetConnection(target[0], target[1], *target[3:]) for target in targets]
+        self.target_ids = [target[2] for target in targets]
+        self.names = ['%s:%d/%d' % (target[0], target[1], target[2]) for target in targets]
+        # 送信先が1つの場合は呼び出したスレッドで送る
+        self.executors = [ThreadPoolExecutor(max_workers=1) for target in targets] \
+            if len(targets) > 1 else None
+        self.successes = [0] * len(targets)
+        self.failures = [0] * len(targets)
+        self.timeouts = [0] * len(targets)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def send(self, source_id, tables=None):
+        """
+        全ての送信先へsource_idを接続するパケットを送り、送信先毎の成功失敗のリストを返す。
+        tablesに送信先毎のパケットの辞書(IdTable.packets)を指定すると、そこにあるパケットを使う。
+        送信先のタイムアウトまでに送り終わらなかった送信先は失敗とする。
+
+        :param source_id: int
+        :param tables: tuple of dict
+        :return: list of bool
+        """
+        if tables:
+            packets = [table.get(source_id) or connect_packet(target_id, source_id)
+                       for table, target_id in zip(tables, self.target_ids)]
+        else:
+            packets = [connect_packet(target_id, source_id) for target_id in self.target_ids]
+        if self.executors is None:
+            results = [connection.send(packet) for connection, packet in zip(self.connections, packets)]
+        else:
+            start = time.monotonic()
+            futures = [executor.submit(connection.send, packet)
+                       for executor, connection, packet in zip(self.executors, self.connections, packets)]
+            results = []
+            for i, future in enumerate(futures):
+                remaining = start + self.connections[i].timeout - time.monotonic()
+                try:
+                    results.append(future.result(max(0, remaining)))
+                except TimeoutError:
+                    self.timeouts[i] += 1
+                    results.append(False)
+
+        for i, status in enumerate(results):
+            if status:
+                self.successes[i] += 1
+            else:
+                self.failures[i] += 1
+        return results
+
+    def close(self):
+        """
+        送信スレッドを止め、全ての接続を閉じる。閉じた後に送信した場合は、また接続する。
+
+        :return:
+        """
+        if self.executors is not None:
+            for executor in self.executors:
+                executor.shutdown(wait=False)
+            # スレッドは最初の送信まで作られないので、作り直しておいても残らない
+            self.executors = [ThreadPoolExecutor(max_workers=1) for executor in self.executors]
+        for connection in self.connections:
+            with connection.lock:
+                connection.close()
+
+
+class OutboundQueue:
+    """
+    TCPで送信するクロスポイント要求を溜める上限付きのキュー。
+    溢れた時の動作は、空くまで待つ(block)、一番古い要求を捨てる(drop_oldest)、
+    同じディスティネーションの要求を最新の1つにまとめる(coalesce)から選ぶ。
+    """
+    policies = ('block', 'drop_oldest', 'coalesce')
+
+    def __init__(self, maxsize=64, policy='block', counter=None):
+        """
+        コンストラクタ。counter(router_metrics.Counter)を指定した場合は、捨てた要求をそれにも数える。
+
+        :param maxsize: int
+        :param policy: str
+        :param counter: router_metrics.Counter
+        """
+        if policy not in self.policies:
+            raise ValueError('unknown overflow policy: %s' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()  # [ディスティネーション, 要求]のリスト
+        self.pending = {}  # coalesce用 ディスティネーション毎の未送信の要求
+        self.condition = threading.Condition()
+        self.closed = False
+        self.drops = 0
+        self.coalesced = 0
+        self.counter = counter
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def depth(self):
+        """
+        キューにたまっている要求の数。
+
+        :return: int
+        """
+        return len(self.items)
+
+    def drop(self):
+        """
+        捨てた要求を数える。
+
+        :return:
+        """
+        self.drops += 1
+        if self.counter is not None:
+            self.counter.inc()
+
+    def put(self, dist, item, timeout=None):
+        """
+        要求をキューに入れる。blockで空くのを待ってタイムアウトした場合は、入れずにFalseを返す。
+
+        :param dist: int
+        :param item:
+        :param timeout: float
+        :return: bool
+        """
+        with self.condition:
+            if self.policy == 'coalesce' and dist in self.pending:
+                self.pending[dist][1] = item
+                self.coalesced += 1
+                return True
+
+            if len(self.items) >= self.maxsize:
+                if self.policy == 'block':
+                    if not self.condition.wait_for(
+                            lambda: len(self.items) < self.maxsize or self.closed, timeout):
+                        self.drop()
+                        return False
+                else:
+                    self.remove_entry(self.items.popleft())
+                    self.drop()
+
+            entry = [dist, item]
+            self.items.append(entry)
+            if self.policy == 'coalesce':
+                self.pending[dist] = entry
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """
+        一番古い要求を(ディスティネーション, 要求)で取り出す。
+        キューが閉じられた場合やタイムアウトした場合はNoneを返す。
+
+        :param timeout: float
+        :return: tuple
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+            if not self.items:
+                return None
+            entry = self.items.popleft()
+            self.remove_entry(entry)
+            self.condition.notify_all()
+            return entry[0], entry[1]
+
+    def remove_entry(self, entry):
+        """
+        coalesce用の未送信の要求から、取り出した要求を外す。
+
+        :param entry: list
+        :return:
+        """
+        if self.pending.get(entry[0]) is entry:
+            del self.pending[entry[0]]
+
+    def close(self):
+        """
+        キューを閉じて、待っているスレッドを起こす。
+
+        :return:
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
 class Serial2Tcp:
     """
     素材分配ルーターと同等のシリアルの送受信をするダミープログラム。
     """
-    interval = 1  # 待ち時間 (s)
-    run_status = True  # 継続して待ち続けるかのフラグ
+    interval = 1  # 受信待ちのタイムアウト (s)
+    debug = False  # 受信データの16進や電文毎の処理内容を表示するかどうか
     test_status = False  # テストの結果のフラグ　初期値は失敗
     ng_mode = False  # 応答の失敗モード　初期値はFalse
     my_name = 'Sir'
@@ -43,18 +597,27 @@ class Serial2Tcp:
     buffer_size = 4096
     target_id = 12
     source_id = 116
-    stx = bytearray.fromhex('1002')
-    etx = bytearray.fromhex('1003')
-    
-    # 変換テーブル 
-    ID_table = {}
 
-    def __init__(self, port_name, ng_mode=False):
+    # 変換テーブルのファイル 省略時はこのファイルと同じフォルダのlocation.csv
+    table_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'location.csv')
+
+    def __init__(self, port_name, ng_mode=False, queue_size=0, overflow='block', registry=None,
+                 table_path=None, targets=None):
         """
         コンストラクタ。NGの場合の振る舞いもできること、シリアルデバイスも変更可能に引数を取る。
+        queue_sizeを指定すると、TCPの送信はキュー経由で別スレッドから行い、シリアルのACKを待たせない。
+        送信時間や応答の回数はregistry(省略時はrouter_metrics.default_registry)に記録する。
+        変換テーブルはtable_path(省略時はSerial2Tcp.table_path)から読み込む。
+        targetsに(IPアドレス, ポート, ディスティネーション番号[, タイムアウト])のリストを指定すると、
+        全ての送信先へ並行して送る。省略時はtarget_ip, target_port, target_idの1つとする。
 
         :param port_name: str
         :param ng_mode: bool
+        :param queue_size: int
+        :param overflow: str
+        :param registry: router_metrics.Registry
+        :param table_path: str
+        :param targets: list of tuple
         """
         if 'COM' in port_name:
             self.com = serial.Serial(
@@ -76,9 +639,35 @@ class Serial2Tcp:
                 writeTimeout=5)
 
         self.ng_mode = ng_mode
-
-        # 変換テーブルの読み込み
-        self.read_table()
+        self.stop_event = threading.Event()  # 受信待ちを停止させるイベント
+        self.thread = None
+        self.targets = TargetGroup(targets or [(self.target_ip, self.target_port, self.target_id)])
+        self.sender = None
+
+        registry = registry or router_metrics.default_registry
+        self.send_seconds = registry.histogram(
+            'serial2tcp_send_packet_seconds', 'Time to send one crosspoint to all SW-P-88 targets.')
+        self.send_failures = registry.counter(
+            'serial2tcp_send_failures_total', 'Crosspoints that could not be sent to every target.')
+        self.target_sends = registry.counter(
+            'serial2tcp_target_sends_total', 'SW-P-88 packets sent by target.', 'target')
+        self.target_failures = registry.counter(
+            'serial2tcp_target_failures_total', 'SW-P-88 packets that failed or timed out by target.', 'target')
+        self.replies = registry.counter(
+            'serial2tcp_replies_total', 'Replies sent back on the serial line by control code.', 'reply')
+        self.bbc_errors = registry.counter(
+            'serial2tcp_bbc_errors_total', 'Received frames dropped for a bad BBC.')
+        self.queue_drops = registry.counter(
+            'serial2tcp_queue_drops_total', 'Packets dropped because the outbound queue was full.')
+        # インスタンスを参照し続けないように、値はownerから取得して合算する
+        registry.gauge('serial2tcp_queue_depth', 'SW-P-88 packets waiting in the outbound queue.',
+                       lambda ser: ser.outbound.depth if ser.outbound is not None else 0, owner=self)
+
+        self.decoder = FrameDecoder(counter=self.bbc_errors)
+        self.outbound = OutboundQueue(queue_size, overflow, self.queue_drops) if queue_size > 0 else None
+
+        # 変換テーブルの読み込み 更新されると受信待ちのスレッドで読み込み直す
+        self.id_table = IdTable(table_path or self.table_path, self.targets.target_ids)
 
     def serial_wait(self, stime):
         """
@@ -114,97 +703,100 @@ class Serial2Tcp:
     def read_table(self):
         """
         変換テーブルの読み込み
+
+        :return: int
         """
-        with open('d:\\\\serial2tcp\\'+ 'location.csv','r',encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                self.ID_table[int(row['旧番号'])]=int(row['新番号'])
-        # print(self.ID_table)
+        return self.id_table.load()
 
     def send_packet(self, sourceid):
         """
         TCPパケット送出
 
         :param soueceid: int
-        :return: bytes
+        :return: bool
         """
 
-        message_data = bytearray.fromhex('020000')
-
-        message_data.append(self.target_id-1)
-        message_data.append(sourceid-1)
-        message_data.append(0x05)
-
-        message_data.append((~sum(message_data) + 1 )& 0xff)
-
-        sendmessage = self.stx+message_data+self.etx
+        sendmessage = connect_packet(self.targets.target_ids[0], sourceid)
 
         for b in sendmessage:
             print('%02x' % b)
-        try:
-            # 1.ソケットオブジェクトの作成
-            tcp_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            # 1.1 タイムアウト値の設定 2秒内
-            tcp_client.settimeout(2)
 
-            # 2.サーバに接続
-            tcp_client.connect((self.target_ip,self.target_port))
+        return self.send_tcp(sourceid)
 
-            # 3.サーバにデータを送信
-            tcp_client.send(sendmessage)
-
-            # 4.サーバからのレスポンスを受信
-            response = tcp_client.recv(self.buffer_size)
-            print("[*]Received a response : {}".format(response))
-        except socket.timeout:
-            response = b'no data'
-
-        tcp_client.close()
+    def send_tcp(self, source_id):
+        """
+        全ての送信先へsource_idを接続するSW-P-88パケットを送り、送信時間と送信先毎の結果を記録する。
+        全ての送信先に送れた場合にTrueを返す。
 
-        return response
+        :param source_id: int
+        :return: bool
+        """
+        start = time.monotonic()
+        results = self.targets.send(source_id, self.id_table.packets)
+        self.send_seconds.observe(time.monotonic() - start)
+        for name, result in zip(self.targets.names, results):
+            if result:
+                self.target_sends.inc(name)
+            else:
+                self.target_failures.inc(name)
+                print('%s:TCP送信失敗 %s' % (self.my_name, name))
+        status = all(results)
+        if not status:
+            self.send_failures.inc()
+        return status
+
+    def reply(self, code):
+        """
+        ACK/NAKなどの制御コードをシリアルに返す。
 
+        :param code: str
+        :return:
+        """
+        if self.debug:
+            print('%s>%s' % (self.my_name, code))
+        self.replies.inc(code)
+        self.com.write(bytes((router_r_dict[code],)))
 
     def b_parser(self, i_array):
         """
         受信した電文を解析し、内容に応じて返信する。
 
-        :param i_array: array
+        :param i_array: memoryview
         :return: null
         """
         if i_array[0] != router_r_dict['STX']:
             return
-        if chr(i_array[1])+chr(i_array[2]) == '03':
-            print("%s:クロスポイント制御" % self.my_name)
-            self.output_ch = chr(i_array[8])+chr(i_array[9])+chr(i_array[10])
-            self.input_ch = chr(i_array[11])+chr(i_array[12])+chr(i_array[13])
-
-            if not self.ng_mode:
-                print('%s>ACK' % self.my_name)
-                print('in:%s,send:%d' % (self.input_ch, self.ID_table[int(self.input_ch)]))
-                try: 
-                  self.send_packet(self.ID_table[int(self.input_ch)])
-                  self.com.write(chr(router_r_dict['ACK']).encode())
-                except KeyError:
-                  print('%s>NAK' % self.my_name)
-                  self.com.write(chr(router_r_dict['NAK']).encode())
-                  
+        command = i_array[1:3]
+        if command == b'03':
+            if self.debug:
+                print("%s:クロスポイント制御" % self.my_name)
+            self.output_ch = str(i_array[8:11], 'latin-1')
+            self.input_ch = str(i_array[11:14], 'latin-1')
+
+            # 変換テーブルに無いソースはNAKを返す
+            new_id = self.id_table.get(int(self.input_ch)) if self.input_ch.isdigit() else None
+            if not self.ng_mode and new_id is not None:
+                if self.debug:
+                    print('in:%s,send:%d' % (self.input_ch, new_id))
+                if self.outbound is not None:
+                    # 送信スレッドに任せ、ID変換できた時点でACKを返す
+                    self.outbound.put(self.target_id, new_id)
+                else:
+                    self.send_tcp(new_id)
+                self.reply('ACK')
             else:
-                print('%s>NAK' % self.my_name)
-                self.com.write(chr(router_r_dict['NAK']).encode())
+                self.reply('NAK')
 
-        elif chr(i_array[1])+chr(i_array[2]) == '10':
-            print("%s:クロスポイント状態問い合わせ" % self.my_name)
+        elif command == b'10':
+            if self.debug:
+                print("%s:クロスポイント状態問い合わせ" % self.my_name)
             if not self.ng_mode:
-                print('%s>ACK' % self.my_name)
-                self.com.write(chr(router_r_dict['ACK']).encode())
+                self.reply('ACK')
             else:
-                print('%s>NAK' % self.my_name)
-                self.com.write(chr(router_r_dict['NAK']).encode())
+                self.reply('NAK')
                 return
 
-            for d_item in Serial2Tcp.send_status('127'):
-                self.com.write(d_item.encode())
+            self.com.write(Serial2Tcp.send_status('127').encode('latin-1'))
         self.test_status = True  # 受信データが正しく、適切に応答を返したので成功とする
 
     def start(self):
@@ -214,41 +806,76 @@ class Serial2Tcp:
         :return:
         """
         print('%s:start' % self.my_name)
-        self.run_status = True
+        self.stop_event.clear()
         self.com.flushInput()
         self.com.flushOutput()
         print(self.com.portstr)
 
-        thread = threading.Thread(target=self.run)
-        thread.start()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
 
     def run(self):
         """
         電文の送受信対応するスレッドの本体。
+        受信はデータが届くまでブロックし、届いた時点ですぐに処理する。
 
         :return:
         """
-        while self.run_status:
-            # 受信
-            b_array = array('B')
-            d_len = self.com.inWaiting()  # 受信バッファにたまってる数を確認
-            if d_len > 0:
-                d = self.com.read(d_len)
-                b_array.extend(array('B', d))  # b_arrayの後ろから追加
-                print(self.my_name + ':' + str([hex(x) for x in b_array]))
-                self.b_parser(b_array)
+        if self.outbound is not None and self.sender is None:
+            self.outbound.closed = False
+            self.sender = threading.Thread(target=self.send_run)
+            self.sender.start()
+
+        self.com.timeout = self.interval  # 停止の確認をする間隔
+        decoder = self.decoder
+        while not self.stop_event.is_set():
+            # 受信 最初の1文字が届くまで待ち、残りは受信バッファにたまっている分を読む
+            # 読んだデータはデコーダの受信バッファに直接書き込む
+            space = decoder.space()
+            size = self.com.readinto(space[:1])
+            self.id_table.reload_if_changed()
+            if not size:
+                continue
+            waiting = min(self.com.in_waiting, len(space) - 1)
+            if waiting:
+                size += self.com.readinto(space[1:1 + waiting])
+            if self.debug:
+                print(self.my_name + ':' + space[:size].hex(' '))
+            decoder.commit(size)
+            for frame in decoder.frames():
+                self.b_parser(frame)
+
+    def send_run(self):
+        """
+        キューにたまったソースのSW-P-88パケットをTCPで送信するスレッドの本体。キューが閉じられるまで続ける。
 
-            self.serial_wait(1)
+        :return:
+        """
+        while True:
+            request = self.outbound.get()
+            if request is None:
+                break
+            self.send_tcp(request[1])
 
     def stop(self):
         """
-        電文の送受信対応するスレッドを停止させる。run_statusにて判断している為、この値のみを変更。
+        電文の送受信対応するスレッドを停止させる。受信待ちを中断し、スレッドの終了を待ってから送信先との接続を閉じる。
 
         :return:
         """
         print('%s:stop' % self.my_name)
-        self.run_status = False
-        self.serial_wait(5)
+        self.stop_event.set()
+        if hasattr(self.com, 'cancel_read'):
+            self.com.cancel_read()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+            self.thread = None
+        if self.sender is not None:
+            # 溜まっている要求を送り終えてから送信スレッドを止める
+            self.outbound.close()
+            self.sender.join()
+            self.sender = None
+        self.targets.close()
 
     def get_test_status(self):
         """
@@ -260,6 +887,7 @@ class Serial2Tcp:
 
 
 if __name__ == '__main__':
+    router_metrics.try_start_server()
     s2t = Serial2Tcp('COM11')
-    #s2t.send_packet(s2t.ID_table[70])
+    #s2t.send_packet(s2t.id_table.get(70))
     s2t.start()
@@ -8,6 +8,7 @@ import socket
 import time
 import logging
 import serial2tcp
+import router_metrics
 import os
 
 logging.basicConfig(
@@ -51,6 +52,9 @@ class OrenoSvc (win32serviceutil.ServiceFramework):
             (self._svc_name_,'')
         )
         logging.info('serial2tcp Service を開始します...')
+        # 処理時間などをhttp://127.0.0.1:9057/metricsで取得できるようにする
+        # ポートが使えなくても警告をログに残すだけで、サービスは止めない
+        router_metrics.try_start_server()
         # loop 
         self.s2t.run() 
 
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+SW-P-88のTCPパケットの組み立て・解析をするモジュール。
+パケットは DLE STX + メッセージ + BTC + チェックサム + DLE ETX で、
+DLE STX/DLE ETXの間にデータとして0x10(DLE)が現れる場合は0x10を2つ重ねて送る。
+"""
+
+DLE = 0x10
+STX = 0x02
+ETX = 0x03
+SOM = bytes((DLE, STX))  # パケットの開始
+EOM = bytes((DLE, ETX))  # パケットの終了
+
+CROSSPOINT_CONNECT = 0x02  # クロスポイント制御のコマンド
+
+
+def checksum(data):
+    """
+    メッセージとBTCの合計の2の補数(下位8bit)を返す。
+
+    :param data: bytes
+    :return: int
+    """
+    return -sum(data) & 0xff
+
+
+def encode(message):
+    """
+    メッセージ(コマンド+データ)にBTCとチェックサムを付け、DLEを重ねてパケットにする。
+
+    :param message: bytes
+    :return: bytes
+    """
+    data = bytes(message) + bytes((len(message),))
+    data += bytes((checksum(data),))
+    return SOM + data.replace(bytes((DLE,)), bytes((DLE, DLE))) + EOM
+
+
+def crosspoint_connect(target_id, source_id):
+    """
+    ディスティネーション(target_id)にソース(source_id)を接続するパケットを返す。
+    番号は1から始まり、パケット上は0から始まる値になる。
+
+    :param target_id: int
+    :param source_id: int
+    :return: bytes
+    """
+    return encode(bytes((CROSSPOINT_CONNECT, 0x00, 0x00, target_id - 1, source_id - 1)))
+
+
+def build_packets(source_ids, target_id):
+    """
+    全てのソース番号について、target_idへ接続するパケットを作っておき、ソース番号をキーにした辞書で返す。
+
+    :param source_ids: iterable of int
+    :param target_id: int
+    :return: dict
+    """
+    return {source_id: crosspoint_connect(target_id, source_id) for source_id in source_ids}
+
+
+class Decoder:
+    """
+    受信したデータを溜めて、DLE STX～DLE ETXまでのパケットを1つずつ取り出すクラス。
+    DLEの重なりを戻し、BTCとチェックサムの合わないパケットは捨てて、その数を数える。
+    """
+
+    def __init__(self):
+        """
+        コンストラクタ。受信バッファを空にする。
+        """
+        self.buffer = bytearray()
+        self.errors = 0
+
+    def feed(self, data):
+        """
+        受信データを追加し、揃ったパケットのメッセージ(コマンド+データ)を順に返す。
+
+        :param data: bytes
+        :return: generator
+        """
+        self.buffer.extend(data)
+        while True:
+            start = self.buffer.find(SOM)
+            if start < 0:
+                # 最後のDLEはDLE STXの前半かもしれないので残す
+                del self.buffer[:-1 if self.buffer.endswith(bytes((DLE,))) else len(self.buffer)]
+                return
+            del self.buffer[:start]
+
+            # DLEの重なりを飛ばしながらDLE ETXを探す
+            data = bytearray()
+            i = len(SOM)
+            while i + 1 < len(self.buffer):
+                if self.buffer[i] == DLE:
+                    if self.buffer[i + 1] == DLE:
+                        data.append(DLE)
+                        i += 2
+                        continue
+                    break
+                data.append(self.buffer[i])
+                i += 1
+            else:
+                return  # DLE ETXまで揃っていないので次の受信を待つ
+
+            if self.buffer[i + 1] != ETX:
+                # DLE ETXの前に別の制御(DLE STXなど)が来たので、途中で切れたパケットを捨てる
+                self.errors += 1
+                del self.buffer[:i]
+                continue
+            del self.buffer[:i + 2]
+
+            if len(data) < 2 or data[-2] != len(data) - 2 or checksum(data[:-1]) != data[-1]:
+                self.errors += 1
+                continue
+            yield bytes(data[:-2])
+
+
+def decode(packet):
+    """
+    1つのパケットからメッセージ(コマンド+データ)を返す。異常なパケットの場合はNoneを返す。
+
+    :param packet: bytes
+    :return: bytes
+    """
+    messages = list(Decoder().feed(packet))
+    return messages[0] if len(messages) == 1 else None
@@ -2,6 +2,7 @@
 # -*- coding:utf-8 -*-
 
 import socket
+import sw_p_88
 
 target_ip = "127.0.0.1"
 target_port = 52000
@@ -10,19 +11,9 @@ buffer_size = 4096
 target_id = 12
 source_id = 116
 
-stx = bytearray.fromhex('1002')
+sendmessage = sw_p_88.crosspoint_connect(target_id, source_id)
 
-sendmessage = bytearray.fromhex('020000')
-
-sendmessage.append(target_id-1)
-sendmessage.append(source_id-1)
-sendmessage.append(0x05)
-
-sendmessage.append((~sum(sendmessage) + 1 )& 0xff)
-
-etx= bytearray.fromhex('1003')
-
-for b in stx+sendmessage+etx:
+for b in sendmessage:
     print('%02x' % b)
 
 
@@ -36,7 +27,7 @@ tcp_client.settimeout(2)
 tcp_client.connect((target_ip,target_port))
 
 # 3.サーバにデータを送信
-tcp_client.send(stx+sendmessage+etx)
+tcp_client.send(sendmessage)
 
 # 4.サーバからのレスポンスを受信
 response = tcp_client.recv(buffer_size)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+OA Tallyの接点の変化を記録したトレース、または合成したパターンをGPIOのコールバックに流し込み、
+エミュレータに対して切り替えの遅延を計測する負荷試験プログラム。
+
+トレースはtime(開始からの秒),pin(GPIOのピン番号かnsub/tsub)の列を持つCSV。
+
+python tally_replay.py --trace tally.csv --speed 10
+python tally_replay.py --pattern poisson --rate 200 --duration 5
+python tally_replay.py --pattern burst --burst-size 20 --burst-interval 0.002 --burst-gap 0.5
+"""
+
+import argparse
+import csv
+import json
+import random
+import sys
+import threading
+import time
+import RPi.GPIO as GPIO
+import benchmark
+import change_router
+import router_emulator
+import router_log
+
+pin_names = {'nsub': change_router.gpio_nsub, 'tsub': change_router.gpio_tsub}
+
+
+def read_trace(path_name):
+    """
+    トレースのCSVを読み込み、(時刻, ピン番号)のリストを時刻順で返す。
+
+    :param path_name: str
+    :return: list of (float, int)
+    """
+    events = []
+    with open(path_name, 'r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            pin = row['pin'].strip().lower()
+            events.append((float(row['time']), pin_names[pin] if pin in pin_names else int(pin)))
+    events.sort()
+    return events
+
+
+def poisson_events(rate, duration, seed=None):
+    """
+    1秒にrate回のポアソン過程で、duration秒の間nSubとtSubを交互に入れる(時刻, ピン番号)のリストを返す。
+
+    :param rate: float
+    :param duration: float
+    :param seed: int
+    :return: list of (float, int)
+    """
+    generator = random.Random(seed)
+    events = []
+    now = generator.expovariate(rate)
+    while now < duration:
+        events.append((now, (change_router.gpio_nsub, change_router.gpio_tsub)[len(events) % 2]))
+        now += generator.expovariate(rate)
+    return events
+
+
+def burst_events(bursts, size, interval, gap):
+    """
+    interval秒間隔でsize回nSubとtSubを交互に入れるばたつきを、gap秒毎にbursts回繰り返す
+    (時刻, ピン番号)のリストを返す。
+
+    :param bursts: int
+    :param size: int
+    :param interval: float
+    :param gap: float
+    :return: list of (float, int)
+    """
+    return [(burst * gap + i * interval, (change_router.gpio_nsub, change_router.gpio_tsub)[i % 2])
+            for burst in range(bursts) for i in range(size)]
+
+
+def tally_levels(events):
+    """
+    (時刻, ピン番号)の接点onのリストを、GPIO.Timelineに入れる(時刻, ピン番号, レベル)のリストにする。
+    nSubとtSubは排他なので、一方の接点onでもう一方は接点off(HIGH)にし、
+    既に接点onのピンは一度offにしてからonにする。
+
+    :param events: list of (float, int)
+    :return: list of (float, int, int)
+    """
+    levels = {}
+    result = []
+    for at, pin in events:
+        for other in (change_router.gpio_nsub, change_router.gpio_tsub):
+            if other != pin and levels.get(other) == GPIO.LOW:
+                result.append((at, other, GPIO.HIGH))
+                levels[other] = GPIO.HIGH
+        if levels.get(pin) == GPIO.LOW:
+            result.append((at, pin, GPIO.HIGH))
+        result.append((at, pin, GPIO.LOW))
+        levels[pin] = GPIO.LOW
+    return result
+
+
+def replay(cr, events, speed=1.0):
+    """
+    eventsをspeed倍の速さでGPIO.Timelineの入力レベルとして再生し、callbackを呼んだ各エッジの予定時刻、
+    切り替えの(開始時刻, 完了時刻, 成功したか)のリストを集めた結果を返す。
+    予定時刻に遅れた場合はすぐに次のイベントを入れる。
+
+    :param cr: change_router.ChangeRouter
+    :param events: list of (float, int)
+    :param speed: float
+    :return: dict
+    """
+    switches = []  # (開始時刻, 完了時刻, 成功したか)
+    lock = threading.Lock()
+    set_crosspoint = cr.set_crosspoint
+
+    def recorded_set_crosspoint(dist, source, *args, **kwargs):
+        start = time.perf_counter()
+        status = set_crosspoint(dist, source, *args, **kwargs)
+        with lock:
+            switches.append((start, time.perf_counter(), status))
+        return status
+
+    cr.set_crosspoint = recorded_set_crosspoint
+    # tally_levelsは接点offから始めるので、前回の再生で残ったレベルを戻しておく(上がるエッジは検出しない)
+    for pin in (change_router.gpio_nsub, change_router.gpio_tsub):
+        GPIO.set_input(pin, GPIO.HIGH)
+    cpu = time.process_time()
+    timeline = GPIO.Timeline(tally_levels(events), speed)
+    try:
+        timeline.start()
+        timeline.join()
+        if cr.coalescer is not None:
+            cr.coalescer.flush()
+        if cr.scheduler is not None:
+            cr.scheduler.submit(change_router.PRIORITY_BULK, int, 0).result()
+    finally:
+        del cr.set_crosspoint
+    return {'edges': [timeline.scheduled(at) for at, pin in timeline.fired], 'switches': sorted(switches),
+            'lag': timeline.lag, 'wall': time.perf_counter() - timeline.origin,
+            'cpu': time.process_time() - cpu}
+
+
+def edge_latencies(edges, switches):
+    """
+    各イベントから、その後に開始して成功した最初の切り替えが完了するまでの時間(s)のリストと、
+    その後に成功した切り替えが無かったイベントの数を返す。
+
+    :param edges: list of float
+    :param switches: list of (float, float, bool)
+    :return: (list of float, int)
+    """
+    completed = [(start, done) for start, done, status in switches if status]
+    latencies = []
+    unserved = 0
+    i = 0
+    for edge in sorted(edges):
+        while i < len(completed) and completed[i][0] < edge:
+            i += 1
+        if i < len(completed):
+            latencies.append(completed[i][1] - edge)
+        else:
+            unserved += 1
+    return latencies, unserved
+
+
+def run(events, speed=1.0, window=0.02, latency=0.0, jitter=0.0, nak_rate=0.0, drop_rate=0.0,
+        scheduler=False, seed=None, bouncetime=0):
+    """
+    エミュレータとChangeRouterを用意してeventsを流し込み、結果の辞書を返す。
+
+    :param events: list of (float, int)
+    :param speed: float
+    :param window: float
+    :param latency: float
+    :param jitter: float
+    :param nak_rate: float
+    :param drop_rate: float
+    :param scheduler: bool
+    :param seed: int
+    :param bouncetime: int
+    :return: dict
+    """
+    emulator = router_emulator.RouterEmulator.virtual(
+        latency=latency, jitter=jitter, nak_rate=nak_rate, drop_rate=drop_rate, seed=seed)
+    with emulator:
+        # 本番の前回の状態は使わず、空の状態から始めて最初のイベントから切り替える
+        with change_router.ChangeRouter(log_level=router_log.ERROR + 1, port=emulator.client_ports[0],
+                                        status_path=benchmark.scratch_status_path('tally_replay_')) as cr:
+            cr.bouncetime = bouncetime
+            if scheduler:
+                cr.start_scheduler()
+            cr.set_event_detect('128', window)
+            result = replay(cr, events, speed)
+            coalescer = cr.coalescer
+
+    latencies, unserved = edge_latencies(result['edges'], result['switches'])
+    failures = sum(1 for start, done, status in result['switches'] if not status)
+    report = {
+        'events': len(events),
+        'speed': speed,
+        'event_rate': len(events) / result['wall'] if result['wall'] else 0,
+        'debounced': len(events) - len(result['edges']),  # bouncetimeの間で捨てられたイベント
+        'ignored': len(result['edges']) - coalescer.events,  # 前回と同じ状態で切り替えなかったイベント
+        'coalesced': coalescer.absorbed,
+        'switches': len(result['switches']),
+        'failures': failures,
+        'dropped': unserved,
+        'edge_to_ack': benchmark.percentiles(latencies),
+        'max_lag': result['lag'] * 1000,
+        'wall_seconds': result['wall'],
+        'cpu_seconds': result['cpu'],
+        'emulator': emulator.stats(),
+    }
+    return report
+
+
+def main(argv=None):
+    """
+    コマンドラインの引数に従ってイベントを流し込み、結果をJSONで出力する。
+
+    :param argv: list of str
+    :return: int
+    """
+    parser = argparse.ArgumentParser(description='Tallyの変化を流し込んで切り替えの遅延を計測する')
+    parser.add_argument('--trace', help='トレースのCSVファイル')
+    parser.add_argument('--pattern', choices=('poisson', 'burst'), default='poisson',
+                        help='トレースを指定しない場合に合成するパターン')
+    parser.add_argument('--rate', type=float, default=50, help='poissonの1秒あたりのイベント数')
+    parser.add_argument('--duration', type=float, default=5, help='poissonの秒数')
+    parser.add_argument('--bursts', type=int, default=5, help='burstの回数')
+    parser.add_argument('--burst-size', type=int, default=10, help='1回のburstのイベント数')
+    parser.add_argument('--burst-interval', type=float, default=0.005, help='burst内のイベントの間隔 (s)')
+    parser.add_argument('--burst-gap', type=float, default=1, help='burstの間隔 (s)')
+    parser.add_argument('--speed', type=float, default=1, help='再生速度の倍率 1～100')
+    parser.add_argument('--window', type=float, default=20, help='イベントをまとめる時間 (ms)')
+    parser.add_argument('--latency', type=float, default=0, help='エミュレータの応答の遅延 (ms)')
+    parser.add_argument('--jitter', type=float, default=0, help='エミュレータの遅延のばらつき (ms)')
+    parser.add_argument('--nak-rate', type=float, default=0, help='エミュレータがNAKを返す確率')
+    parser.add_argument('--drop-rate', type=float, default=0, help='エミュレータが応答しない確率')
+    parser.add_argument('--bouncetime', type=int, default=0,
+                        help='GPIOのbouncetime (ms) 本番の設定は300')
+    parser.add_argument('--scheduler', action='store_true', help='優先度付きのスケジューラを使う')
+    parser.add_argument('--seed', type=int, help='乱数の種')
+    parser.add_argument('--output', help='出力ファイル 省略時は標準出力')
+    args = parser.parse_args(argv)
+    if not 0 < args.speed <= 100:
+        parser.error('--speed must be between 0 and 100')
+
+    if args.trace:
+        events = read_trace(args.trace)
+    elif args.pattern == 'poisson':
+        events = poisson_events(args.rate, args.duration, args.seed)
+    else:
+        events = burst_events(args.bursts, args.burst_size, args.burst_interval, args.burst_gap)
+
+    report = run(events, args.speed, args.window / 1000, args.latency / 1000, args.jitter / 1000,
+                 args.nak_rate, args.drop_rate, args.scheduler, args.seed, args.bouncetime)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+async_change_router.pyのunittestプログラム。
+シリアルのテストにserial2tcp.pyを利用しCIツール上でもテスト可能となっている。
+"""
+
+import asyncio
+import time
+import unittest
+import async_change_router
+import serial2tcp
+
+router_port = '/dev/tnt0'  # Jenkins上でテストする場合のデバイス名
+comport = '/dev/tnt1'
+
+
+class AsyncChangeRouterTestCase(unittest.TestCase):
+    """
+    AsyncChangeRouterクラスのテスト
+    """
+
+    @staticmethod
+    def run_router(coro_func, timeout=None):
+        """
+        AsyncChangeRouterを開いてcoro_funcを実行し、結果を返す。
+
+        :param coro_func: function
+        :param timeout: float
+        :return:
+        """
+        async def main():
+            async with async_change_router.AsyncChangeRouter(router_port, timeout) as cr:
+                return await coro_func(cr)
+        return asyncio.run(main())
+
+    def test_set_crosspoint(self):
+        """
+        set_crosspointのテスト。相手側に問題があった場合、失敗するかどうかの確認。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport, ng_mode=True)
+        ser.start()
+        expected = False
+        actual = self.run_router(lambda cr: cr.set_crosspoint('127', '128'))
+        ser.stop()
+        self.assertEqual(expected, actual)
+
+    def test_get_crosspoint(self):
+        """
+        get_crosspointのテスト。ディスティネーション127chの情報を取得。ダミーはソース123chを返す。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport)
+        ser.start()
+        expected = ('127', '123')
+        actual = self.run_router(lambda cr: cr.get_crosspoint('127'))
+        ser.stop()
+        self.assertEqual(expected, actual)
+
+    def test_get_crosspoint2(self):
+        """
+        get_crosspointのテスト。複数のコルーチンから同時に問い合わせても、順番に処理されるか確認。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport)
+        ser.start()
+        expected = [('127', '123'), ('127', '123')]
+        actual = self.run_router(
+            lambda cr: asyncio.gather(cr.get_crosspoint('127'), cr.get_crosspoint('127')))
+        ser.stop()
+        self.assertEqual(expected, actual)
+
+    def test_get_crosspoint3(self):
+        """
+        get_crosspointのテスト。相手側が応答しない場合、タイムアウト値でNoneが返るか確認。
+
+        :return:
+        """
+        start = time.monotonic()
+        actual = self.run_router(lambda cr: cr.get_crosspoint('127'), timeout=0.2)
+        elapsed = time.monotonic() - start
+        self.assertIsNone(actual)
+        self.assertLess(elapsed, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+benchmark.pyとloopback.pyのunittestプログラム。
+"""
+
+import json
+import os
+import socket
+import tempfile
+import time
+import unittest
+import serial
+import benchmark
+import loopback
+
+
+class LoopbackTestCase(unittest.TestCase):
+    """
+    loopbackのテスト
+    """
+
+    def test_serial_pair(self):
+        """
+        SerialPairのテスト。一方に書いたデータがもう一方から読めること。
+
+        :return:
+        """
+        with loopback.SerialPair() as pair:
+            a = serial.Serial(pair.port_a, timeout=1)
+            b = serial.Serial(pair.port_b, timeout=1)
+            try:
+                a.write(b'\x02abc\x03')
+                self.assertEqual(b'\x02abc\x03', b.read(5))
+                b.write(b'\x06')
+                self.assertEqual(b'\x06', a.read(1))
+            finally:
+                a.close()
+                b.close()
+
+    def test_tcp_sink(self):
+        """
+        TcpSinkのテスト。受信したバイト数を数えること。
+
+        :return:
+        """
+        with loopback.TcpSink() as sink:
+            with socket.create_connection(sink.address) as conn:
+                conn.sendall(b'0123456789')
+            deadline = time.monotonic() + 2
+            while sink.received < 10 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(10, sink.received)
+            self.assertEqual(1, sink.connections)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """
+    benchmarkのテスト
+    """
+
+    def test_percentiles(self):
+        """
+        percentilesのテスト。秒をmsにしてパーセンタイルを返すこと。
+
+        :return:
+        """
+        actual = benchmark.percentiles([i / 1000.0 for i in range(100, 0, -1)])
+        self.assertEqual(100, actual['count'])
+        self.assertAlmostEqual(1, actual['min'])
+        self.assertAlmostEqual(51, actual['p50'])
+        self.assertAlmostEqual(99, actual['p99'])
+        self.assertAlmostEqual(100, actual['max'])
+        self.assertEqual({'count': 0}, benchmark.percentiles([]))
+
+    def test_main(self):
+        """
+        mainのテスト。全ての計測が失敗無く終わり、JSONで出力されること。
+
+        :return:
+        """
+        path_name = os.path.join(tempfile.gettempdir(), 'benchmark_test.json')
+        self.assertEqual(0, benchmark.main(['--iterations', '10', '--salvo-size', '4', '--output', path_name,
+                                            '--import-budget', '5000', '--startup-budget', '5000']))
+        with open(path_name) as f:
+            report = json.load(f)
+        os.remove(path_name)
+        results = report['results']
+        self.assertEqual(10, results['set_crosspoint']['count'])
+        self.assertEqual(0, results['set_crosspoint']['failures'])
+        self.assertEqual(0, results['get_crosspoint']['failures'])
+        self.assertEqual(0, results['set_crosspoints']['failures'])
+        self.assertEqual(4, results['set_crosspoints']['size'])
+        self.assertEqual(10, results['gpio_edge_to_ack']['count'])
+        self.assertEqual(10, results['tally_flap']['events'])
+        self.assertLess(results['tally_flap']['dispatched'], 10)
+        self.assertLess(0, results['tcp_bytes_received'])
+        self.assertLess(0, results['import'])
+        self.assertTrue(report['budget']['ok'])
+
+    def test_check_budget(self):
+        """
+        check_budgetのテスト。importか起動の時間が予算を超えると失敗になるか確認。
+
+        :return:
+        """
+        self.assertTrue(benchmark.check_budget({'import': 50, 'startup': 5}, 200, 100)['ok'])
+        self.assertFalse(benchmark.check_budget({'import': 250, 'startup': 5}, 200, 100)['ok'])
+        self.assertFalse(benchmark.check_budget({'import': 50, 'startup': 150}, 200, 100)['ok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
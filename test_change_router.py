@@ -14,11 +14,14 @@ import platform
 import os
 import serial2tcp
 import tempfile
+import threading
+import router_log
+import router_metrics
 
 comport = '/dev/tnt1'  # Jenkins上でテストする場合のデバイス名
 
-# GPIOのinputメソッドを退避
-tmp_input = GPIO.input
+# nSub・tSubのソースも変換できるテスト用の変換テーブル
+table_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_location.csv')
 
 # Windows上はCOM12 、Jenkins上では/dev/tnt0
 if platform.uname()[0] == 'Windows':
@@ -37,13 +40,14 @@ class ChangeRouterTestCase(unittest.TestCase):
         :return:
         """
         print('before test')
-        self.cr = change_router.ChangeRouter()
 
         # 前回のGPIO状態ファイルの削除
         path_name = os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename)
         if os.path.exists(path_name):
             os.remove(path_name)
 
+        self.cr = change_router.ChangeRouter(log_background=False).open()
+
     def tearDown(self):
         """
         テスト毎の事後処理。ChangeRouterのシリアルポートのクローズ。
@@ -51,29 +55,20 @@ class ChangeRouterTestCase(unittest.TestCase):
         :return:
         """
         print('after test')
-        self.cr.com.close()
+        self.cr.close()
+        GPIO.cleanup()  # 入力レベルとcallbackを次のテストに残さない
 
     @staticmethod
     def change_GPIO_input(ch):
         """
         GPIOの状態をセットするメソッド
-        chが0で初期状態に戻す
+        chのピンだけを接点on(LOW)にする。chが0で初期状態に戻す
 
         :param ch:int
         :return:
         """
-
-        # GPIOのinputメソッドを再定義する
-        def new_input(input_ch):
-            if input_ch == ch:
-                return False
-            else:
-                return True
-
-        if ch != 0:
-            GPIO.input = new_input
-        else:
-            GPIO.input = tmp_input
+        for pin in (change_router.gpio_nsub, change_router.gpio_tsub):
+            GPIO.set_input(pin, pin != ch)
 
     def test_write_log(self):
         """
@@ -115,6 +110,76 @@ class ChangeRouterTestCase(unittest.TestCase):
             actual = f.read()
         self.assertEqual(expected, actual)
 
+    def test_write_log3(self):
+        """
+        write_logのテスト。バックグラウンドで書き込む場合、flush_log後にファイルに書き込まれているか確認。
+
+        :return:
+        """
+
+        logname = "write_log.log"
+        pathname = os.path.join(tempfile.gettempdir(), logname)
+        with open(pathname, 'w') as f:
+            f.write("")
+
+        expected = "test1test2"
+        self.cr.log_background = True
+        self.cr.set_log(logname)
+        self.cr.write_log("test1")
+        self.cr.write_log("test2")
+        self.cr.flush_log()
+        self.cr.log_writer.close()
+
+        with open(pathname, 'r') as f:
+            actual = f.read()
+        self.assertEqual(expected, actual)
+
+    def test_close(self):
+        """
+        closeのテスト。バックグラウンドのログを書き込んでから書き込みスレッドを終了し、
+        以降のログは直接ファイルに書き込まれるか確認。
+
+        :return:
+        """
+        logname = "write_log.log"
+        pathname = os.path.join(tempfile.gettempdir(), logname)
+        with open(pathname, 'w') as f:
+            f.write("")
+
+        self.cr.log_background = True
+        self.cr.set_log(logname)
+        log_writer = self.cr.log_writer
+        self.cr.write_log("test1")
+        self.cr.close()
+        self.assertIsNone(self.cr.log_writer)
+        self.assertFalse(log_writer.thread.is_alive())
+        self.cr.write_log("test2")
+
+        with open(pathname, 'r') as f:
+            actual = f.read()
+        self.assertEqual("test1test2", actual)
+
+    def test_write_log4(self):
+        """
+        write_logのテスト。デフォルトのログレベルでは、電文の詳細(DEBUG)は書き込まれないか確認。
+
+        :return:
+        """
+
+        logname = "write_log.log"
+        pathname = os.path.join(tempfile.gettempdir(), logname)
+        with open(pathname, 'w') as f:
+            f.write("")
+
+        expected = "info"
+        self.cr.set_log(logname)
+        self.cr.write_log(">STX", router_log.DEBUG)
+        self.cr.write_log("info", router_log.INFO)
+
+        with open(pathname, 'r') as f:
+            actual = f.read()
+        self.assertEqual(expected, actual)
+
     def test_ChangerRouter_log(self):
         """
         logのパラメータを付与した時のコンストラクタのテスト
@@ -127,8 +192,8 @@ class ChangeRouterTestCase(unittest.TestCase):
             f.write("")
 
         # setupによるインスタンスcloseし、新たにlog付きでインスタンス生成
-        self.cr.com.close()
-        self.cr = change_router.ChangeRouter(log=logname)
+        self.cr.close()
+        self.cr = change_router.ChangeRouter(log=logname, log_background=False).open()
 
         expected = "test"
         self.cr.set_log(logname)
@@ -139,6 +204,38 @@ class ChangeRouterTestCase(unittest.TestCase):
         self.assertEqual(expected, actual)
 
 
+    def test_open(self):
+        """
+        open・closeのテスト。コンストラクタではシリアルポートを開かず、with文で開いて閉じるか確認。
+
+        :return:
+        """
+        self.cr.close()
+        cr = change_router.ChangeRouter(log_background=False)
+        self.assertIsNone(cr.com)
+        with cr:
+            self.assertTrue(cr.com.is_open)
+            self.assertTrue(change_router.gpio_ready)
+        self.assertIsNone(cr.com)
+
+    def test_status_path(self):
+        """
+        status_pathを指定した場合、前回の状態をそのファイルに保存するか確認。
+
+        :return:
+        """
+        path_name = os.path.join(tempfile.gettempdir(), 'test_' + change_router.temp_GPIO_filename)
+        if os.path.exists(path_name):
+            os.remove(path_name)
+        cr = change_router.ChangeRouter(status_path=path_name)
+        cr.status.update(change_router.tSub_ch)
+        cr.status.flush()
+        with open(path_name, 'r') as f:
+            actual = f.read()
+        os.remove(path_name)
+        self.assertEqual(change_router.tSub_ch, actual)
+        self.assertFalse(os.path.exists(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename)))
+
     def test_bcc1(self):
         """
         bbcのテスト1。3文字分のデータを与えてテスト。
@@ -201,6 +298,29 @@ class ChangeRouterTestCase(unittest.TestCase):
         actual = self.cr.get_full_crosspoint_set('127', '128')
         self.assertEqual(expected, actual)
 
+    def test_get_information_frame(self):
+        """
+        get_information_frameのテスト。127chの場合、get_full_informationと同じ内容のbytesになるか確認。
+
+        :return:
+        """
+        expected = self.cr.get_full_information('127').encode('latin-1')
+        actual = self.cr.get_information_frame('127')
+        self.assertIsInstance(actual, bytes)
+        self.assertEqual(expected, actual)
+
+    def test_get_crosspoint_set_frame(self):
+        """
+        get_crosspoint_set_frameのテスト。127chをディスティネーション、128chをソースとしたとき、
+        get_full_crosspoint_setと同じ内容のbytesになるか確認。
+
+        :return:
+        """
+        expected = self.cr.get_full_crosspoint_set('127', '128').encode('latin-1')
+        actual = self.cr.get_crosspoint_set_frame('127', '128')
+        self.assertIsInstance(actual, bytes)
+        self.assertEqual(expected, actual)
+
     def test_get_sub_state(self):
         """
         get_sub_stateのテスト。ダミーのGPIOではOA_chが選択される。
@@ -285,6 +405,18 @@ class ChangeRouterTestCase(unittest.TestCase):
         print(expected, actual)
         self.assertGreaterEqual(expected, actual)
 
+    def test_read_reply(self):
+        """
+        read_replyのテスト。応答が無い場合、deadlineでNoneが返り、それ以上待たないことを確認。
+
+        :return:
+        """
+        start = time.monotonic()
+        actual = self.cr.read_reply(start + 0.2)
+        elapsed = time.monotonic() - start
+        self.assertIsNone(actual)
+        self.assertLess(elapsed, 1)
+
     def test_set_crosspoint(self):
         """
         set_crosspointのテスト。ディスティネーション127ch,ソース128chの制御命令。
@@ -300,6 +432,20 @@ class ChangeRouterTestCase(unittest.TestCase):
         actual = ser.get_test_status()
         self.assertEqual(expected, actual)
 
+    def test_set_crosspoint3(self):
+        """
+        set_crosspointのテスト。ディスティネーション127ch,ソース070chの制御命令。
+        相手側がTCPの送信をキュー経由で行う場合も、成功するかどうかの確認。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport, queue_size=8)
+        ser.start()
+        expected = True
+        actual = self.cr.set_crosspoint('127', '070')
+        ser.stop()
+        self.assertEqual(expected, actual)
+
     def test_set_crosspoint2(self):
         """
         set_crosspointのテスト。ディスティネーション127ch,ソース128chの制御命令。
@@ -315,6 +461,231 @@ class ChangeRouterTestCase(unittest.TestCase):
         actual = status
         self.assertEqual(expected, actual)
 
+    def test_set_crosspoint_metrics(self):
+        """
+        set_crosspointのテスト。相手側がNAKを返した場合、NAKの回数と処理時間が記録されるかの確認。
+
+        :return:
+        """
+        naks = self.cr.replies.get('NAK')
+        count = self.cr.set_seconds.count
+        ser = serial2tcp.Serial2Tcp(comport, ng_mode=True)
+        ser.start()
+        self.cr.set_crosspoint('127', '128')
+        ser.stop()
+        self.assertEqual(naks + 1, self.cr.replies.get('NAK'))
+        self.assertEqual(count + 1, self.cr.set_seconds.count)
+        self.assertIn('router_replies_total{reply="NAK"}', router_metrics.default_registry.render())
+
+    def test_schedule(self):
+        """
+        scheduleのテスト。スケジューラを開始した場合も、ディスティネーション127ch,ソース070chの制御命令が
+        成功するかの確認。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport)
+        ser.start()
+        self.cr.start_scheduler()
+        expected = True
+        actual = self.cr.schedule(change_router.PRIORITY_OPERATOR, 'set_crosspoint', '127', '070').result(10)
+        self.cr.stop_scheduler()
+        ser.stop()
+        self.assertEqual(expected, actual)
+
+    def test_schedule2(self):
+        """
+        scheduleとdispatch_tallyのテスト。スケジューラが終了した後に依頼しても例外にならず、その場で実行するか確認。
+
+        :return:
+        """
+        calls = []
+        self.cr.set_crosspoint = lambda dist, source: calls.append((dist, source)) or True
+        scheduler = self.cr.start_scheduler()
+        scheduler.close()  # self.cr.schedulerが残ったまま終了した状態
+        self.assertTrue(self.cr.schedule(change_router.PRIORITY_OPERATOR, 'set_crosspoint', '127', '070').result(0))
+        self.cr.dispatch_tally('128', '024')
+        self.cr.stop_scheduler()
+        self.assertEqual([('127', '070'), ('128', '024')], calls)
+
+    def test_start_reconcile2(self):
+        """
+        start_reconcileのテスト。待っている問い合わせがstop_schedulerで取り消されても、
+        スレッドが終了せずに問い合わせを続けるか確認。
+
+        :return:
+        """
+        calls = []
+        self.cr.query_crosspoint = lambda dist: calls.append(dist)
+        self.cr.start_scheduler(low_rate=1)  # 2つ目の問い合わせは1秒待たせる
+        self.cr.start_reconcile(['127', '128'], period=0.01)
+        deadline = time.monotonic() + 2
+        while not calls and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.cr.stop_scheduler()
+        while len(calls) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        alive = self.cr.reconcile_thread.is_alive()
+        self.cr.stop_reconcile()
+        self.assertTrue(alive)
+        self.assertLessEqual(4, len(calls))
+
+    def test_set_crosspoints(self):
+        """
+        set_crosspointsのテスト。制御命令が無い場合、何も送信せず空のリストが返るか確認。
+
+        :return:
+        """
+        expected = []
+        actual = self.cr.set_crosspoints([])
+        self.assertEqual(expected, actual)
+
+    def test_set_crosspoints3(self):
+        """
+        set_crosspointsのテスト。ディスティネーション127ch,128chの制御命令を続けて送信。
+        相手側で電文が1回の受信にまとまっても、両方成功するかの確認。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport)
+        ser.start()
+        expected = [('127', True), ('128', True)]
+        actual = self.cr.set_crosspoints([('127', '070'), ('128', '090')])
+        ser.stop()
+        self.assertEqual(expected, actual)
+
+    def test_set_crosspoints4(self):
+        """
+        set_crosspointsのテスト。同じディスティネーション127chに2回制御命令を送り、
+        1つ目(070ch)はACK、2つ目(テーブルに無い999ch)はNAKと、それぞれの電文の結果が返るか確認。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport, table_path=table_path)
+        ser.start()
+        expected = [('127', True), ('127', False)]
+        actual = self.cr.set_crosspoints([('127', '070'), ('127', '999')])
+        ser.stop()
+        self.assertEqual(expected, actual)
+
+    def test_set_crosspoints5(self):
+        """
+        set_crosspointsのテスト。2つ目の応答が失われた場合、1つ目のACKも確定とせず、
+        送信した全てのディスティネーションが失敗となり、記録したクロスポイントも消えるか確認。
+
+        :return:
+        """
+        self.cr.record_crosspoint('127', '070')
+        self.cr.record_crosspoint('128', '090')
+        replies = iter(['ACK', None])
+        self.cr.read_reply = lambda deadline: next(replies)
+        expected = [('127', False), ('128', False)]
+        actual = self.cr.set_crosspoints([('127', '043'), ('128', '024')])
+        self.assertEqual(expected, actual)
+        self.assertIsNone(self.cr.cached_source('127'))
+        self.assertIsNone(self.cr.cached_source('128'))
+
+    def test_set_crosspoints2(self):
+        """
+        set_crosspointsのテスト。ディスティネーション127ch,128chの制御命令。
+        相手側に問題があった場合、全てのディスティネーションが失敗となるかの確認。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport, ng_mode=True)
+        ser.start()
+        expected = [('127', False), ('128', False)]
+        actual = self.cr.set_crosspoints([('127', '070'), ('128', '090')])
+        ser.stop()
+        self.assertEqual(expected, actual)
+
+    def test_set_crosspoint4(self):
+        """
+        set_crosspointのテスト。成功したクロスポイントが記録され、skip_unchangedで同じソースchの場合は
+        送信しないことを確認。相手側は失敗するようにしておき、送信すれば失敗となる。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport)
+        ser.start()
+        self.assertTrue(self.cr.set_crosspoint('127', '070'))
+        ser.stop()
+        self.assertEqual('070', self.cr.cached_source('127'))
+
+        ser = serial2tcp.Serial2Tcp(comport, ng_mode=True)
+        ser.start()
+        expected = [True, False]
+        actual = [self.cr.set_crosspoint('127', '070', skip_unchanged=True),
+                  self.cr.set_crosspoint('127', '090', skip_unchanged=True)]
+        ser.stop()
+        self.assertEqual(expected, actual)
+        self.assertEqual('070', self.cr.cached_source('127'))
+
+    def test_get_source(self):
+        """
+        get_sourceのテスト。問い合わせた結果が記録され、新しいうちは問い合わせずに返るか確認。
+        ダミーはディスティネーション127chにソース123chと返信する。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport)
+        ser.start()
+        first = self.cr.get_source('127')
+        ser.stop()
+        self.assertEqual('123', first)
+
+        # 相手がいなくても記録から返る
+        self.assertEqual('123', self.cr.get_source('127', max_age=60))
+        # 記録が古い場合は問い合わせる為、相手がいないと分からない
+        self.cr.crosspoints['127'] = ('123', time.monotonic() - 120)
+        change_router.timeout = 0.2
+        try:
+            self.assertIsNone(self.cr.get_source('127', max_age=60))
+        finally:
+            change_router.timeout = 5
+
+    def test_get_source2(self):
+        """
+        get_sourceのテスト。max_ageが0の場合は毎回問い合わせ、その応答のソースchを返すか確認。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport)
+        ser.start()
+        actual = self.cr.get_source('127', max_age=0)
+        ser.stop()
+        self.assertEqual('123', actual)
+
+    def test_dump_crosspoints(self):
+        """
+        dump_crosspointsのテスト。ディスティネーション126～128chを続けて問い合わせる。
+        ダミーは全てディスティネーション127chにソース123chと返信する為、127chのみ分かる。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport)
+        ser.start()
+        actual = self.cr.dump_crosspoints(range(126, 129), window=2)
+        ser.stop()
+        self.assertEqual(129, len(actual))
+        self.assertEqual([-1, 123, -1], list(actual[126:129]))
+
+    def test_start_reconcile(self):
+        """
+        start_reconcileのテスト。別スレッドの問い合わせで、クロスポイントの記録が更新されるか確認。
+
+        :return:
+        """
+        ser = serial2tcp.Serial2Tcp(comport)
+        ser.start()
+        self.cr.start_reconcile(['127'], period=0.05)
+        deadline = time.monotonic() + 5
+        while self.cr.cached_source('127') is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.cr.stop_reconcile()
+        ser.stop()
+        self.assertEqual('123', self.cr.cached_source('127'))
+
     def test_set_crosspoint_by_oa_tally(self):
         """
         set_crosspoint_by_oa_tallyのテスト。現状のGPIOの状態から、128chのディスティネーションに対して制御命令。
@@ -338,7 +709,7 @@ class ChangeRouterTestCase(unittest.TestCase):
         :return:
         """
         self.change_GPIO_input(change_router.gpio_nsub)
-        ser = serial2tcp.Serial2Tcp(comport)
+        ser = serial2tcp.Serial2Tcp(comport, table_path=table_path)
         ser.start()
         expected = (True, True)
         status = self.cr.set_crosspoint_by_oa_tally('128')
@@ -357,6 +728,7 @@ class ChangeRouterTestCase(unittest.TestCase):
         # 前回の状態ファイルの作成。ダミーの状態はnSub_ch
         with open(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename), 'w') as f:
             f.write(str(change_router.nSub_ch))
+        self.cr.restore_status()
 
         self.change_GPIO_input(change_router.gpio_nsub)
         ser = serial2tcp.Serial2Tcp(comport)
@@ -378,9 +750,10 @@ class ChangeRouterTestCase(unittest.TestCase):
         # 前回の状態ファイルの作成。ダミーの状態はnSub_ch
         with open(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename), 'w') as f:
             f.write(str(change_router.nSub_ch))
+        self.cr.restore_status()
 
         self.change_GPIO_input(change_router.gpio_tsub)
-        ser = serial2tcp.Serial2Tcp(comport)
+        ser = serial2tcp.Serial2Tcp(comport, table_path=table_path)
         ser.start()
         expected = (True, True)
         status = self.cr.set_crosspoint_by_oa_tally('128')
@@ -444,6 +817,7 @@ class ChangeRouterTestCase(unittest.TestCase):
         # 前回の状態ファイルの作成。ダミーの状態はnSub_ch
         with open(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename), 'w') as f:
             f.write(str(change_router.nSub_ch))
+        self.cr.restore_status()
 
         expected = False
 
@@ -464,6 +838,7 @@ class ChangeRouterTestCase(unittest.TestCase):
         # 前回の状態ファイルの作成。ダミーの状態はnSub_ch
         with open(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename), 'w') as f:
             f.write(str(change_router.nSub_ch))
+        self.cr.restore_status()
 
         # 変化があり、前回状態の書き込み
         self.cr.gpio_status_check()
@@ -498,6 +873,24 @@ class ChangeRouterTestCase(unittest.TestCase):
 
         self.assertEqual(expected, actual)
 
+    def test_GPIO_status_check5(self):
+        """
+        GPIOの状態に変化があった場合、テンポラリファイルに保存され、新しいインスタンスで復元されるか確認。
+
+        :return:
+        """
+        self.change_GPIO_input(change_router.gpio_tsub)
+        self.cr.gpio_status_check()
+        self.change_GPIO_input(0)
+        self.cr.status.flush()
+
+        expected = change_router.tSub_ch
+
+        cr = change_router.ChangeRouter()
+        actual = cr.status.value
+
+        self.assertEqual(expected, actual)
+
     def test_GPIO_history_check(self):
         """
         GPIO_history_checkのテスト。比較ファイルがないためTrueになる。
@@ -519,6 +912,7 @@ class ChangeRouterTestCase(unittest.TestCase):
         # 前回の状態ファイルの作成。ダミーの状態はnSub_ch
         with open(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename), 'w') as f:
             f.write(str(change_router.nSub_ch))
+        self.cr.restore_status()
 
         expected = True
 
@@ -535,6 +929,7 @@ class ChangeRouterTestCase(unittest.TestCase):
         # 前回の状態ファイルの作成。ダミーの状態はnSub_ch
         with open(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename), 'w') as f:
             f.write(str(change_router.nSub_ch))
+        self.cr.restore_status()
 
         expected = False
 
@@ -551,6 +946,7 @@ class ChangeRouterTestCase(unittest.TestCase):
         # 前回の状態ファイルの作成。ダミーの状態はnSub_ch
         with open(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename), 'w') as f:
             f.write(str(change_router.nSub_ch))
+        self.cr.restore_status()
 
         expected = False
 
@@ -609,6 +1005,7 @@ class ChangeRouterTestCase(unittest.TestCase):
         # 前回の状態ファイルの作成。ダミーの状態はnSub_ch
         with open(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename), 'w') as f:
             f.write(str(change_router.nSub_ch))
+        self.cr.restore_status()
 
         expected = '000'  # 受信側初期値ch
         ser = serial2tcp.Serial2Tcp(comport)
@@ -634,6 +1031,7 @@ class ChangeRouterTestCase(unittest.TestCase):
         # 前回の状態ファイルの作成。ダミーの状態はnSub_ch
         with open(os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename), 'w') as f:
             f.write(str(change_router.nSub_ch))
+        self.cr.restore_status()
 
         expected = '000'  # 受信側初期値ch
         ser = serial2tcp.Serial2Tcp(comport)
@@ -661,6 +1059,249 @@ class ChangeRouterTestCase(unittest.TestCase):
 
         self.assertEqual(expected, actual)
 
+    def test_cleanup2(self):
+        """
+        cleanup後にset_event_detectすると、GPIOを設定し直してエッジを受けられるか確認。
+
+        :return:
+        """
+        self.cr.cleanup()
+        self.assertIsNone(GPIO.getmode())
+
+        self.assertTrue(self.cr.set_event_detect('128', window=0))
+        self.assertEqual(GPIO.BCM, GPIO.getmode())
+        self.assertEqual(GPIO.IN, GPIO.directions[change_router.gpio_nsub])
+        self.assertEqual(GPIO.IN, GPIO.directions[change_router.gpio_tsub])
+
+
+class StatusStoreTestCase(unittest.TestCase):
+    """
+    StatusStoreクラスのテスト
+    """
+
+    def test_update(self):
+        """
+        updateのテスト。書き込めないファイルでも例外で止まらず、記録してflushが戻り、
+        次の更新も書き込もうとするか確認。
+
+        :return:
+        """
+        logs = []
+        path_name = os.path.join(tempfile.gettempdir(), 'status_store_test_missing', 'GPIO_status.txt')
+        store = change_router.StatusStore(path_name, lambda message, level: logs.append(level))
+        self.assertTrue(store.update(change_router.nSub_ch))
+        self.assertTrue(store.flush(2))
+        self.assertTrue(store.update(change_router.tSub_ch))
+        self.assertTrue(store.flush(2))
+        self.assertEqual(2, store.errors)
+        self.assertEqual([router_log.ERROR, router_log.ERROR], logs)
+        self.assertEqual(change_router.tSub_ch, store.value)
+
+    def test_update2(self):
+        """
+        updateのテスト。続けて更新した場合、最後の状態がファイルに残るか確認。
+
+        :return:
+        """
+        path_name = os.path.join(tempfile.gettempdir(), 'status_store_test.txt')
+        store = change_router.StatusStore(path_name)
+        threads = [threading.Thread(target=store.update, args=(source,))
+                   for source in (change_router.nSub_ch, change_router.tSub_ch) * 20]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(store.flush(2))
+        actual = store.load()
+        os.remove(path_name)
+        self.assertEqual(store.value, actual)
+
+
+class TallyCoalescerTestCase(unittest.TestCase):
+    """
+    TallyCoalescerクラスのテスト
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。制御した内容を記録するTallyCoalescerを作成。
+
+        :return:
+        """
+        self.dispatched = []
+        self.coalescer = change_router.TallyCoalescer(
+            lambda dist, source: self.dispatched.append((dist, source)), 0.05)
+
+    def test_submit(self):
+        """
+        submitのテスト。窓の最初の要求はすぐに制御されるか確認。
+
+        :return:
+        """
+        self.assertTrue(self.coalescer.submit('128', '024'))
+        self.assertEqual([('128', '024')], self.dispatched)
+        self.assertTrue(self.coalescer.submit('127', '028'))
+        self.assertEqual([('128', '024'), ('127', '028')], self.dispatched)
+
+    def test_submit2(self):
+        """
+        submitのテスト。窓の間にばたついて元のソースに戻った場合、追加の制御はせず、まとめた数を数えるか確認。
+
+        :return:
+        """
+        self.coalescer.submit('128', '024')
+        self.assertFalse(self.coalescer.submit('128', '028'))
+        self.assertFalse(self.coalescer.submit('128', '024'))
+        self.assertTrue(self.coalescer.flush(2))
+        self.assertEqual([('128', '024')], self.dispatched)
+        self.assertEqual(2, self.coalescer.absorbed)
+        self.assertEqual(3, self.coalescer.events)
+
+    def test_submit3(self):
+        """
+        submitのテスト。窓の間に変化した場合、窓の終わりに最新のソースだけを制御するか確認。
+
+        :return:
+        """
+        self.coalescer.submit('128', '024')
+        self.coalescer.submit('128', '043')
+        self.coalescer.submit('128', '028')
+        self.assertEqual([('128', '024')], self.dispatched)
+        self.assertTrue(self.coalescer.flush(2))
+        self.assertEqual([('128', '024'), ('128', '028')], self.dispatched)
+        self.assertEqual(1, self.coalescer.absorbed)
+        self.assertEqual(2, self.coalescer.dispatched)
+
+    def test_submit5(self):
+        """
+        submitのテスト。窓が終わって処理を待っていた要求は、新しい要求に置き換えて数えるか確認。
+
+        :return:
+        """
+        self.coalescer.windows['128'] = [0, '028']
+        self.assertTrue(self.coalescer.submit('128', '024'))
+        self.assertEqual([('128', '024')], self.dispatched)
+        self.assertEqual(1, self.coalescer.absorbed)
+
+    def test_submit4(self):
+        """
+        submitのテスト。窓が終わった後の要求は、またすぐに制御されるか確認。
+
+        :return:
+        """
+        self.coalescer.submit('128', '024')
+        time.sleep(0.1)
+        self.assertTrue(self.coalescer.submit('128', '028'))
+        self.assertEqual([('128', '024'), ('128', '028')], self.dispatched)
+
+
+    def test_run(self):
+        """
+        runのテスト。窓の終わりの制御で例外が起きても、記録して次の窓の要求を制御するか確認。
+
+        :return:
+        """
+        logs = []
+
+        def dispatch(dist, source):
+            if source == '043':
+                raise OSError('write timeout')
+            self.dispatched.append((dist, source))
+
+        coalescer = change_router.TallyCoalescer(dispatch, 0.05, lambda message, level: logs.append(level))
+        coalescer.submit('128', '024')
+        coalescer.submit('128', '043')
+        self.assertTrue(coalescer.flush(2))
+        self.assertEqual(1, coalescer.errors)
+        self.assertEqual([router_log.ERROR], logs)
+
+        time.sleep(0.1)
+        coalescer.submit('128', '024')
+        coalescer.submit('128', '028')
+        self.assertTrue(coalescer.flush(2))
+        self.assertEqual([('128', '024'), ('128', '024'), ('128', '028')], self.dispatched)
+
+
+class CommandSchedulerTestCase(unittest.TestCase):
+    """
+    CommandSchedulerクラスのテスト
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。レジストリを分けたCommandSchedulerを作成。
+
+        :return:
+        """
+        self.scheduler = change_router.CommandScheduler(registry=router_metrics.Registry())
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def test_submit(self):
+        """
+        submitのテスト。待っている命令が、受け付けた順ではなく優先度順に実行されるか確認。
+
+        :return:
+        """
+        order = []
+        event = threading.Event()
+        self.scheduler.submit(change_router.PRIORITY_OPERATOR, event.wait, 2)
+        futures = [self.scheduler.submit(priority, order.append, priority)
+                   for priority in (change_router.PRIORITY_BULK, change_router.PRIORITY_OPERATOR,
+                                    change_router.PRIORITY_TALLY)]
+        event.set()
+        for future in futures:
+            future.result(2)
+        expected = [change_router.PRIORITY_TALLY, change_router.PRIORITY_OPERATOR, change_router.PRIORITY_BULK]
+        self.assertEqual(expected, order)
+
+    def test_submit2(self):
+        """
+        submitのテスト。優先度の低い命令は1秒にlow_rate回までに抑えられ、
+        その間に来た優先度の高い命令は待たされないか確認。
+
+        :return:
+        """
+        self.scheduler.close()
+        self.scheduler = change_router.CommandScheduler(low_rate=5, registry=router_metrics.Registry())
+        start = time.monotonic()
+        bulk = [self.scheduler.submit(change_router.PRIORITY_BULK, time.monotonic) for i in range(3)]
+        tally = self.scheduler.submit(change_router.PRIORITY_TALLY, time.monotonic)
+        self.assertLess(tally.result(2) - start, 0.1)
+        finished = [future.result(2) for future in bulk]
+        self.assertGreaterEqual(finished[2] - finished[0], 0.35)
+
+    def test_submit3(self):
+        """
+        submitのテスト。命令の例外がFutureに渡り、優先度毎の時間が記録されるか確認。
+
+        :return:
+        """
+        future = self.scheduler.submit(change_router.PRIORITY_TALLY, int, 'x')
+        with self.assertRaises(ValueError):
+            future.result(2)
+        self.scheduler.submit(change_router.PRIORITY_OPERATOR, int, '1').result(2)
+        stats = self.scheduler.stats()
+        self.assertEqual(1, stats['tally']['count'])
+        self.assertEqual(1, stats['operator']['count'])
+        self.assertEqual(0, stats['bulk']['count'])
+
+    def test_close(self):
+        """
+        closeのテスト。待っている命令が取り消されるか確認。
+
+        :return:
+        """
+        event = threading.Event()
+        self.scheduler.submit(change_router.PRIORITY_OPERATOR, event.wait, 2)
+        future = self.scheduler.submit(change_router.PRIORITY_BULK, int, '1')
+        threading.Timer(0.1, event.set).start()
+        self.scheduler.close()
+        self.assertTrue(future.cancelled())
+        with self.assertRaises(RuntimeError):
+            self.scheduler.submit(change_router.PRIORITY_TALLY, int, '1')
+
 
 if __name__ == "__main__":
     unittest.main()
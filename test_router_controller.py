@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+router_controller.pyのunittestプログラム。
+ルータaはserial2tcp.pyのダミーに、ルータbは応答の無い疑似端末につなぐ。
+"""
+
+import os
+import pty
+import time
+import unittest
+import change_router
+import router_controller
+import serial2tcp
+
+router_port = '/dev/tnt0'  # Jenkins上でテストする場合のデバイス名
+comport = '/dev/tnt1'
+
+
+class RouterControllerTestCase(unittest.TestCase):
+    """
+    RouterControllerクラスのテスト
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。応答の無いルータbの為の疑似端末と、RouterControllerを作成。
+
+        :return:
+        """
+        self.master, self.slave = pty.openpty()
+        change_router.timeout = 0.5
+        self.controller = router_controller.RouterController(
+            {'a': router_port, 'b': os.ttyname(self.slave)}, log_background=False)
+        self.ser = serial2tcp.Serial2Tcp(comport)
+        self.ser.start()
+
+    def tearDown(self):
+        """
+        テスト毎の事後処理。
+
+        :return:
+        """
+        self.ser.stop()
+        self.controller.close()
+        change_router.timeout = 5
+        os.close(self.master)
+        os.close(self.slave)
+
+    def test_set_crosspoint(self):
+        """
+        set_crosspointのテスト。応答の無いルータbを待たずに、ルータaの切り替えが終わるか確認。
+
+        :return:
+        """
+        start = time.monotonic()
+        future_b = self.controller.set_crosspoint(('b', '127'), '070')
+        future_a = self.controller.set_crosspoint(('a', '127'), '070')
+        self.assertTrue(future_a.result())
+        elapsed = time.monotonic() - start
+        self.assertFalse(future_b.done())
+        self.assertLess(elapsed, change_router.timeout)
+        self.assertFalse(future_b.result())
+
+    def test_get_crosspoint(self):
+        """
+        get_crosspointのテスト。ダミーはディスティネーション127chにソース123chと返信する。
+
+        :return:
+        """
+        expected = ('127', '123')
+        actual = self.controller.get_crosspoint(('a', '127')).result()
+        self.assertEqual(expected, actual)
+
+    def test_set_crosspoints(self):
+        """
+        set_crosspointsのテスト。ルータ毎にまとめて並行して送信し、結果がキー毎に返るか確認。
+
+        :return:
+        """
+        expected = {('a', '127'): True, ('a', '128'): True, ('b', '127'): False}
+        actual = self.controller.set_crosspoints(
+            {('a', '127'): '070', ('a', '128'): '090', ('b', '127'): '070'})
+        self.assertEqual(expected, actual)
+
+
+if __name__ == "__main__":
+    unittest.main()
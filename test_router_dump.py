@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+router_dump.pyのunittestプログラム。
+"""
+
+import io
+import json
+import os
+import tempfile
+import unittest
+from array import array
+import router_dump
+import router_emulator
+
+
+class RouterDumpTestCase(unittest.TestCase):
+    """
+    router_dumpのテスト
+    """
+
+    def test_parse_range(self):
+        """
+        parse_rangeのテスト。範囲と個別の番号の組み合わせ。
+
+        :return:
+        """
+        expected = [1, 2, 3, 7, 10, 11]
+        actual = router_dump.parse_range('1-3,7,10-11')
+        self.assertEqual(expected, actual)
+
+    def test_write_dump(self):
+        """
+        write_dumpのテスト。CSVで出力し、分からなかったソースは空になるか確認。
+
+        :return:
+        """
+        output = io.StringIO()
+        router_dump.write_dump(array('h', [-1, 5, -1]), [1, 2], output, 'csv')
+        expected = 'destination,source\n1,5\n2,\n'
+        self.assertEqual(expected, output.getvalue())
+
+    def test_write_dump2(self):
+        """
+        write_dumpのテスト。JSONで出力し、分からなかったソースはnullになるか確認。
+
+        :return:
+        """
+        output = io.StringIO()
+        router_dump.write_dump(array('h', [-1, 5, -1]), [1, 2], output, 'json')
+        expected = [{'destination': 1, 'source': 5}, {'destination': 2, 'source': None}]
+        self.assertEqual(expected, json.loads(output.getvalue()))
+
+
+    def test_main(self):
+        """
+        mainのテスト。--portで指定したポートのエミュレータから状態を取得し、ファイルに出力するか確認。
+
+        :return:
+        """
+        emulator = router_emulator.RouterEmulator.virtual(seed=1).start()
+        emulator.set_crosspoint(127, 70)
+        with tempfile.TemporaryDirectory() as directory:
+            path_name = os.path.join(directory, 'dump.csv')
+            try:
+                actual = router_dump.main(['--port', emulator.client_ports[0], '--range', '127',
+                                           '--output', path_name])
+            finally:
+                emulator.close()
+            self.assertEqual(0, actual)
+            with open(path_name) as f:
+                self.assertEqual('destination,source\n127,70\n', f.read())
+
+if __name__ == "__main__":
+    unittest.main()
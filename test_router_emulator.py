@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+router_emulator.pyのunittestプログラム。
+疑似端末の対でChangeRouterとエミュレータをつないでテストする。
+"""
+
+import time
+import unittest
+import change_router
+import router_emulator
+import router_log
+
+
+class RouterEmulatorTestCase(unittest.TestCase):
+    """
+    RouterEmulatorクラスのテスト
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。応答待ちのタイムアウトを短くする。
+
+        :return:
+        """
+        self.timeout = change_router.timeout
+        change_router.timeout = 0.3
+        self.emulator = None
+        self.routers = []
+
+    def tearDown(self):
+        """
+        テスト毎の事後処理。ChangeRouterとエミュレータのクローズ。
+
+        :return:
+        """
+        change_router.timeout = self.timeout
+        for cr in self.routers:
+            cr.close()
+        if self.emulator is not None:
+            self.emulator.close()
+
+    def start(self, count=1, **kwargs):
+        """
+        count個のポートでエミュレータを開始し、それぞれに接続したChangeRouterのリストを返す。
+
+        :param count: int
+        :return: list of ChangeRouter
+        """
+        self.emulator = router_emulator.RouterEmulator.virtual(count, seed=1, **kwargs).start()
+        self.routers = [change_router.ChangeRouter(log_level=router_log.ERROR + 1, port=port).open()
+                        for port in self.emulator.client_ports]
+        return self.routers
+
+    def test_status_frame(self):
+        """
+        status_frameのテスト。ChangeRouterで解析できる状態応答電文になるか確認。
+
+        :return:
+        """
+        frame = router_emulator.RouterEmulator.status_frame(127, 70)
+        expected = ('127', '070')
+        actual = change_router.ChangeRouter.parse_status(frame[1:].decode('latin-1'))
+        self.assertEqual(expected, actual)
+        frame = router_emulator.RouterEmulator.status_frame(127, 70, corrupt=True)
+        self.assertIsNone(change_router.ChangeRouter.parse_status(frame[1:].decode('latin-1')))
+
+    def test_set_crosspoint(self):
+        """
+        切り替えた後の状態問い合わせに、実際に切り替えたソースが返るか確認。
+
+        :return:
+        """
+        cr, = self.start()
+        self.assertTrue(cr.set_crosspoint('127', '070'))
+        self.assertTrue(cr.set_crosspoint('128', '090'))
+        self.assertEqual(('127', '070'), cr.query_crosspoint('127'))
+        self.assertEqual(('128', '090'), cr.query_crosspoint('128'))
+        self.assertEqual(70, self.emulator.get_crosspoint(127))
+
+    def test_ports(self):
+        """
+        複数のポートでクロスポイントの状態を共有するか確認。
+
+        :return:
+        """
+        cr1, cr2 = self.start(2)
+        self.assertTrue(cr1.set_crosspoint('127', '070'))
+        self.assertEqual(('127', '070'), cr2.query_crosspoint('127'))
+
+    def test_nak(self):
+        """
+        nak_rateが1の場合、切り替えが失敗し、NAKの数が数えられるか確認。
+
+        :return:
+        """
+        cr, = self.start(nak_rate=1)
+        self.assertFalse(cr.set_crosspoint('127', '070'))
+        self.assertEqual(1, self.emulator.stats()['naks'])
+        self.assertEqual(0, self.emulator.get_crosspoint(127))
+
+    def test_drop(self):
+        """
+        drop_rateが1の場合、応答がタイムアウトして失敗するか確認。
+
+        :return:
+        """
+        cr, = self.start(drop_rate=1)
+        start = time.monotonic()
+        self.assertFalse(cr.set_crosspoint('127', '070'))
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(1, self.emulator.stats()['drops'])
+
+    def test_corrupt(self):
+        """
+        corrupt_rateが1の場合、状態応答のBBC異常で問い合わせが失敗するか確認。
+
+        :return:
+        """
+        cr, = self.start(corrupt_rate=1)
+        errors = cr.status_errors.get()
+        self.assertIsNone(cr.query_crosspoint('127'))
+        self.assertEqual(errors + 1, cr.status_errors.get())
+        self.assertEqual(1, self.emulator.stats()['corrupted'])
+
+    def test_latency(self):
+        """
+        latencyを設定した場合、その分だけ応答が遅れるか確認。
+
+        :return:
+        """
+        cr, = self.start(latency=0.05, jitter=0.01)
+        start = time.monotonic()
+        self.assertTrue(cr.set_crosspoint('127', '070'))
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+router_log.pyのunittestプログラム。
+"""
+
+import os
+import tempfile
+import unittest
+import router_log
+
+
+class LogWriterTestCase(unittest.TestCase):
+    """
+    LogWriterクラスのテスト
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。ログファイルとローテーションしたファイルの削除。
+
+        :return:
+        """
+        self.pathname = os.path.join(tempfile.gettempdir(), "router_log_test.log")
+        for name in (self.pathname, self.pathname + '.1', self.pathname + '.2'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    def read(self, pathname):
+        """
+        ファイルの内容を返す。
+
+        :param pathname: str
+        :return: str
+        """
+        with open(pathname, 'r') as f:
+            return f.read()
+
+    def test_write(self):
+        """
+        writeのテスト。書き込みスレッドでまとめて、順番通りに書き込まれるか確認。
+
+        :return:
+        """
+        writer = router_log.LogWriter(self.pathname, flush_interval=10)
+        for i in range(100):
+            writer.write('%d\n' % i)
+        writer.close()
+
+        expected = ''.join('%d\n' % i for i in range(100))
+        self.assertEqual(expected, self.read(self.pathname))
+
+    def test_flush(self):
+        """
+        flushのテスト。flush_intervalを待たずに書き込まれるか確認。
+
+        :return:
+        """
+        writer = router_log.LogWriter(self.pathname, flush_interval=10)
+        writer.write('test')
+        self.assertTrue(writer.flush(timeout=2))
+        actual = self.read(self.pathname)
+        writer.close()
+        self.assertEqual('test', actual)
+
+    def test_rotate(self):
+        """
+        rotateのテスト。max_bytesを超える場合、古い内容が.1、.2にずれるか確認。
+
+        :return:
+        """
+        writer = router_log.LogWriter(self.pathname, max_bytes=10, backup_count=2)
+        for text in ('aaaaaaaa', 'bbbbbbbb', 'cccccccc', 'dddddddd'):
+            writer.write(text)
+            writer.flush()
+        writer.close()
+
+        self.assertEqual('dddddddd', self.read(self.pathname))
+        self.assertEqual('cccccccc', self.read(self.pathname + '.1'))
+        self.assertEqual('bbbbbbbb', self.read(self.pathname + '.2'))
+
+
+if __name__ == "__main__":
+    unittest.main()
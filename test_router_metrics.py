@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+router_metrics.pyのunittestプログラム。
+"""
+
+import gc
+import unittest
+import urllib.error
+import urllib.request
+import router_metrics
+
+
+class RouterMetricsTestCase(unittest.TestCase):
+    """
+    router_metricsのテスト
+    """
+
+    def setUp(self):
+        self.registry = router_metrics.Registry()
+
+    def test_counter(self):
+        """
+        Counterのテスト。ラベル毎に数えること。
+
+        :return:
+        """
+        counter = self.registry.counter('replies_total', 'replies', 'reply')
+        counter.inc('ACK')
+        counter.inc('ACK')
+        counter.inc('NAK')
+        self.assertIs(counter, self.registry.counter('replies_total', 'replies', 'reply'))
+        self.assertEqual(2, counter.get('ACK'))
+        expected = '# HELP replies_total replies\n' \
+                   '# TYPE replies_total counter\n' \
+                   'replies_total{reply="ACK"} 2\n' \
+                   'replies_total{reply="NAK"} 1\n'
+        self.assertEqual(expected, self.registry.render())
+
+    def test_histogram(self):
+        """
+        Histogramのテスト。区切り毎の件数を累積で出すこと。
+
+        :return:
+        """
+        histogram = self.registry.histogram('seconds', 'latency', (0.01, 0.1))
+        histogram.observe(0.005)
+        histogram.observe(0.01)
+        histogram.observe(0.05)
+        histogram.observe(2)
+        expected = '# HELP seconds latency\n' \
+                   '# TYPE seconds histogram\n' \
+                   'seconds_bucket{le="0.01"} 2\n' \
+                   'seconds_bucket{le="0.1"} 3\n' \
+                   'seconds_bucket{le="+Inf"} 4\n' \
+                   'seconds_sum 2.065\n' \
+                   'seconds_count 4\n'
+        self.assertEqual(expected, self.registry.render())
+
+    def test_gauge(self):
+        """
+        Gaugeのテスト。funcを指定した場合は取得時の値を出すこと。
+
+        :return:
+        """
+        depth = [3]
+        self.registry.gauge('queue_depth', 'depth', lambda: depth[0])
+        depth[0] = 5
+        self.assertIn('queue_depth 5\n', self.registry.render())
+        self.registry.gauge('queue_depth', 'depth', lambda: 7)
+        self.assertIn('queue_depth 7\n', self.registry.render())
+
+    def test_gauge2(self):
+        """
+        Gaugeのテスト。ownerを指定した場合は置き換えずにインスタンス毎の値を合算し、
+        インスタンスが無くなると外れること。
+
+        :return:
+        """
+        class Queue:
+            def __init__(self, depth):
+                self.depth = depth
+
+        queues = [Queue(3), Queue(4)]
+        for queue in queues:
+            self.registry.gauge('queue_depth', 'depth', lambda q: q.depth, owner=queue)
+        self.assertIn('queue_depth 7\n', self.registry.render())
+        del queues[0]
+        gc.collect()
+        self.assertIn('queue_depth 4\n', self.registry.render())
+
+    def test_start_server(self):
+        """
+        start_serverのテスト。/metricsでテキスト形式を返すこと。
+
+        :return:
+        """
+        self.registry.counter('events_total', 'events').inc()
+        server = router_metrics.start_server(0, registry=self.registry)
+        try:
+            url = 'http://127.0.0.1:%d' % server.server_address[1]
+            with urllib.request.urlopen(url + '/metrics', timeout=2) as response:
+                self.assertEqual(200, response.status)
+                self.assertIn('text/plain', response.headers['Content-Type'])
+                self.assertIn('events_total 1\n', response.read().decode('utf-8'))
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + '/other', timeout=2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_try_start_server(self):
+        """
+        try_start_serverのテスト。ポートが使用中の場合は例外にならず、警告を記録してNoneを返すこと。
+
+        :return:
+        """
+        server = router_metrics.start_server(0, registry=self.registry)
+        try:
+            with self.assertLogs('router_metrics', 'WARNING'):
+                actual = router_metrics.try_start_server(server.server_address[1], registry=self.registry)
+            self.assertIsNone(actual)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
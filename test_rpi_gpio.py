@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+RPi/GPIO.py(ダミーのGPIO)のunittestプログラム。
+"""
+
+import threading
+import unittest
+import RPi.GPIO as GPIO
+
+
+class GPIOTestCase(unittest.TestCase):
+    """
+    ダミーのGPIOのテスト
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。検出したエッジを記録するcallbackを用意。
+
+        :return:
+        """
+        GPIO.cleanup()
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(17, GPIO.IN)
+        self.events = []
+        self.threads = []
+
+    def tearDown(self):
+        GPIO.cleanup()
+
+    def callback(self, channel):
+        self.events.append(channel)
+        self.threads.append(threading.current_thread())
+
+    def test_input(self):
+        """
+        inputのテスト。設定していないピンはHIGHで、setupのプルダウンとset_inputが反映されるか確認。
+
+        :return:
+        """
+        self.assertTrue(GPIO.input(17))
+        GPIO.setup(17, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        self.assertFalse(GPIO.input(17))
+        GPIO.set_input(17, GPIO.HIGH)
+        self.assertTrue(GPIO.input(17))
+
+    def test_set_input(self):
+        """
+        set_inputのテスト。FALLINGを指定した場合に、下がるエッジだけでcallbackが呼ばれるか確認。
+
+        :return:
+        """
+        GPIO.add_event_detect(17, GPIO.FALLING, callback=self.callback, bouncetime=0)
+        self.assertTrue(GPIO.set_input(17, GPIO.LOW))
+        self.assertFalse(GPIO.set_input(17, GPIO.LOW))  # レベルが変わらない
+        self.assertFalse(GPIO.set_input(17, GPIO.HIGH))  # 上がるエッジ
+        self.assertTrue(GPIO.set_input(17, GPIO.LOW))
+        self.assertEqual([17, 17], self.events)
+        self.assertTrue(GPIO.event_detected(17))
+        self.assertFalse(GPIO.event_detected(17))
+
+    def test_set_input2(self):
+        """
+        set_inputのテスト。bouncetimeの間のエッジは捨てられるか確認。
+
+        :return:
+        """
+        GPIO.add_event_detect(17, GPIO.BOTH, callback=self.callback, bouncetime=300)
+        self.assertTrue(GPIO.set_input(17, GPIO.LOW, at=0))
+        self.assertFalse(GPIO.set_input(17, GPIO.HIGH, at=0.299))
+        self.assertTrue(GPIO.set_input(17, GPIO.LOW, at=0.3))
+        self.assertEqual([17, 17], self.events)
+
+    def test_add_event_detect(self):
+        """
+        add_event_detectのテスト。cleanup後は番号の指定とピンの設定が消え、RuntimeErrorになるか確認。
+
+        :return:
+        """
+        GPIO.cleanup()
+        self.assertIsNone(GPIO.getmode())
+        self.assertRaises(RuntimeError, GPIO.add_event_detect, 17, GPIO.FALLING)
+        GPIO.setmode(GPIO.BCM)
+        self.assertRaises(RuntimeError, GPIO.add_event_detect, 17, GPIO.FALLING)
+        GPIO.setup(17, GPIO.IN)
+        self.assertTrue(GPIO.add_event_detect(17, GPIO.FALLING))
+
+    def test_add_event_callback(self):
+        """
+        add_event_callbackのテスト。エッジの検出を設定していない場合はRuntimeErrorで、
+        設定後は追加したcallbackも呼ばれるか確認。
+
+        :return:
+        """
+        self.assertRaises(RuntimeError, GPIO.add_event_callback, 17, self.callback)
+        GPIO.add_event_detect(17, GPIO.FALLING, callback=self.callback)
+        GPIO.add_event_callback(17, self.callback)
+        GPIO.set_input(17, GPIO.LOW)
+        self.assertEqual([17, 17], self.events)
+
+        GPIO.remove_event_detect(17)
+        GPIO.set_input(17, GPIO.HIGH)
+        self.assertFalse(GPIO.set_input(17, GPIO.LOW))
+
+    def test_event_detect(self):
+        """
+        event_detectのテスト。レベルに関わらずcallbackが呼ばれ、callbackの例外はerrorsに記録されるか確認。
+
+        :return:
+        """
+        def fail(channel):
+            raise ValueError(channel)
+
+        GPIO.event_detect(17)  # callbackが無くても例外にならない
+        GPIO.add_event_detect(17, GPIO.FALLING, callback=fail)
+        GPIO.add_event_callback(17, self.callback)
+        GPIO.event_detect(17)
+        self.assertEqual([17], self.events)
+        self.assertEqual(1, len(GPIO.errors))
+
+    def test_timeline(self):
+        """
+        Timelineのテスト。別スレッドからcallbackが呼ばれ、予定の時刻でbouncetimeを判定するので、
+        待たずに再生しても結果が変わらないか確認。
+
+        :return:
+        """
+        GPIO.add_event_detect(17, GPIO.FALLING, callback=self.callback, bouncetime=10)
+        events = []
+        for i in range(2000):
+            events.append((i * 0.004, 17, GPIO.LOW))
+            events.append((i * 0.004 + 0.002, 17, GPIO.HIGH))
+        timeline = GPIO.Timeline(events, speed=None).start()
+        self.assertTrue(timeline.join(10))
+        self.assertEqual(667, len(self.events))  # 12msに1回
+        self.assertEqual(667, len(timeline.fired))
+        self.assertEqual({timeline.thread}, set(self.threads))
+
+    def test_timeline2(self):
+        """
+        Timelineのテスト。時刻に合わせて再生し、stopで止められるか確認。
+
+        :return:
+        """
+        GPIO.add_event_detect(17, GPIO.FALLING, callback=self.callback, bouncetime=0)
+        with GPIO.Timeline([(0.01, 17, GPIO.LOW), (10, 17, GPIO.HIGH)]) as timeline:
+            self.assertFalse(timeline.join(0.2))
+            self.assertEqual([17], self.events)
+        self.assertTrue(timeline.join(0))
+        self.assertFalse(GPIO.input(17))
+
+
+if __name__ == '__main__':
+    unittest.main()
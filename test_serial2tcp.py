@@ -0,0 +1,617 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+serial2tcp.pyのunittestプログラム。
+シリアルデバイスを使わない部品と、疑似端末(loopback.SerialPair)につないだSerial2Tcpのテスト。
+"""
+
+import contextlib
+import functools
+import io
+import operator
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import serial
+import loopback
+import router_metrics
+import serial2tcp
+import sw_p_88
+from change_router import ChangeRouter
+
+
+class IdTableTestCase(unittest.TestCase):
+    """
+    IdTableクラスのテスト
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。変換テーブルのファイルを作成。
+
+        :return:
+        """
+        self.path_name = os.path.join(tempfile.gettempdir(), 'id_table_test.csv')
+        self.write_table('札幌,70,116\n函館,90,126\n')
+        self.table = serial2tcp.IdTable(self.path_name)
+        self.table.check_interval = 0
+
+    def tearDown(self):
+        os.remove(self.path_name)
+
+    def write_table(self, rows):
+        """
+        変換テーブルのファイルを書き、更新時刻を進める。
+
+        :param rows: str
+        :return:
+        """
+        with open(self.path_name, 'w', encoding='utf-8') as f:
+            f.write('\ufeff地名,旧番号,新番号\n' + rows)
+        stat = os.stat(self.path_name)
+        os.utime(self.path_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    def test_get(self):
+        """
+        getのテスト。テーブルに無い番号、範囲外の番号はNoneになるか確認。
+
+        :return:
+        """
+        self.assertEqual(116, self.table.get(70))
+        self.assertEqual(126, self.table.get(90))
+        self.assertIsNone(self.table.get(24))
+        self.assertIsNone(self.table.get(1000))
+
+    def test_packets(self):
+        """
+        packetsのテスト。送信先毎に、テーブルの新番号のパケットが作られ、読み込み直すと差し替わるか確認。
+
+        :return:
+        """
+        table = serial2tcp.IdTable(self.path_name, (12, 13))
+        self.assertEqual({116: sw_p_88.crosspoint_connect(12, 116), 126: sw_p_88.crosspoint_connect(12, 126)},
+                         table.packets[0])
+        self.assertEqual(sw_p_88.crosspoint_connect(13, 116), table.packets[1][116])
+
+        self.write_table('札幌,70,117\n')
+        table.check_interval = 0
+        self.assertTrue(table.reload_if_changed())
+        self.assertEqual([117], sorted(table.packets[0]))
+        self.assertEqual(117, table.get(70))
+
+    def test_compile(self):
+        """
+        compileのテスト。不正な行があるとValueErrorになるか確認。
+
+        :return:
+        """
+        for rows in ([{'旧番号': '1000', '新番号': '1'}],
+                     [{'旧番号': '1', '新番号': '257'}],
+                     [{'旧番号': '1', '新番号': 'x'}],
+                     [{'旧番号': '1', '新番号': '2'}, {'旧番号': '1', '新番号': '3'}]):
+            with self.assertRaises(ValueError):
+                serial2tcp.IdTable.compile(rows)
+
+    def test_reload_if_changed(self):
+        """
+        reload_if_changedのテスト。ファイルが更新されると読み込み直すか確認。
+
+        :return:
+        """
+        self.assertFalse(self.table.reload_if_changed())
+        self.write_table('札幌,70,117\nnSub,24,124\n')
+        self.assertTrue(self.table.reload_if_changed())
+        self.assertEqual(117, self.table.get(70))
+        self.assertEqual(124, self.table.get(24))
+        self.assertIsNone(self.table.get(90))
+        self.assertEqual(1, self.table.reloads)
+
+    def test_reload_if_changed2(self):
+        """
+        reload_if_changedのテスト。不正な行がある場合は差し替えず、元のテーブルを使い続けるか確認。
+
+        :return:
+        """
+        self.write_table('札幌,70,117\n不正,abc,1\n')
+        self.assertFalse(self.table.reload_if_changed())
+        self.assertEqual(116, self.table.get(70))
+        self.assertEqual(1, self.table.errors)
+        self.assertFalse(self.table.reload_if_changed())
+        self.assertEqual(1, self.table.errors)
+
+
+class FrameDecoderTestCase(unittest.TestCase):
+    """
+    FrameDecoderクラスのテスト
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。1つのFrameDecoderのインスタンスを作成。
+
+        :return:
+        """
+        self.decoder = serial2tcp.FrameDecoder()
+        self.frame = ChangeRouter.get_crosspoint_set_frame('127', '070')
+        self.frame2 = ChangeRouter.get_information_frame('128')
+
+    def test_feed(self):
+        """
+        feedのテスト。1つの電文を一度に受信した場合。
+
+        :return:
+        """
+        expected = [self.frame]
+        actual = list(self.decoder.feed(self.frame))
+        self.assertEqual(expected, actual)
+
+    def test_feed2(self):
+        """
+        feedのテスト。1つの電文が1文字ずつに分かれて受信した場合、最後の1文字で電文が揃うか確認。
+
+        :return:
+        """
+        actual = []
+        for x in self.frame:
+            actual.append(list(self.decoder.feed(bytes((x,)))))
+        self.assertEqual([[]] * (len(self.frame) - 1) + [[self.frame]], actual)
+
+    def test_feed3(self):
+        """
+        feedのテスト。複数の電文が1回の受信で届き、さらに途中で分かれている場合。
+
+        :return:
+        """
+        data = self.frame + self.frame2 + self.frame
+        expected = [self.frame, self.frame2, self.frame]
+        actual = list(self.decoder.feed(data[:20])) + list(self.decoder.feed(data[20:]))
+        self.assertEqual(expected, actual)
+
+    def test_feed4(self):
+        """
+        feedのテスト。BBCが合わない電文は捨てて数え、次の電文は取り出せるか確認。
+
+        :return:
+        """
+        broken = self.frame[:-1] + bytes((self.frame[-1] ^ 0xff,))
+        expected = [self.frame2]
+        actual = list(self.decoder.feed(broken + self.frame2))
+        self.assertEqual(expected, actual)
+        self.assertEqual(1, self.decoder.bbc_errors)
+
+    def test_feed5(self):
+        """
+        feedのテスト。STX前のゴミや、ETXが欠けて途中で切れた電文は読み飛ばすか確認。
+
+        :return:
+        """
+        data = b'\x06\x15' + self.frame[:8] + self.frame2
+        expected = [self.frame2]
+        actual = list(self.decoder.feed(data))
+        self.assertEqual(expected, actual)
+
+    def test_feed6(self):
+        """
+        feedのテスト。電文はコピーせず、受信バッファのmemoryviewで返すか確認。
+
+        :return:
+        """
+        actual = list(self.decoder.feed(self.frame))
+        self.assertIsInstance(actual[0], memoryview)
+        self.assertIs(self.decoder.buffer, actual[0].obj)
+
+    def test_feed7(self):
+        """
+        feedのテスト。受信バッファの大きさを超えて受信を続けても、途中で分かれた電文を取り出せるか確認。
+
+        :return:
+        """
+        decoder = serial2tcp.FrameDecoder(256)
+        data = (self.frame + self.frame2) * 50
+        actual = []
+        for i in range(0, len(data), 7):
+            actual.extend(bytes(frame) for frame in decoder.feed(data[i:i + 7]))
+        self.assertEqual([self.frame, self.frame2] * 50, actual)
+        self.assertEqual(0, decoder.bbc_errors)
+
+    def test_feed8(self):
+        """
+        feedのテスト。ETXの来ないデータで受信バッファが一杯になった場合、捨てて次の電文を取り出せるか確認。
+
+        :return:
+        """
+        decoder = serial2tcp.FrameDecoder(256)
+        list(decoder.feed(b'\x02' + b'0' * 300))
+        actual = [bytes(frame) for frame in decoder.feed(self.frame)]
+        self.assertEqual([self.frame], actual)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class TargetConnectionTestCase(unittest.TestCase):
+    """
+    TargetConnectionクラスのテスト。ローカルのTCPサーバを送信先とする。
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。ローカルのTCPサーバを立て、そこへのTargetConnectionを作成。
+
+        :return:
+        """
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.server.settimeout(2)
+        self.connection = serial2tcp.TargetConnection(*self.server.getsockname())
+
+    def tearDown(self):
+        """
+        テスト毎の事後処理。接続とサーバのクローズ。
+
+        :return:
+        """
+        self.connection.close()
+        self.server.close()
+
+    def receive(self, conn, size):
+        """
+        サーバ側でsizeバイト受信する。
+
+        :param conn: socket
+        :param size: int
+        :return: bytes
+        """
+        data = b''
+        while len(data) < size:
+            data += conn.recv(size - len(data))
+        return data
+
+    def test_send(self):
+        """
+        sendのテスト。2回送信しても接続は1回で、両方届くか確認。
+
+        :return:
+        """
+        self.assertTrue(self.connection.send(b'abc'))
+        conn, address = self.server.accept()
+        self.assertTrue(self.connection.send(b'def'))
+        actual = self.receive(conn, 6)
+        conn.close()
+        self.assertEqual(b'abcdef', actual)
+        self.assertEqual(1, self.connection.connects)
+
+    def test_send2(self):
+        """
+        sendのテスト。相手から切断された場合、次の送信で再接続して届くか確認。
+
+        :return:
+        """
+        self.assertTrue(self.connection.send(b'abc'))
+        conn, address = self.server.accept()
+        self.receive(conn, 3)
+        conn.close()
+        time.sleep(0.1)
+
+        self.assertTrue(self.connection.send(b'def'))
+        conn, address = self.server.accept()
+        actual = self.receive(conn, 3)
+        conn.close()
+        self.assertEqual(b'def', actual)
+        self.assertEqual(2, self.connection.connects)
+
+    def test_is_alive(self):
+        """
+        is_aliveのテスト。相手からのレスポンスは出力せずに数えて読み捨て、接続は生きているとなるか確認。
+
+        :return:
+        """
+        self.assertTrue(self.connection.send(b'abc'))
+        conn, address = self.server.accept()
+        conn.sendall(b'ok')
+        time.sleep(0.1)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertTrue(self.connection.is_alive())
+        conn.close()
+        self.assertEqual('', stdout.getvalue())
+        self.assertEqual(1, self.connection.responses)
+
+    def test_send3(self):
+        """
+        sendのテスト。接続できない場合、例外にならずFalseが返り、待ち時間中は接続を試みないか確認。
+
+        :return:
+        """
+        self.server.close()
+        self.assertFalse(self.connection.send(b'abc'))
+        self.assertFalse(self.connection.send(b'abc'))
+        self.assertEqual(1, self.connection.errors)
+
+
+class TargetGroupTestCase(unittest.TestCase):
+    """
+    TargetGroupクラスのテスト。ローカルのTCPサーバ2つを送信先とする。
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。ローカルのTCPサーバを2つ立て、その両方へのTargetGroupを作成。
+
+        :return:
+        """
+        self.servers = []
+        for i in range(2):
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(('127.0.0.1', 0))
+            server.listen(5)
+            server.settimeout(2)
+            self.servers.append(server)
+        self.group = serial2tcp.TargetGroup(
+            [self.servers[0].getsockname() + (12,), self.servers[1].getsockname() + (13, 0.2)])
+
+    def tearDown(self):
+        """
+        テスト毎の事後処理。接続とサーバのクローズ。
+
+        :return:
+        """
+        self.group.close()
+        for server in self.servers:
+            server.close()
+
+    def test_send(self):
+        """
+        sendのテスト。それぞれの送信先に、そのディスティネーション番号のパケットが届くか確認。
+
+        :return:
+        """
+        self.assertEqual([True, True], self.group.send(116))
+        for server, target_id in zip(self.servers, (12, 13)):
+            conn, address = server.accept()
+            expected = serial2tcp.connect_packet(target_id, 116)
+            actual = b''
+            while len(actual) < len(expected):
+                actual += conn.recv(len(expected) - len(actual))
+            conn.close()
+            self.assertEqual(expected, actual)
+        self.assertEqual([1, 1], self.group.successes)
+
+    def test_send3(self):
+        """
+        sendのテスト。送信先毎のパケットの辞書を指定すると、辞書にあるパケットを送り、
+        無いソース番号はその場で作ったパケットを送るか確認。
+
+        :return:
+        """
+        self.assertEqual([True, True], self.group.send(116, ({116: b'abc'}, {})))
+        for server, expected in zip(self.servers, (b'abc', serial2tcp.connect_packet(13, 116))):
+            conn, address = server.accept()
+            actual = b''
+            while len(actual) < len(expected):
+                actual += conn.recv(len(expected) - len(actual))
+            conn.close()
+            self.assertEqual(expected, actual)
+
+    def test_send2(self):
+        """
+        sendのテスト。送信先のタイムアウトまでに送れない送信先があっても、
+        もう一方は成功し、全体はそのタイムアウトで戻るか確認。
+
+        :return:
+        """
+        def slow_send(data):
+            time.sleep(1)
+            return True
+
+        self.group.connections[1].send = slow_send
+        start = time.monotonic()
+        actual = self.group.send(116)
+        elapsed = time.monotonic() - start
+        self.assertEqual([True, False], actual)
+        self.assertLess(elapsed, 0.8)
+        self.assertEqual([0, 1], self.group.timeouts)
+        self.assertEqual([1, 0], self.group.successes)
+        self.assertEqual([0, 1], self.group.failures)
+
+
+class OutboundQueueTestCase(unittest.TestCase):
+    """
+    OutboundQueueクラスのテスト
+    """
+
+    def test_put(self):
+        """
+        putのテスト。入れた順に取り出せるか確認。
+
+        :return:
+        """
+        queue = serial2tcp.OutboundQueue(4)
+        queue.put(12, 116)
+        queue.put(13, 117)
+        self.assertEqual(2, queue.depth)
+        self.assertEqual((12, 116), queue.get())
+        self.assertEqual((13, 117), queue.get())
+        self.assertEqual(0, queue.depth)
+
+    def test_put2(self):
+        """
+        putのテスト。blockで溢れた場合、タイムアウトで入れずにFalseを返し、数えるか確認。
+
+        :return:
+        """
+        queue = serial2tcp.OutboundQueue(1, 'block')
+        self.assertTrue(queue.put(12, 116))
+        self.assertFalse(queue.put(12, 117, timeout=0.1))
+        self.assertEqual(1, queue.drops)
+        self.assertEqual((12, 116), queue.get())
+
+    def test_put3(self):
+        """
+        putのテスト。drop_oldestで溢れた場合、一番古い要求が捨てられるか確認。
+
+        :return:
+        """
+        queue = serial2tcp.OutboundQueue(2, 'drop_oldest')
+        queue.put(12, 116)
+        queue.put(12, 117)
+        queue.put(12, 118)
+        self.assertEqual(1, queue.drops)
+        self.assertEqual([(12, 117), (12, 118)], [queue.get(), queue.get()])
+
+    def test_put5(self):
+        """
+        putのテスト。counterを共有した2つのキューで、捨てた要求が合算して数えられるか確認。
+
+        :return:
+        """
+        counter = router_metrics.Counter('drops_total', 'drops')
+        queues = [serial2tcp.OutboundQueue(1, 'drop_oldest', counter),
+                  serial2tcp.OutboundQueue(1, 'block', counter)]
+        for queue in queues:
+            queue.put(12, 116)
+        queues[0].put(12, 117)
+        self.assertFalse(queues[1].put(12, 117, timeout=0))
+        self.assertEqual(2, counter.get())
+        self.assertEqual([1, 1], [queue.drops for queue in queues])
+
+    def test_put4(self):
+        """
+        putのテスト。coalesceで同じディスティネーションの要求が最新の1つにまとまるか確認。
+
+        :return:
+        """
+        queue = serial2tcp.OutboundQueue(2, 'coalesce')
+        queue.put(12, 116)
+        queue.put(13, 116)
+        queue.put(12, 118)
+        self.assertEqual(1, queue.coalesced)
+        self.assertEqual(2, queue.depth)
+        self.assertEqual([(12, 118), (13, 116)], [queue.get(), queue.get()])
+
+        # 取り出した後は、同じディスティネーションでも新しい要求になる
+        queue.put(12, 119)
+        self.assertEqual((12, 119), queue.get())
+
+    def test_get(self):
+        """
+        getのテスト。キューを閉じると、待っている取り出しがNoneで戻るか確認。
+
+        :return:
+        """
+        queue = serial2tcp.OutboundQueue(2)
+        timer = threading.Timer(0.1, queue.close)
+        timer.start()
+        self.assertIsNone(queue.get(timeout=2))
+        timer.join()
+
+    def test_policy(self):
+        """
+        不明な溢れた時の動作を指定した場合、ValueErrorになるか確認。
+
+        :return:
+        """
+        with self.assertRaises(ValueError):
+            serial2tcp.OutboundQueue(2, 'unknown')
+
+
+class Serial2TcpTestCase(unittest.TestCase):
+    """
+    Serial2Tcpクラスのテスト。疑似端末とローカルのTCPサーバ(loopback.TcpSink)を使う。
+    """
+
+    def setUp(self):
+        """
+        テスト毎の事前準備。疑似端末の対とTcpSinkを用意し、一方の端末でSerial2Tcpを作成。
+
+        :return:
+        """
+        self.pair = loopback.SerialPair()
+        self.sink = loopback.TcpSink()
+        self.s2t = serial2tcp.Serial2Tcp(self.pair.port_b, targets=[self.sink.address + (12,)],
+                                         registry=router_metrics.Registry())
+
+    def tearDown(self):
+        """
+        テスト毎の事後処理。
+
+        :return:
+        """
+        self.s2t.stop()
+        self.s2t.com.close()
+        self.sink.close()
+        self.pair.close()
+
+    @staticmethod
+    def wait_until(condition, timeout=2):
+        """
+        conditionがTrueを返すまで、最大timeout秒待つ。
+
+        :param condition: function
+        :param timeout: float
+        :return: bool
+        """
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def test_stop(self):
+        """
+        stopのテスト。送信先との接続を閉じ、送信先で切断が検出されるか確認。
+
+        :return:
+        """
+        self.assertTrue(self.s2t.send_tcp(116))
+        self.assertTrue(self.wait_until(lambda: self.sink.connections == 1))
+        self.s2t.stop()
+        self.assertTrue(self.wait_until(lambda: self.sink.disconnections == 1))
+
+    def test_b_parser(self):
+        """
+        b_parserのテスト。debugでなければ、電文毎に何も表示せずに応答するか確認。
+
+        :return:
+        """
+        stx, etx = serial2tcp.router_r_dict['STX'], serial2tcp.router_r_dict['ETX']
+        frames = [bytes((stx,)) + b'0300000128999' + bytes((etx, 0)),  # テーブルに無いソース
+                  bytes((stx,)) + b'1000000127000' + bytes((etx, 0))]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            for frame in frames:
+                self.s2t.b_parser(memoryview(frame))
+        self.assertEqual('', output.getvalue())
+        self.assertEqual(1, self.s2t.replies.get('NAK'))
+
+    def test_run(self):
+        """
+        runのテスト。電文を受信待ちのタイムアウトを待たずにすぐ処理して応答し、
+        stopは受信待ちを中断してinterval(s)より十分早く戻るか確認。
+
+        :return:
+        """
+        stx, etx = serial2tcp.router_r_dict['STX'], serial2tcp.router_r_dict['ETX']
+        frame = bytes((stx,)) + b'1000000127000' + bytes((etx,))
+        frame += bytes((functools.reduce(operator.xor, frame[1:]),))
+        self.s2t.start()
+        with serial.serial_for_url(self.pair.port_a, timeout=2) as com:
+            start = time.monotonic()
+            com.write(frame)
+            reply = com.read(1)
+            elapsed = time.monotonic() - start
+        self.assertEqual(bytes((serial2tcp.router_r_dict['ACK'],)), reply)
+        self.assertLess(elapsed, 0.1)
+
+        start = time.monotonic()
+        self.s2t.stop()
+        elapsed = time.monotonic() - start
+        self.assertIsNone(self.s2t.thread)
+        self.assertLess(elapsed, self.s2t.interval / 2)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+sw_p_88.pyのunittestプログラム。
+"""
+
+import unittest
+import sw_p_88
+
+
+class SwP88TestCase(unittest.TestCase):
+    """
+    SW-P-88のパケットの組み立て・解析のテスト
+    """
+
+    def test_checksum(self):
+        """
+        checksumのテスト。合計との和の下位8bitが0になるか確認。
+
+        :return:
+        """
+        data = bytes((0x02, 0x00, 0x00, 0x0b, 0x73, 0x05))
+        actual = sw_p_88.checksum(data)
+        self.assertEqual(0, (sum(data) + actual) & 0xff)
+
+    def test_crosspoint_connect(self):
+        """
+        crosspoint_connectのテスト。ディスティネーション12、ソース116のパケット。
+
+        :return:
+        """
+        expected = bytes.fromhex('1002' + '0200000b7305' + '7b' + '1003')
+        actual = sw_p_88.crosspoint_connect(12, 116)
+        self.assertEqual(expected, actual)
+
+    def test_crosspoint_connect2(self):
+        """
+        crosspoint_connectのテスト。ソース17はデータが0x10になるため、0x10が重ねられるか確認。
+
+        :return:
+        """
+        expected = bytes.fromhex('1002' + '0200000b1010' + '05' + 'de' + '1003')
+        actual = sw_p_88.crosspoint_connect(12, 17)
+        self.assertEqual(expected, actual)
+
+    def test_decode(self):
+        """
+        decodeのテスト。0x10が重なったパケットも元のメッセージに戻るか確認。
+
+        :return:
+        """
+        expected = bytes((0x02, 0x00, 0x00, 0x0b, 0x10))
+        actual = sw_p_88.decode(sw_p_88.crosspoint_connect(12, 17))
+        self.assertEqual(expected, actual)
+
+    def test_decode2(self):
+        """
+        decodeのテスト。チェックサムが合わない場合Noneになるか確認。
+
+        :return:
+        """
+        packet = bytearray(sw_p_88.crosspoint_connect(12, 116))
+        packet[-3] ^= 0xff
+        self.assertIsNone(sw_p_88.decode(bytes(packet)))
+
+    def test_decoder(self):
+        """
+        Decoderのテスト。複数のパケットが1バイトずつ届いても順に取り出せるか確認。
+
+        :return:
+        """
+        data = sw_p_88.crosspoint_connect(12, 17) + sw_p_88.crosspoint_connect(12, 116)
+        decoder = sw_p_88.Decoder()
+        actual = []
+        for x in data:
+            actual.extend(decoder.feed(bytes((x,))))
+        expected = [bytes((0x02, 0x00, 0x00, 0x0b, 0x10)), bytes((0x02, 0x00, 0x00, 0x0b, 0x73))]
+        self.assertEqual(expected, actual)
+        self.assertEqual(0, decoder.errors)
+
+    def test_build_packets(self):
+        """
+        build_packetsのテスト。ソース番号毎に、パケットが作られるか確認。
+
+        :return:
+        """
+        expected = {116: sw_p_88.crosspoint_connect(12, 116), 126: sw_p_88.crosspoint_connect(12, 126)}
+        actual = sw_p_88.build_packets([116, 126], 12)
+        self.assertEqual(expected, actual)
+
+
+if __name__ == "__main__":
+    unittest.main()
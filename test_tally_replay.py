@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+tally_replay.pyのunittestプログラム。
+"""
+
+import os
+import tempfile
+import unittest
+import RPi.GPIO as GPIO
+import change_router
+import tally_replay
+
+
+class TallyReplayTestCase(unittest.TestCase):
+    """
+    tally_replayのテスト
+    """
+
+    def test_read_trace(self):
+        """
+        read_traceのテスト。ピン名とピン番号を読み、時刻順に並べるか確認。
+
+        :return:
+        """
+        path_name = os.path.join(tempfile.gettempdir(), 'tally_trace_test.csv')
+        with open(path_name, 'w') as f:
+            f.write('time,pin\n0.5,tsub\n0.1,NSUB\n1.0,2\n')
+        actual = tally_replay.read_trace(path_name)
+        os.remove(path_name)
+        expected = [(0.1, change_router.gpio_nsub), (0.5, change_router.gpio_tsub), (1.0, 2)]
+        self.assertEqual(expected, actual)
+
+    def test_poisson_events(self):
+        """
+        poisson_eventsのテスト。同じ種なら同じ結果になり、時刻がdurationに収まるか確認。
+
+        :return:
+        """
+        events = tally_replay.poisson_events(100, 2, seed=1)
+        self.assertEqual(events, tally_replay.poisson_events(100, 2, seed=1))
+        self.assertTrue(all(0 <= at < 2 for at, pin in events))
+        self.assertLess(100, len(events))
+        self.assertEqual([change_router.gpio_nsub, change_router.gpio_tsub], [pin for at, pin in events[:2]])
+
+    def test_burst_events(self):
+        """
+        burst_eventsのテスト。
+
+        :return:
+        """
+        actual = tally_replay.burst_events(2, 3, 0.01, 1)
+        self.assertEqual([0, 0.01, 0.02, 1, 1.01, 1.02], [round(at, 6) for at, pin in actual])
+
+    def test_tally_levels(self):
+        """
+        tally_levelsのテスト。接点onでもう一方のピンをoffにし、続けて同じピンの場合は一度offにするか確認。
+
+        :return:
+        """
+        nsub = change_router.gpio_nsub
+        tsub = change_router.gpio_tsub
+        actual = tally_replay.tally_levels([(0, nsub), (1, tsub), (2, tsub)])
+        expected = [(0, nsub, GPIO.LOW), (1, nsub, GPIO.HIGH), (1, tsub, GPIO.LOW),
+                    (2, tsub, GPIO.HIGH), (2, tsub, GPIO.LOW)]
+        self.assertEqual(expected, actual)
+
+    def test_edge_latencies(self):
+        """
+        edge_latenciesのテスト。イベントの後に開始して成功した切り替えの完了までを遅延とし、
+        成功した切り替えの無いイベントを数えるか確認。
+
+        :return:
+        """
+        edges = [1.0, 1.5, 3.0, 5.0]
+        switches = [(1.1, 1.2, True), (2.0, 2.5, True), (3.1, 3.3, False)]
+        latencies, unserved = tally_replay.edge_latencies(edges, switches)
+        self.assertEqual([0.2, 1.0], [round(latency, 6) for latency in latencies])
+        self.assertEqual(2, unserved)
+
+    def test_run(self):
+        """
+        runのテスト。ばたつきがまとめられ、全てのイベントが切り替えかまとめた数に数えられるか確認。
+
+        :return:
+        """
+        events = tally_replay.burst_events(2, 5, 0.001, 0.1)
+        report = tally_replay.run(events, speed=1, seed=1)
+        self.assertEqual(10, report['events'])
+        self.assertEqual(0, report['debounced'])
+        self.assertLess(0, report['coalesced'])
+        self.assertEqual(0, report['dropped'])
+        self.assertEqual(0, report['failures'])
+        self.assertEqual(10, report['ignored'] + report['coalesced'] + report['switches'])
+        self.assertEqual(10, report['edge_to_ack']['count'])
+        self.assertEqual(report['switches'], report['emulator']['acks'])
+
+    def test_run2(self):
+        """
+        runのテスト。bouncetimeを指定すると、間隔の短いイベントが捨てられるか確認。
+
+        :return:
+        """
+        events = tally_replay.burst_events(1, 6, 0.001, 1)
+        report = tally_replay.run(events, speed=None, seed=1, bouncetime=300)
+        self.assertEqual(4, report['debounced'])  # nSubとtSubの最初のエッジだけが残る
+        self.assertEqual(2, report['edge_to_ack']['count'])
+
+    def test_run3(self):
+        """
+        runのテスト。本番の前回の状態のファイルを使わず、書き換えないか確認。
+
+        :return:
+        """
+        path_name = os.path.join(tempfile.gettempdir(), change_router.temp_GPIO_filename)
+        with open(path_name, 'w') as f:
+            f.write(change_router.nSub_ch)
+        try:
+            report = tally_replay.run([(0, change_router.gpio_nsub), (0.01, change_router.gpio_tsub)],
+                                      speed=None, window=0, seed=1)
+            with open(path_name, 'r') as f:
+                actual = f.read()
+        finally:
+            os.remove(path_name)
+        self.assertEqual(0, report['ignored'])  # 本番の状態(nSub)を読んでいれば最初のイベントは切り替えない
+        self.assertEqual(2, report['switches'])
+        self.assertEqual(change_router.nSub_ch, actual)
+
+
+    def test_replay(self):
+        """
+        replayのテスト。前回の再生で接点onのまま残ったピンがあっても、同じイベントは同じ結果になるか確認。
+
+        :return:
+        """
+        events = [(0, change_router.gpio_nsub), (0.01, change_router.gpio_tsub)]
+        first = tally_replay.run(events, speed=None, window=0, seed=1)
+        second = tally_replay.run(events, speed=None, window=0, seed=1)
+        self.assertEqual(0, first['debounced'])
+        self.assertEqual(0, second['debounced'])
+        self.assertEqual(first['switches'], second['switches'])
+
+
+if __name__ == '__main__':
+    unittest.main()